@@ -0,0 +1,65 @@
+"""
+Measures the cold-start cost of ``run_cumulus_task``: the time to import the
+module, and the time of the first invocation for an inline message without
+schemas, each in a fresh interpreter.  Also reports which of the message
+adapter's heavy dependencies were imported by the module import, which
+should be none: the message adapter is imported by the first invocation.
+
+Usage:
+
+    python benchmarks/import_time.py [--runs N]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY_MODULES = ('boto3', 'botocore', 'jsonschema', 'jsonpath_ng')
+
+PROBE = '''
+import json, sys, time
+start = time.perf_counter()
+from run_cumulus_task import run_cumulus_task
+imported = time.perf_counter()
+heavy_modules = sorted(m for m in %r if m in sys.modules)
+event = {"cumulus_meta": {"task": "Example"}, "meta": {}, "payload": {"a": 1},
+         "task_config": {"foo": "bar"}}
+run_cumulus_task(lambda event, context: event["input"], event)
+invoked = time.perf_counter()
+print(json.dumps({
+    "import_ms": (imported - start) * 1000,
+    "first_invocation_ms": (invoked - imported) * 1000,
+    "heavy_modules": heavy_modules,
+}))
+''' % (HEAVY_MODULES,)
+
+
+def run_probe():
+    output = subprocess.run(
+        [sys.executable, '-c', PROBE], cwd=ROOT, check=True,
+        capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--runs', type=int, default=10)
+    args = parser.parse_args()
+
+    results = [run_probe() for _ in range(args.runs)]
+    report = {
+        key: {
+            'median': statistics.median(result[key] for result in results),
+            'min': min(result[key] for result in results),
+        }
+        for key in ('import_ms', 'first_invocation_ms')
+    }
+    report['heavy_modules'] = results[-1]['heavy_modules']
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+"""
+Measures ``CumulusLogger`` throughput, in log lines per second, against the
+previous implementation, which JSON-encoded the metadata and formatted the
+timestamp with ``datetime.now().isoformat()`` for every line, and built the
+message even when its level was disabled.  Lines are written to
+``os.devnull``, so formatting is included but not terminal I/O.  Disabled
+debug calls are measured with the logger at the info level.
+
+Usage:
+
+    python benchmarks/logging_throughput.py [--lines N] [--granules N]
+"""
+import argparse
+from collections.abc import Mapping
+from datetime import datetime
+import json
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import cumulus_json  # pylint: disable=wrong-import-position
+from cumulus_logger import (  # pylint: disable=wrong-import-position
+    CumulusLogger, _get_exception_message)
+
+
+class LegacyCumulusLogger(CumulusLogger):
+    """``CumulusLogger`` as it logged before the metadata was pre-encoded
+    and the message was built lazily."""
+
+    def _log(self, level, message, *args, **kwargs):
+        msg = {}
+        if isinstance(message, Mapping):
+            msg.update(message)
+        else:
+            fmt_message = str(message)
+            if args or kwargs:
+                fmt_message = fmt_message.format(*args, **kwargs)
+            ex_message = _get_exception_message(**kwargs)
+            msg["message"] = " ".join(filter(None, [fmt_message, ex_message]))
+        msg.update(self._msg)
+        msg["timestamp"] = datetime.now().isoformat()
+        if level == logging.NOTSET or not isinstance(level, int):
+            level = self._resolve_log_level(msg.get("level", None))
+        msg["level"] = logging.getLevelName(level).lower()
+        self.logger.log(level, json.dumps(msg))
+
+
+class Context:  # pylint: disable=too-few-public-methods
+    function_name = "benchmark"
+    function_version = "1"
+
+
+def make_event(granules):
+    return {
+        "cumulus_meta": {
+            "execution_name": "execution",
+            "asyncOperationId": "async-operation",
+            "parentExecutionArn": "arn:aws:states:us-east-1:1:execution:x:y",
+        },
+        "meta": {"stack": "stack"},
+        "payload": {"granules": [{"granuleId": "granule-%d" % i}
+                                 for i in range(granules)]},
+    }
+
+
+def lines_per_second(logger_class, name, event, lines, method="info"):
+    with open(os.devnull, "w", encoding="utf-8") as devnull:
+        logger = logger_class(name, logging.INFO)
+        logger.logger.handlers[0].setStream(devnull)
+        logger.setMetadata(event, Context())
+        log = getattr(logger, method)
+        start = time.perf_counter()
+        for i in range(lines):
+            log("processed granule {}", i)
+        elapsed = time.perf_counter() - start
+        logger.logger.handlers[0].setStream(sys.stderr)
+    return lines / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n", 1)[0])
+    parser.add_argument("--lines", type=int, default=50000)
+    parser.add_argument("--granules", type=int, default=100)
+    args = parser.parse_args()
+
+    event = make_event(args.granules)
+    print(f"codec: {cumulus_json.codec_name}, granules: {args.granules}")
+    for method in ("info", "debug"):
+        legacy = lines_per_second(
+            LegacyCumulusLogger, "legacy", event, args.lines, method)
+        current = lines_per_second(
+            CumulusLogger, "current", event, args.lines, method)
+        print(f"{method}")
+        print(f"  legacy:  {legacy:12,.0f} calls/s")
+        print(f"  current: {current:12,.0f} calls/s ({current / legacy:.2f}x)")
+
+
+if __name__ == "__main__":
+    main()
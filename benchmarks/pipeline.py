@@ -0,0 +1,326 @@
+"""
+Benchmarks ``run_cumulus_task`` and ``CumulusLogger`` over a grid of
+synthetic Cumulus messages, varying:
+
++ the payload size (``--sizes``, e.g. ``1KB 1MB 200MB``)
++ the number of granules (``--granules``)
++ inline messages, or remote messages stored in S3 (``--shapes``)
++ without or with input, config and output schemas (``--schemas``)
++ a flat task config, or one deeply nested with JSONPath templates
+  (``--templating``)
+
+Messages are configured to be stored in S3 past the Step Functions limit, and
+S3 is replaced by the in-memory ``FakeS3Client`` of ``tests/helpers.py``.  Each case
+reports latency percentiles, throughput, the peak memory allocated by one
+traced invocation, and the log lines per second of a ``CumulusLogger`` with
+the metadata of the message.  ``mb_per_s`` is the rate at which the message
+is read from and written to S3, and is null when it is neither.  Results can be saved as a baseline, and compared
+with it to catch regressions of the adapter hot path:
+
+    python benchmarks/pipeline.py --save-baseline benchmarks/baseline.json
+    python benchmarks/pipeline.py --compare benchmarks/baseline.json
+
+``--compare`` exits with status 1 when the median latency or the peak memory
+of a case is more than ``--tolerance`` (25% by default) above the baseline.  Timings
+depend on the machine, so baselines should be compared on the same one.
+"""
+import argparse
+import contextlib
+import itertools
+import json
+import logging
+import math
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+from unittest import mock
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'tests'))
+
+# pylint: disable=wrong-import-position
+import cumulus_json
+import cumulus_remote
+from cumulus_logger import CumulusLogger
+from helpers import FakeS3Client
+from run_cumulus_task import bootstrap, run_cumulus_task
+
+UNITS = {'KB': 1024, 'MB': 1024 ** 2, 'GB': 1024 ** 3}
+DEFAULT_SIZES = ('1KB', '1MB', '10MB', '200MB')
+DEFAULT_GRANULES = (1, 1000)
+SHAPES = ('inline', 'remote')
+TEMPLATING_DEPTH = 8
+# The Step Functions limit on the size of a message
+MAX_MESSAGE_SIZE = 256 * 1024
+REGRESSION_METRICS = ('p50_ms', 'peak_mb')
+
+INPUT_SCHEMA = {
+    'type': 'object',
+    'required': ['granules'],
+    'properties': {'granules': {'type': 'array', 'items': {
+        'type': 'object', 'required': ['granuleId'],
+        'properties': {'granuleId': {'type': 'string'},
+                       'files': {'type': 'array'}}}}},
+}
+CONFIG_SCHEMA = {'type': 'object'}
+OUTPUT_SCHEMA = INPUT_SCHEMA
+
+
+def parse_size(size):
+    """Returns the number of bytes of e.g. ``"200MB"``.
+
+    >>> parse_size('1KB'), parse_size('2MB'), parse_size('512')
+    (1024, 2097152, 512)
+    """
+    for unit, factor in UNITS.items():
+        if size.upper().endswith(unit):
+            return int(float(size[:-len(unit)]) * factor)
+    return int(size)
+
+
+def percentile(values, fraction):
+    """Returns the nearest-rank percentile of ``values``.
+
+    >>> percentile([4, 1, 3, 2], 0.5), percentile([4, 1, 3, 2], 0.99)
+    (2, 4)
+    """
+    ordered = sorted(values)
+    return ordered[max(math.ceil(fraction * len(ordered)) - 1, 0)]
+
+
+def make_granule(index):
+    return {
+        'granuleId': f'granule-{index:08d}',
+        'files': [{'bucket': 'protected', 'key': f'data/granule-{index:08d}.h5',
+                   'size': 1024 * index}],
+    }
+
+
+def make_task_config(templating):
+    if not templating:
+        return {'provider': 'provider', 'collection': 'collection'}
+    config = {'bucket': '{$.meta.buckets.protected.name}'}
+    for depth in range(TEMPLATING_DEPTH):
+        config = {
+            f'level{depth}': config,
+            'provider': '{$.meta.provider.id}',
+            'collection': '{$.meta.collection.name}',
+            'static': [depth, 'value'],
+        }
+    return config
+
+
+def make_message(size, granules, templating):
+    """Returns an inline Cumulus message whose payload is about ``size``
+    bytes, or larger if its granules alone are."""
+    payload = {'granules': [make_granule(i) for i in range(granules)]}
+    remaining = size - len(cumulus_json.dumpb(payload))
+    if remaining > 0:
+        chunk = 'x' * min(remaining, 64 * 1024)
+        payload['filler'] = [chunk] * (remaining // len(chunk) or 1)
+    return {
+        'cumulus_meta': {
+            'execution_name': 'benchmark', 'state_machine': 'arn:sm',
+            'system_bucket': 'benchmark',
+            'parentExecutionArn': 'arn:parent', 'asyncOperationId': 'operation',
+        },
+        'meta': {
+            'stack': 'benchmark',
+            'buckets': {'protected': {'name': 'protected'}},
+            'provider': {'id': 'provider'},
+            'collection': {'name': 'collection'},
+        },
+        'task_config': make_task_config(templating),
+        'ReplaceConfig': {'FullMessage': True, 'MaxSize': MAX_MESSAGE_SIZE},
+        'payload': payload,
+    }
+
+
+def store_remote_message(s3, message):
+    s3.put_object(Bucket='benchmark', Key='events/remote',
+                  Body=cumulus_json.dumpb(message))
+
+
+def remote_message(message):
+    return {'cma': {'event': {
+        'cumulus_meta': message['cumulus_meta'],
+        'replace': {'Bucket': 'benchmark', 'Key': 'events/remote',
+                    'TargetPath': '$'},
+    }}}
+
+
+def write_schemas(task_root):
+    os.makedirs(os.path.join(task_root, 'schemas'), exist_ok=True)
+    for schema_type, schema in (('input', INPUT_SCHEMA),
+                                ('config', CONFIG_SCHEMA),
+                                ('output', OUTPUT_SCHEMA)):
+        with open(os.path.join(task_root, 'schemas', f'{schema_type}.json'),
+                  'w', encoding='utf-8') as schema_file:
+            json.dump(schema, schema_file)
+
+
+def task(event, context):  # pylint: disable=unused-argument
+    return event['input']
+
+
+class Context:  # pylint: disable=too-few-public-methods
+    function_name = 'benchmark'
+    function_version = '1'
+
+
+def measure_logging(message, lines=2000):
+    with open(os.devnull, 'w', encoding='utf-8') as devnull:
+        logger = CumulusLogger('benchmark', logging.INFO)
+        logger.logger.handlers[0].setStream(devnull)
+        logger.setMetadata(message, Context())
+        start = time.perf_counter()
+        for i in range(lines):
+            logger.info('processed granule {}', i)
+        elapsed = time.perf_counter() - start
+        logger.logger.handlers[0].setStream(sys.stderr)
+    return lines / elapsed
+
+
+def run_case(case, task_roots, min_runs, max_runs, budget):
+    size, granules, shape, schemas, templating = case
+    message = make_message(size, granules, templating == 'on')
+    s3 = FakeS3Client()
+    if shape == 'remote':
+        store_remote_message(s3, message)
+    # Outgoing messages are only measured, so that the memory they would take
+    # in S3 is not part of the peak
+    s3.keep_data = False
+    os.environ['LAMBDA_TASK_ROOT'] = task_roots[schemas]
+    bootstrap(refresh=True)
+    # The bytes read from and written to S3 by an invocation
+    transferred = []
+
+    def invoke():
+        event = remote_message(message) if shape == 'remote' else message
+        result = run_cumulus_task(task, event, Context())
+        stored = 0
+        if 'replace' in result:
+            stored = s3.sizes[(result['replace']['Bucket'], result['replace']['Key'])]
+            s3.delete_object(Bucket=result['replace']['Bucket'],
+                             Key=result['replace']['Key'])
+        read = s3.sizes[('benchmark', 'events/remote')] if shape == 'remote' else 0
+        transferred.append(read + stored)
+
+    with mock.patch.object(cumulus_remote, 's3_client', lambda: s3):
+        invoke()  # warm up caches and lazy imports
+        latencies = []
+        started = time.perf_counter()
+        while len(latencies) < max_runs and (
+                len(latencies) < min_runs or time.perf_counter() - started < budget):
+            start = time.perf_counter()
+            invoke()
+            latencies.append((time.perf_counter() - start) * 1000)
+
+        tracemalloc.start()
+        invoke()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    message_bytes = len(cumulus_json.dumpb(message))
+    median = percentile(latencies, 0.5)
+    return {
+        'runs': len(latencies),
+        'message_mb': round(message_bytes / UNITS['MB'], 3),
+        'p50_ms': round(median, 3),
+        'p90_ms': round(percentile(latencies, 0.9), 3),
+        'p99_ms': round(percentile(latencies, 0.99), 3),
+        'invocations_per_s': round(1000 / median, 1),
+        'mb_per_s': (round(transferred[-1] / UNITS['MB'] / (median / 1000), 1)
+                     if transferred[-1] else None),
+        'peak_mb': round(peak / UNITS['MB'], 3),
+        'log_lines_per_s': round(measure_logging(message)),
+    }
+
+
+def case_name(case):
+    size, granules, shape, schemas, templating = case
+    return (f'{size}-granules:{granules}-{shape}-schemas:{schemas}'
+            f'-templating:{templating}')
+
+
+def compare(results, baseline, tolerance):
+    """Returns the descriptions of the regressions of ``results`` relative
+    to ``baseline``: the metrics more than ``tolerance`` (a fraction of the
+    baseline) above it.
+
+    >>> compare({'a': {'p50_ms': 1.3, 'peak_mb': 1.0}},
+    ...         {'cases': {'a': {'p50_ms': 1.0, 'peak_mb': 1.0}}}, 0.25)
+    ['a: p50_ms 1.3 > 1.0 (+30%)']
+    """
+    regressions = []
+    for name, result in results.items():
+        reference = baseline['cases'].get(name)
+        if reference is None:
+            continue
+        for metric in REGRESSION_METRICS:
+            if result[metric] > reference[metric] * (1 + tolerance):
+                regressions.append(
+                    f'{name}: {metric} {result[metric]} > {reference[metric]} '
+                    f'(+{(result[metric] / reference[metric] - 1) * 100:.0f}%)')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n', 1)[0])
+    parser.add_argument('--sizes', nargs='+', default=DEFAULT_SIZES)
+    parser.add_argument('--granules', nargs='+', type=int, default=DEFAULT_GRANULES)
+    parser.add_argument('--shapes', nargs='+', choices=SHAPES, default=SHAPES)
+    parser.add_argument('--schemas', nargs='+', choices=('off', 'on'),
+                        default=('off', 'on'))
+    parser.add_argument('--templating', nargs='+', choices=('off', 'on'),
+                        default=('off', 'on'))
+    parser.add_argument('--min-runs', type=int, default=3)
+    parser.add_argument('--max-runs', type=int, default=50)
+    parser.add_argument('--budget', type=float, default=1.0,
+                        help='seconds spent timing each case, beyond --min-runs')
+    parser.add_argument('--save-baseline', metavar='PATH')
+    parser.add_argument('--compare', metavar='PATH')
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    args = parser.parse_args()
+
+    # The message adapter writes to stderr while resolving templates
+    devnull = open(os.devnull, 'w', encoding='utf-8')  # pylint: disable=consider-using-with
+    with tempfile.TemporaryDirectory() as with_schemas, \
+            tempfile.TemporaryDirectory() as without_schemas:
+        write_schemas(with_schemas)
+        task_roots = {'on': with_schemas, 'off': without_schemas}
+        results = {}
+        for size, granules, shape, schemas, templating in itertools.product(
+                args.sizes, args.granules, args.shapes, args.schemas,
+                args.templating):
+            case = (parse_size(size), granules, shape, schemas, templating)
+            name = case_name((size,) + case[1:])
+            with contextlib.redirect_stderr(devnull):
+                results[name] = run_case(
+                    case, task_roots, args.min_runs, args.max_runs, args.budget)
+            print(name, json.dumps(results[name]), flush=True)
+
+    report = {
+        'python': platform.python_version(),
+        'codec': cumulus_json.codec_name,
+        'cases': results,
+    }
+    if args.save_baseline:
+        with open(args.save_baseline, 'w', encoding='utf-8') as baseline_file:
+            json.dump(report, baseline_file, indent=2, sort_keys=True)
+            baseline_file.write('\n')
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.tolerance)
+        for regression in regressions:
+            print('REGRESSION', regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
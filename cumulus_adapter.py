@@ -0,0 +1,778 @@
+"""
+Message adapter used by ``run_cumulus_task``: a subclass of the deployed
+``message_adapter.message_adapter.MessageAdapter`` that avoids copying,
+templating and validating the message from scratch on every invocation.
+Adapters are cached for the life of the process, so that warm Lambda
+invocations reuse the schema files and validators prepared by earlier
+invocations.
+
+This module imports ``message_adapter``, so it must only be imported once the
+message adapter is on ``sys.path`` (see ``run_cumulus_task.bootstrap``).
+"""
+from collections import OrderedDict
+from collections.abc import ItemsView, ValuesView
+from copy import copy, deepcopy
+import functools
+import hashlib
+import json
+import os
+import re
+import threading
+
+import cumulus_json
+from cumulus_schema import compile_schema, validation_engine
+from cumulus_remote import (
+    load_remote_event, store_remote_response)
+from cumulus_streaming import (
+    LazyObject, LazyView, SpooledArray, has_streams, is_stream, materialize,
+    parse_lazy_objects, unwrap_lazy_views)
+from message_adapter.message_adapter import MessageAdapter
+from message_adapter.util import assign_json_path_value
+
+SCHEMA_TYPES = ('input', 'config', 'output')
+# Keywords about the length or contents of an array as a whole, which are not
+# checked for arrays streamed item by item
+ARRAY_KEYWORDS = frozenset(
+    ('minItems', 'maxItems', 'uniqueItems', 'contains', 'minContains', 'maxContains'))
+# JSONPath made only of field names, e.g. ``$.meta.collection``
+SIMPLE_JSON_PATH = re.compile(r'^\$((\.[a-zA-Z_@][a-zA-Z0-9_@\-]*)*)$')
+# Words the JSONPath lexer reserves, which are not parsed as field names
+JSON_PATH_RESERVED_WORDS = frozenset(('where', 'wherenot'))
+# The three flavors of templates of ``resolve_path_str``
+VALUE_TEMPLATE = re.compile(r"^{[^\[\]].*}$")
+ARRAY_TEMPLATE = re.compile(r"^{\[.*\]}$")
+STRING_TEMPLATE = re.compile('{[^}]+}')
+TEMPLATE_CACHE_SIZE = 1024
+CONFIG_PLAN_CACHE_SIZE = 256
+# Number of adapters kept, the least recently used being discarded
+ADAPTER_CACHE_SIZE = 16
+# Number of valid configs remembered by each schema set
+VALIDATION_CACHE_SIZE = 128
+
+_adapters = OrderedDict()
+_adapters_lock = threading.Lock()
+_config_plans = OrderedDict()
+_config_plans_lock = threading.Lock()
+_MISSING = object()
+
+
+def _resolve_schema_path(schemas, schema_type, task_root=None):
+    """Returns the schema filepath the message adapter would use for
+    ``schema_type``, or None if there is no such file.
+
+    Mirrors the lookup done by ``MessageAdapter``: a path given in ``schemas``
+    (or ``schemas/<schema_type>.json`` by default) relative to the task root,
+    which defaults to the ``LAMBDA_TASK_ROOT`` directory.
+    """
+    if task_root is None:
+        task_root = os.environ.get('LAMBDA_TASK_ROOT', '')
+    has_schema = schemas and schemas.get(schema_type)
+    rel_filepath = (
+        schemas.get(schema_type) if has_schema else f'schemas/{schema_type}.json'
+    )
+    filepath = os.path.join(task_root, rel_filepath)
+    return filepath if os.path.exists(filepath) else None
+
+
+def _cache_key(schemas, task_root=None):
+    """Returns a hashable key made of the resolved schema paths and mtimes."""
+    key = []
+    for schema_type in SCHEMA_TYPES:
+        filepath = _resolve_schema_path(schemas, schema_type, task_root)
+        mtime = os.stat(filepath).st_mtime_ns if filepath else None
+        key.append((schema_type, filepath, mtime))
+    return tuple(key)
+
+
+def _compile_json_path(json_path):
+    """Returns the function that finds the values matching ``json_path`` in
+    a message, as ``jsonpath_ng`` does.  Paths made only of field names are
+    looked up directly, without going through jsonpath."""
+    keys = _simple_path_keys(json_path)
+    if keys is None or JSON_PATH_RESERVED_WORDS.intersection(keys):
+        from jsonpath_ng import parse
+        parsed_json_path = parse(json_path)
+        return lambda event: [match.value for match in parsed_json_path.find(event)]
+
+    def find(event):
+        value = event
+        for key in keys:
+            try:
+                value = value.get(key, _MISSING)
+            except (TypeError, AttributeError):
+                return []
+            if value is _MISSING:
+                return []
+        return [value]
+    return find
+
+
+@functools.lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def _compile_template(json_path_string):
+    """Returns the function resolving the JSONPath template
+    ``json_path_string`` in a message, equivalent to
+    ``message_adapter.cumulus_message.resolve_path_str``, with its JSONPath
+    expressions parsed once.
+
+    >>> _compile_template('{$.meta.name}')({'meta': {'name': 'x'}})
+    'x'
+    >>> _compile_template('{[$.meta.name]}')({'meta': {}})
+    []
+    >>> _compile_template('s3://{$.bucket}/{$.key}')({'bucket': 'b'})
+    's3://b/{$.key}'
+    """
+    if VALUE_TEMPLATE.search(json_path_string):
+        find = _compile_json_path(json_path_string.lstrip('{').rstrip('}'))
+
+        def resolve_value(event):
+            match_data = find(event)
+            return match_data[0] if match_data else None
+        return resolve_value
+
+    if ARRAY_TEMPLATE.search(json_path_string):
+        return _compile_json_path(
+            json_path_string.lstrip('{').rstrip('}').lstrip('[').rstrip(']'))
+
+    finders = [(match, _compile_json_path(match.lstrip('{').rstrip('}')))
+               for match in STRING_TEMPLATE.findall(json_path_string)]
+
+    def resolve_string(event):
+        result = json_path_string
+        for match, find in finders:
+            match_data = find(event)
+            if match_data:
+                result = result.replace(match, match_data[0])
+        return result
+    return resolve_string
+
+
+def _resolve_path_str(event, json_path_string):
+    """Resolves a JSONPath template the way the message adapter does, without
+    matching strings that cannot contain a template against its patterns."""
+    if '{' not in json_path_string:
+        return json_path_string
+    return _compile_template(json_path_string)(event)
+
+
+def _compile_config(config):
+    """Returns the function resolving the templates of a task config shaped
+    as ``config`` (see ``_resolve_config_object``), or None if it holds no
+    template.  Parts without templates are not copied."""
+    if isinstance(config, str):
+        if '{' not in config:
+            return None
+        template = _compile_template(config)
+        return lambda event, value: template(event)
+
+    if isinstance(config, list):
+        plans = [(index, plan) for index, plan in enumerate(map(_compile_config, config))
+                 if plan is not None]
+        if not plans:
+            return None
+
+        def resolve_list(event, value):
+            for index, plan in plans:
+                value[index] = plan(event, value[index])
+            return value
+        return resolve_list
+
+    if isinstance(config, dict):
+        plans = [(key, plan) for key, plan in zip(config, map(_compile_config, config.values()))
+                 if plan is not None]
+        if not plans:
+            return None
+
+        def resolve_dict(event, value):
+            result = dict(value)
+            for key, plan in plans:
+                result[key] = plan(event, value[key])
+            return result
+        return resolve_dict
+
+    return None
+
+
+def _config_plan(event, config):
+    """Returns the compiled ``_compile_config`` plan of ``config``, cached by
+    ``cumulus_meta.task`` and a hash of ``config``, which must not hold
+    lazily parsed objects (see ``parse_lazy_objects``)."""
+    try:
+        digest = hashlib.blake2b(cumulus_json.dumpb_compact(config), digest_size=16).digest()
+    except (TypeError, ValueError):  # Not JSON serializable
+        return _compile_config(config)
+    cumulus_meta = event.get('cumulus_meta')
+    key = (cumulus_meta.get('task') if isinstance(cumulus_meta, dict) else None, digest)
+    with _config_plans_lock:
+        if key in _config_plans:
+            _config_plans.move_to_end(key)
+            return _config_plans[key]
+    plan = _compile_config(config)
+    with _config_plans_lock:
+        _config_plans[key] = plan
+        while len(_config_plans) > CONFIG_PLAN_CACHE_SIZE:
+            _config_plans.popitem(last=False)
+    return plan
+
+
+def _resolve_config_object(event, config):
+    """Equivalent of ``message_adapter.cumulus_message._resolve_config_object``,
+    including its in-place update of lists, running a plan compiled once per
+    task config (see ``_config_plan``)."""
+    # Hashed as JSON, which encoders would read as empty from lazy objects
+    config = parse_lazy_objects(config)
+    plan = _config_plan(event, config)
+    return config if plan is None else plan(event, config)
+
+
+def _simple_path_keys(json_path):
+    """Returns the keys of a JSONPath made only of field names, or None.
+
+    >>> _simple_path_keys('$.meta.output_granules'), _simple_path_keys('$')
+    (['meta', 'output_granules'], [])
+    >>> _simple_path_keys('$.granules[0]') is None
+    True
+    """
+    match = SIMPLE_JSON_PATH.match(json_path)
+    if match is None:
+        return None
+    return match.group(1).split('.')[1:]
+
+
+def _copy_path(message, keys):
+    """Replaces the dicts along ``keys`` in ``message`` (which the caller
+    owns) by shallow copies, so that they can be updated without affecting
+    the messages they are shared with.  Returns the innermost dict, or None
+    if the path does not lead through dicts."""
+    current = message
+    for key in keys:
+        child = current.get(key)
+        if not isinstance(child, dict):
+            return None
+        current[key] = current = copy(child)
+    return current
+
+
+def _assign_json_path_value(message, json_path, value):
+    """Equivalent of ``message_adapter.util.assign_json_path_value``, which
+    updates ``message`` (which the caller owns) rather than a deep copy, and
+    only copies the dicts along simple paths.  Other paths, including the
+    root path ``$``, are assigned by the message adapter."""
+    keys = _simple_path_keys(json_path)
+    if not keys or _copy_path(message, keys[:-1]) is None:
+        return assign_json_path_value(message, json_path, value)
+    current = message
+    for key in keys[:-1]:
+        current = current[key]
+    current[keys[-1]] = value
+    return message
+
+
+def _view(value):
+    if isinstance(value, LazyObject):
+        # Members not parsed yet are parsed when the task accesses them
+        return _DictView(value) if value.parsed else LazyView(value, _view)
+    if type(value) is dict:  # pylint: disable=unidiomatic-typecheck
+        return _DictView(value)
+    if type(value) is list:  # pylint: disable=unidiomatic-typecheck
+        return _ListView(value)
+    return value
+
+
+class _DictView(dict):
+    """Dict given to a task in place of a dict of the Cumulus message, so that
+    the task may update it without affecting the message.
+
+    The view is a shallow copy, and the dicts and lists it holds are only
+    replaced by views in turn when the task reaches them, so a task only
+    copies the parts of its input it actually visits, one level at a time.
+    """
+    __slots__ = ()
+
+    def __getitem__(self, key):
+        value = dict.__getitem__(self, key)
+        view = _view(value)
+        if view is not value:
+            dict.__setitem__(self, key, view)
+        return view
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            dict.__setitem__(self, key, default)
+        return self[key]
+
+    def pop(self, key, *default):
+        return _view(dict.pop(self, key, *default))
+
+    def popitem(self):
+        key, value = dict.popitem(self)
+        return key, _view(value)
+
+    def __iter__(self):
+        # Overridden so that dict(view) and {**view} read the values through
+        # __getitem__, rather than copying the dicts of the message
+        return dict.__iter__(self)
+
+    def values(self):
+        return ValuesView(self)
+
+    def items(self):
+        return ItemsView(self)
+
+    def copy(self):
+        return _DictView(self)
+
+    def __or__(self, other):
+        merged = dict.__or__(self, other)
+        return merged if merged is NotImplemented else _DictView(merged)
+
+    def __ror__(self, other):
+        if not isinstance(other, dict):
+            return NotImplemented
+        return _DictView(dict.__or__(other, self))
+
+
+class _ListView(list):
+    """List counterpart of ``_DictView``."""
+    __slots__ = ()
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return _ListView(list.__getitem__(self, index))
+        value = list.__getitem__(self, index)
+        view = _view(value)
+        if view is not value:
+            list.__setitem__(self, index, view)
+        return view
+
+    def __iter__(self):
+        index = 0
+        while index < len(self):
+            yield self[index]
+            index += 1
+
+    def __reversed__(self):
+        index = len(self) - 1
+        while index >= 0:
+            if index < len(self):
+                yield self[index]
+            index -= 1
+
+    def pop(self, index=-1):
+        return _view(list.pop(self, index))
+
+    def copy(self):
+        return _ListView(list.__getitem__(self, slice(None)))
+
+    # Concatenations and repetitions hold the items of the view, like slices
+
+    def __add__(self, other):
+        items = list.__add__(self, other)
+        return items if items is NotImplemented else _ListView(items)
+
+    def __radd__(self, other):
+        if not isinstance(other, list):
+            return NotImplemented
+        return _ListView(list.__add__(other, self))
+
+    def __mul__(self, count):
+        items = list.__mul__(self, count)
+        return items if items is NotImplemented else _ListView(items)
+
+    __rmul__ = __mul__
+
+
+class SchemaSet:
+    """The parsed input, config and output schemas of a task, along with
+    their compiled validators.
+
+    Schema files are read when the set is created.  Validators are compiled
+    on first use, so that an invalid schema is reported at validation time,
+    as ``jsonschema.validate`` would.
+
+    With the compiled validation engine (see ``cumulus_schema``), documents
+    are first checked by the functions compiled from the schemas, and only
+    those they reject are validated by jsonschema, to report the same
+    errors.  The hashes of the last ``VALIDATION_CACHE_SIZE`` valid configs,
+    which rarely change across invocations, are also remembered.
+    """
+
+    def __init__(self, paths):
+        self.paths = dict(paths)
+        self.schemas = {}
+        self._validators = {}
+        self._compiled = {}
+        self._valid_configs = OrderedDict()
+        self._lock = threading.Lock()
+        for schema_type, filepath in self.paths.items():
+            if filepath:
+                with open(filepath, encoding='utf-8') as schema_handle:
+                    self.schemas[schema_type] = json.load(schema_handle)
+
+    def has_schema(self, schema_type):
+        """Returns whether documents are validated against a
+        ``schema_type`` schema."""
+        return schema_type in self.schemas
+
+    def _validator(self, schema_type):
+        validator = self._validators.get(schema_type)
+        if validator is None:
+            from jsonschema import validators
+            schema = self.schemas[schema_type]
+            cls = validators.validator_for(schema)
+            cls.check_schema(schema)
+            validator = self._validators[schema_type] = cls(schema)
+        return validator
+
+    def _compiled_validator(self, schema_type, sample_items):
+        key = (schema_type, sample_items)
+        if key not in self._compiled:
+            validator = self._validator(schema_type)
+            self._compiled[key] = compile_schema(
+                self.schemas[schema_type], type(validator), sample_items)
+        return self._compiled[key]
+
+    def _config_digest(self, document):
+        # Templates may have copied lazily parsed objects of the message into
+        # the config, which JSON encoders would read as empty
+        document = parse_lazy_objects(document)
+        try:
+            return hashlib.blake2b(cumulus_json.dumpb_compact(document),
+                                   digest_size=16).digest()
+        except (TypeError, ValueError):  # Not JSON serializable
+            return None
+
+    def validate(self, document, schema_type, streamed=(), item=None):
+        """Validates ``document`` against the ``schema_type`` schema, if any.
+
+        ``streamed`` holds the paths (tuples of keys) of arrays whose items
+        are streamed by the task, which ``document`` holds empty: errors
+        about those arrays as a whole (see ``ARRAY_KEYWORDS``) are ignored.
+        ``item``, a path and an index, validates a single streamed item, held
+        by ``document`` in a one item array at that path: only the errors of
+        the item are reported.
+
+        Raises the same errors as ``jsonschema.validate``.
+        """
+        if schema_type not in self.schemas:
+            return
+        engine, sample_items = validation_engine()
+        digest = None
+        if engine == 'compiled':
+            if schema_type == 'config':
+                digest = self._config_digest(document)
+                with self._lock:
+                    if digest is not None and digest in self._valid_configs:
+                        self._valid_configs.move_to_end(digest)
+                        return
+            is_valid = self._compiled_validator(schema_type, sample_items)
+            if is_valid is not None and is_valid(document):
+                self._remember_config(digest)
+                return
+        self._validate(document, schema_type, streamed, item)
+        self._remember_config(digest)
+
+    def _remember_config(self, digest):
+        if digest is None:
+            return
+        with self._lock:
+            self._valid_configs[digest] = True
+            while len(self._valid_configs) > VALIDATION_CACHE_SIZE:
+                self._valid_configs.popitem(last=False)
+
+    def _validate(self, document, schema_type, streamed, item):
+        from jsonschema.exceptions import best_match
+        errors = self._validator(schema_type).iter_errors(document)
+        if streamed:
+            errors = (error for error in errors
+                      if tuple(error.path) not in streamed
+                      or error.validator not in ARRAY_KEYWORDS)
+        if item is not None:
+            path, index = item
+            prefix = path + (0,)
+            errors = (error for error in errors
+                      if tuple(error.path)[:len(prefix)] == prefix)
+        error = best_match(errors)
+        if error is not None:
+            if item is not None:
+                error.path[len(path)] = index
+            raise error
+
+
+class CumulusMessageAdapter(MessageAdapter):
+    """
+    A ``MessageAdapter`` that validates against a pre-loaded ``SchemaSet``
+    instead of finding, reading and parsing the schema files on every call,
+    and that shares the parts of the incoming message that are not updated
+    with the task and the outgoing message, rather than deep copying them.
+
+    Only the steps that copy, template or store the message are overridden;
+    the rest is delegated to the deployed message adapter.
+    """
+
+    def __init__(self, schemas=None, schema_set=None):
+        super().__init__(schemas)
+        self.schema_set = schema_set or SchemaSet({})
+
+    def _validate_json(self, document, schema_type, **kwargs):
+        try:
+            self.schema_set.validate(document, schema_type, **kwargs)
+        except Exception as exception:
+            exception.message = f'{schema_type} schema: {str(exception)}'
+            raise exception
+
+    # MessageAdapter calls its private methods, so the mangled names have to
+    # be overridden for these versions to be used.
+    _MessageAdapter__validate_json = _validate_json
+
+    @staticmethod
+    def _load_remote_event(event):
+        if 'replace' in event:
+            return load_remote_event(deepcopy(event))
+        return copy(event)
+
+    def load_and_update_remote_event(self, incoming_event, context):
+        """
+        Returns the full Cumulus message for ``incoming_event``, fetching any
+        part of it that is stored remotely in S3, and records the task in
+        ``meta.workflow_tasks``.  See
+        ``MessageAdapter.load_and_update_remote_event``.
+
+        Rather than a deep copy of ``incoming_event``, the returned message
+        shares the parts of it that are never updated (such as the payload),
+        so that large messages are not duplicated.  Remote messages, which
+        are small until loaded, and ``task_config``, whose lists are
+        updated by templating, are still copied.
+        """
+        if incoming_event.get('cma'):
+            cma = dict(incoming_event['cma'])
+            cma['event'] = self._load_remote_event(cma.get('event'))
+            event = self._MessageAdapter__parse_parameter_configuration({'cma': cma})
+        else:
+            event = self._load_remote_event(incoming_event)
+
+        if 'task_config' in event:
+            event['task_config'] = deepcopy(event['task_config'])
+
+        if context and 'meta' in event:
+            # The message adapter records the task in a copy of the part of
+            # meta it updates
+            meta = event['meta']
+            tracked = {'meta': {'workflow_tasks': meta['workflow_tasks']}
+                                if 'workflow_tasks' in meta else {}}
+            tracked = super().load_and_update_remote_event(tracked, context)
+            event['meta'] = copy(meta)
+            event['meta']['workflow_tasks'] = tracked['meta']['workflow_tasks']
+        return event
+
+    def load_nested_event(self, event):
+        """
+        Interprets a full Cumulus message as the event passed to a task, with
+        ``input`` and templated ``config`` resolved and validated.  See
+        ``MessageAdapter.load_nested_event``.
+
+        ``input`` and ``config`` are views over ``event`` (see
+        ``_DictView``), so the task may update them without copying the
+        message up front.  The lazily parsed objects of the message they hold
+        (see ``cumulus_streaming.LazyObject``) are given to the task as
+        read-only ``LazyView``\ s, whose members are parsed as the task
+        accesses them, unless a schema validates them, which reads them
+        entirely.
+        """
+        config = event.get('task_config', {})
+        task_config = config.copy()
+        task_config.pop('cumulus_message', None)
+        final_config = _resolve_config_object(event, task_config)
+
+        if 'cumulus_message' in config and 'input' in config['cumulus_message']:
+            final_payload = _resolve_path_str(event, config['cumulus_message']['input'])
+        else:
+            final_payload = event.get('payload')
+
+        if self.schema_set.has_schema('input'):
+            final_payload = parse_lazy_objects(final_payload)
+        if self.schema_set.has_schema('config'):
+            final_config = parse_lazy_objects(final_config)
+        response = {'input': _view(final_payload)}
+        self._validate_json(final_payload, 'input')
+        if final_config:
+            self._validate_json(final_config, 'config')
+            response['config'] = _view(final_config)
+        else:
+            response['config'] = {}
+        if 'cumulus_message' in config:
+            response['messageConfig'] = config['cumulus_message']
+
+        # add cumulus_config property, only selective attributes from event.cumulus_meta are added
+        if 'cumulus_meta' in event:
+            response['cumulus_config'] = {}
+            # add both attributes or none of them
+            attributes = ['state_machine', 'execution_name']
+            if all(attribute in event['cumulus_meta'] for attribute in attributes):
+                for attribute in attributes:
+                    response['cumulus_config'][attribute] = event['cumulus_meta'][attribute]
+
+            if 'cumulus_context' in event['cumulus_meta']:
+                cumulus_context = event['cumulus_meta']['cumulus_context']
+                response['cumulus_config']['cumulus_context'] = cumulus_context
+
+            if not response['cumulus_config']:
+                del response['cumulus_config']
+
+        return response
+
+    @staticmethod
+    def _MessageAdapter__assign_outputs(handler_response, event, message_config):
+        # A shallow copy, whose nested dicts are copied only where outputs
+        # are assigned
+        result = copy(event)
+        if message_config is not None and 'outputs' in message_config:
+            result['payload'] = {}
+            for output in message_config['outputs']:
+                dest_json_path = output['destination'].lstrip('{').rstrip('}')
+                value = _resolve_path_str(handler_response, output['source'])
+                result = _assign_json_path_value(result, dest_json_path, value)
+        else:
+            result['payload'] = handler_response
+
+        return result
+
+    def _item_validator(self, skeleton, path):
+        """Returns the function validating the items streamed at ``path`` of
+        the response, whose other values are those of ``skeleton``, or None
+        if there is no output schema."""
+        if 'output' not in self.schema_set.schemas:
+            return None
+
+        def validate(item, index):
+            if path:
+                document = dict(skeleton)
+                document[path[0]] = [item]
+            else:
+                document = [item]
+            self._validate_json(document, 'output', item=(path, index))
+        return validate
+
+    def _spool_response(self, handler_response):
+        """
+        Consumes the iterators returned by the task (see
+        ``cumulus_streaming``) into ``SpooledArray``s, validating the rest of
+        the response, then each item, against the output schema.  Returns the
+        response holding the arrays.
+        """
+        if is_stream(handler_response):
+            streams = {(): handler_response}
+            skeleton = []
+        else:
+            streams = {(key,): value for key, value in handler_response.items()
+                       if is_stream(value)}
+            skeleton = {key: [] if (key,) in streams else value
+                        for key, value in handler_response.items()}
+        self._validate_json(skeleton, 'output', streamed=set(streams))
+
+        arrays = {}
+        try:
+            for path, items in streams.items():
+                arrays[path] = SpooledArray(items, self._item_validator(skeleton, path))
+        except BaseException:
+            for array in arrays.values():
+                array.close()
+            raise
+        if () in arrays:
+            return arrays[()]
+        return {key: arrays.get((key,), value) for key, value in handler_response.items()}
+
+    def create_next_event(self, handler_response, event, message_config):
+        """
+        Creates the outgoing Cumulus message from the task's response, storing
+        part of it in S3 when configured to and it is too large.  See
+        ``MessageAdapter.create_next_event``.
+
+        The response may also be an iterator, or a dict holding iterators,
+        whose items are streamed into the outgoing message (see
+        ``cumulus_streaming``).
+        """
+        # The parts of its input the task returns are output as lazy objects
+        handler_response = unwrap_lazy_views(handler_response)
+        if not has_streams(handler_response):
+            self._validate_json(handler_response, 'output')
+            return self._create_next_event(handler_response, event, message_config)
+
+        handler_response = self._spool_response(handler_response)
+        arrays = [handler_response] if isinstance(handler_response, SpooledArray) else [
+            value for value in handler_response.values() if isinstance(value, SpooledArray)]
+        try:
+            if message_config is not None and 'outputs' in message_config:
+                handler_response = materialize(handler_response)
+            result = self._create_next_event(handler_response, event, message_config)
+            if 'payload' in result:
+                result['payload'] = materialize(result['payload'])
+            return result
+        finally:
+            for array in arrays:
+                array.close()
+
+    def _create_next_event(self, handler_response, event, message_config):
+        result = self._MessageAdapter__assign_outputs(handler_response, event, message_config)
+        if not result.get('exception'):
+            result['exception'] = 'None'
+        if 'replace' in result:
+            del result['replace']
+        return self.store_response(result)
+
+    def store_response(self, result):
+        """
+        Stores part of the outgoing message ``result`` in S3 per its
+        ``ReplaceConfig``, when it is too large, and returns the message to
+        return to Step Functions.  ``result`` is updated, but the parts of it
+        that are cleared once stored are copied first, since they may be
+        shared with the incoming message.
+        """
+        if result.get('ReplaceConfig'):
+            # Storing the message clears the stored part, which may be shared
+            replace_config = result['ReplaceConfig'] = copy(result['ReplaceConfig'])
+            path = '$' if replace_config.get('FullMessage', False) else replace_config.get('Path')
+            keys = _simple_path_keys(path) if isinstance(path, str) else None
+            parent = None if keys is None else _copy_path(result, keys[:-1])
+            if parent is None:
+                if 'payload' in result:
+                    result['payload'] = materialize(result['payload'])
+                result = deepcopy(result)
+            elif keys and isinstance(parent.get(keys[-1]), (dict, list)):
+                parent[keys[-1]] = copy(parent[keys[-1]])
+        result = store_remote_response(
+            result, self.REMOTE_DEFAULT_MAX_SIZE, self.CMA_CONFIG_KEYS)
+        # Parts of a lazily parsed remote event that were neither accessed
+        # nor stored in S3 are returned to Lambda
+        return parse_lazy_objects(result)
+
+
+def get_adapter(schemas=None, task_root=None):
+    """Returns the cached adapter for ``schemas``, creating it if needed.
+
+    Adapters are keyed by the resolved schema filepaths and their mtimes, so
+    editing or replacing a schema file results in a fresh adapter.  The last
+    ``ADAPTER_CACHE_SIZE`` adapters used are kept.
+    """
+    key = _cache_key(schemas, task_root)
+    with _adapters_lock:
+        adapter = _adapters.get(key)
+        if adapter is not None:
+            _adapters.move_to_end(key)
+            return adapter
+        schema_set = SchemaSet((schema_type, filepath) for schema_type, filepath, _ in key)
+        adapter = _adapters[key] = CumulusMessageAdapter(schemas, schema_set)
+        while len(_adapters) > ADAPTER_CACHE_SIZE:
+            _adapters.popitem(last=False)
+    return adapter
+
+
+def clear_cache():
+    """Discards all cached adapters and compiled templates."""
+    with _adapters_lock:
+        _adapters.clear()
+    with _config_plans_lock:
+        _config_plans.clear()
+    _compile_template.cache_clear()
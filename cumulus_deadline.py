@@ -0,0 +1,75 @@
+"""
+Cooperative deadline of a task invocation, so that a task processing many
+granules can stop before the Lambda timeout and resume in the next attempt.
+
+``run_cumulus_task`` passes a ``Deadline`` to task functions that take a
+``deadline`` argument.  When ``deadline.expired``, the task raises
+``DeadlineExceeded`` with the state it needs to resume, typically by calling
+``deadline.stop(state)``.  That state is then stored in S3 where the next
+attempt of the task on the same message finds it, and the invocation fails
+with ``CheckpointSaved``, so that the ``Retry`` of the task's state resumes
+from it in ``deadline.checkpoint``.
+"""
+
+DEFAULT_DEADLINE_MARGIN_MS = 10000
+
+
+class DeadlineExceeded(Exception):
+    """Raised by a task that stopped before its deadline, with the state
+    from which the next attempt resumes.  The state must be JSON
+    serializable; None is saved as ``{}``."""
+
+    def __init__(self, checkpoint=None):
+        super().__init__('Deadline exceeded')
+        self.checkpoint = {} if checkpoint is None else checkpoint
+
+
+class CheckpointSaved(Exception):
+    """Raised by ``run_cumulus_task`` once the checkpoint of a task that
+    stopped before its deadline is stored, so that Step Functions retries the
+    task, which resumes from the checkpoint."""
+
+    def __init__(self, bucket, key):
+        super().__init__(f'Deadline exceeded, checkpoint saved to s3://{bucket}/{key}')
+        self.bucket = bucket
+        self.key = key
+
+
+class Deadline:
+    """
+    The remaining execution time of an invocation, and the checkpoint saved
+    by the previous attempt, if any.
+
+    Arguments:
+        context -- AWS Lambda context object; without one, the deadline
+            never expires
+        margin_ms -- Optional. The time kept to create and store the
+            outgoing message: the deadline expires when less remains
+        checkpoint -- Optional. The state saved by the previous attempt
+    """
+
+    def __init__(self, context=None, margin_ms=DEFAULT_DEADLINE_MARGIN_MS,
+                 checkpoint=None):
+        self.context = context
+        self.margin_ms = margin_ms
+        self.checkpoint = checkpoint
+
+    def remaining_ms(self):
+        """Returns the remaining execution time, or None if unknown."""
+        get_remaining_time = getattr(self.context, 'get_remaining_time_in_millis', None)
+        return get_remaining_time() if get_remaining_time else None
+
+    @property
+    def expired(self):
+        """Whether the task should stop and save its state."""
+        remaining = self.remaining_ms()
+        return remaining is not None and remaining <= self.margin_ms
+
+    def stop(self, state):
+        """Raises ``DeadlineExceeded`` with ``state`` as the checkpoint."""
+        raise DeadlineExceeded(state)
+
+    def check(self, state):
+        """Stops with ``state`` as the checkpoint if the deadline expired."""
+        if self.expired:
+            self.stop(state)
@@ -0,0 +1,163 @@
+"""
+JSON codec shared by ``CumulusLogger`` and the message adapter.
+
+``dumps`` and ``dumpb`` produce the encoding of ``json.dumps(obj)`` with its
+default options, byte for byte, which is what log lines and messages have
+always been written in: they use the standard library encoder.  Decoding,
+and the compact encoding of ``dumpb_compact``, which is only read back by
+this package (e.g. in hashes and memoized responses), use the fastest
+installed backend, ``orjson`` or ``ujson``, and fall back to the standard
+library ``json`` module.  The backend may be forced by setting
+``CUMULUS_JSON_CODEC`` to ``orjson``, ``ujson`` or ``json``.
+
+The compact encoding is that of
+``json.dumps(obj, ensure_ascii=False, separators=(',', ':'))``, whatever the
+backend, but for floats formatted with an exponent (``1e+16`` vs ``1e16``),
+which decode to the same value.  Values that a fast backend cannot encode
+(e.g. integers beyond 64 bits, or ``NaN`` and ``Infinity``, which orjson
+would encode as ``null``) are encoded by the standard library instead, and
+strings with lone surrogates (e.g. file names decoded with
+``surrogateescape``), which are not valid UTF-8, are encoded with escapes.
+Documents that a fast backend cannot decode are decoded by the standard
+library.
+
+>>> dumps({"granules": ["id1", "id2"], "0": 1})
+'{"granules": ["id1", "id2"], "0": 1}'
+>>> dumpb_compact({"granules": ["id1", "id2"], "0": 1})
+b'{"granules":["id1","id2"],"0":1}'
+>>> loads(b'{"a": [1, 2.5, null]}')
+{'a': [1, 2.5, None]}
+"""
+import json
+import math
+import os
+
+CODECS = ('orjson', 'ujson', 'json')
+
+_default_encoder = json.JSONEncoder()
+_std_encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'))
+_ascii_encoder = json.JSONEncoder(separators=(',', ':'))
+
+
+def _std_dumpb(obj):
+    try:
+        return _std_encoder.encode(obj).encode('utf-8')
+    except UnicodeEncodeError:  # Lone surrogates
+        return _ascii_encoder.encode(obj).encode('ascii')
+
+
+def _has_non_finite_float(obj):
+    stack = [obj]
+    while stack:
+        value = stack.pop()
+        if isinstance(value, float):
+            if not math.isfinite(value):
+                return True
+        elif isinstance(value, dict):
+            stack.extend(value.values())
+        elif isinstance(value, (list, tuple)):
+            stack.extend(value)
+    return False
+
+
+def _std_loads(data):
+    return json.loads(data)
+
+
+def _orjson_codec():
+    import orjson
+    option = orjson.OPT_NON_STR_KEYS
+
+    def dumpb(obj):
+        try:
+            encoded = orjson.dumps(obj, option=option)
+        except TypeError:
+            return _std_dumpb(obj)
+        # orjson encodes NaN and Infinity as null
+        if b'null' in encoded and _has_non_finite_float(obj):
+            return _std_dumpb(obj)
+        return encoded
+
+    def loads(data):
+        try:
+            return orjson.loads(data)
+        except ValueError:  # Including NaN and Infinity, which orjson rejects
+            return _std_loads(data)
+
+    return dumpb, loads
+
+
+def _ujson_codec():
+    import ujson
+
+    def dumpb(obj):
+        try:
+            return ujson.dumps(obj, ensure_ascii=False,
+                               escape_forward_slashes=False).encode('utf-8')
+        except (TypeError, OverflowError, UnicodeEncodeError):
+            return _std_dumpb(obj)
+
+    def loads(data):
+        try:
+            return ujson.loads(data)
+        except ValueError:
+            return _std_loads(data)
+
+    return dumpb, loads
+
+
+def _json_codec():
+    return _std_dumpb, _std_loads
+
+
+_CODEC_FACTORIES = {
+    'orjson': _orjson_codec,
+    'ujson': _ujson_codec,
+    'json': _json_codec,
+}
+
+codec_name = None
+_dumpb = _std_dumpb
+_loads = _std_loads
+
+
+def set_codec(name=None):
+    """Selects the codec by name, or the fastest installed one if ``name`` is
+    None.  Raises ``ImportError`` if the named codec is not installed."""
+    global codec_name, _dumpb, _loads  # pylint: disable=global-statement
+    if name is not None and name not in CODECS:
+        raise ValueError(
+            f'Unsupported JSON codec {name}, expected one of {", ".join(CODECS)}')
+    for candidate in (name,) if name else CODECS:
+        try:
+            _dumpb, _loads = _CODEC_FACTORIES[candidate]()
+        except ImportError:
+            if name:
+                raise
+            continue
+        codec_name = candidate
+        return codec_name
+    return codec_name
+
+
+def dumps(obj):
+    """Returns ``json.dumps(obj)``."""
+    return _default_encoder.encode(obj)
+
+
+def dumpb(obj):
+    """Returns ``json.dumps(obj)`` as bytes, which are ASCII."""
+    return _default_encoder.encode(obj).encode('ascii')
+
+
+def dumpb_compact(obj):
+    """Returns the compact JSON encoding of ``obj`` as UTF-8 bytes."""
+    return _dumpb(obj)
+
+
+def loads(data):
+    """Decodes a JSON document given as str or UTF-8 bytes."""
+    return _loads(data)
+
+
+set_codec(os.environ.get('CUMULUS_JSON_CODEC') or None)
@@ -2,11 +2,32 @@ try:
     from collections.abc import Mapping  # Python 3
 except ImportError:
     from collections import Mapping  # Python 2
+from collections import deque
+import copy
 from datetime import datetime
-from functools import reduce
+import atexit
+import functools
+import hashlib
 import json
 import logging
+import os
+import random
 import sys
+import threading
+import time
+import weakref
+
+import cumulus_json
+
+GRANULE_METADATA_POLICIES = ("full", "truncated", "hashed")
+DEFAULT_GRANULE_METADATA_LIMIT = 100
+OVERFLOW_POLICIES = ("block", "drop-oldest", "drop-debug")
+DEFAULT_BUFFER_CAPACITY = 10000
+
+# Members that every log line ends with
+_RESERVED_FIELDS = frozenset(("timestamp", "level"))
+_buffered_handlers = weakref.WeakSet()
+_limited_loggers = weakref.WeakSet()
 
 
 def _path_finder(*paths):
@@ -21,6 +42,9 @@ def _path_finder(*paths):
     paths have been checked.  If a non-None value is found, it is returned.
     Otherwise, it returns the default value, if specified, or None.
 
+    The paths are split once, when the function is created, so finders
+    should be created once and reused.
+
     >>> obj = {"a": 1, "x": {"y": {"z": 2}}}
     >>> _path_finder("a.b", "x.y.z")(obj)
     2
@@ -29,15 +53,18 @@ def _path_finder(*paths):
     >>> _path_finder("a.b", "x.y.z")(obj, 42)
     42
     """
-    def _get(val, key):
-        return val.get(key, None) if isinstance(val, Mapping) else None
-
-    def _getter(obj):
-        return lambda path: reduce(_get, path.split("."), obj)
+    split_paths = tuple(tuple(path.split(".")) for path in paths)
 
     def _finder(obj, default=None):
-        vals = (val for val in map(_getter(obj), paths) if val is not None)
-        return next(vals, default)
+        for keys in split_paths:
+            val = obj
+            for key in keys:
+                val = val.get(key, None) if isinstance(val, Mapping) else None
+                if val is None:
+                    break
+            if val is not None:
+                return val
+        return default
 
     return _finder
 
@@ -48,30 +75,74 @@ def _extended_paths(*paths):
     return extended_paths
 
 
+_find_async_operation_id = _path_finder(
+    *_extended_paths("cumulus_meta.asyncOperationId"))
+_find_execution_name = _path_finder(
+    *_extended_paths("cumulus_meta.execution_name"))
+_find_granules = _path_finder(
+    *_extended_paths("payload.granules", "meta.input_granules"))
+_find_parent_arn = _path_finder(
+    *_extended_paths("cumulus_meta.parentExecutionArn"))
+_find_stack_name = _path_finder(*_extended_paths("meta.stack"))
+
+
 def _get_async_operation_id(event):
-    paths = _extended_paths("cumulus_meta.asyncOperationId")
-    return _path_finder(*paths)(event)
+    return _find_async_operation_id(event)
 
 
 def _get_execution_name(event):
-    paths = _extended_paths("cumulus_meta.execution_name")
-    return _path_finder(*paths)(event)
+    return _find_execution_name(event)
 
 
 def _get_granule_ids(event):
-    paths = _extended_paths("payload.granules", "meta.input_granules")
-    granules = _path_finder(*paths)(event, [])
-    return list(map(_path_finder("granuleId"), granules))
+    return [
+        granule.get("granuleId") if isinstance(granule, Mapping) else None
+        for granule in _find_granules(event, [])
+    ]
 
 
 def _get_parent_arn(event):
-    paths = _extended_paths("cumulus_meta.parentExecutionArn")
-    return _path_finder(*paths)(event)
+    return _find_parent_arn(event)
 
 
 def _get_stack_name(event):
-    paths = _extended_paths("meta.stack")
-    return _path_finder(*paths)(event)
+    return _find_stack_name(event)
+
+
+def _granule_metadata(granule_ids, policy, limit):
+    """Returns the ``granules`` and ``granuleCount`` metadata for a list of
+    granule IDs according to the granule metadata policy:
+
+    + ``"full"``: ``granules`` is the JSON list of all granule IDs
+    + ``"truncated"``: ``granules`` is the JSON list of the first ``limit``
+      granule IDs, and ``granuleCount`` is the number of granules, if there
+      are more than ``limit``
+    + ``"hashed"``: ``granules`` is the SHA-256 hash of the JSON list of all
+      granule IDs, and ``granuleCount`` is the number of granules
+
+    The lists are encoded by ``json.dumps``, so that ``granules`` is the same
+    string regardless of the ``cumulus_json`` codec.
+
+    >>> _granule_metadata(["a", "b", "c"], "full", 2)
+    ('["a", "b", "c"]', None)
+    >>> _granule_metadata(["a", "b", "c"], "truncated", 2)
+    ('["a", "b"]', 3)
+    >>> _granule_metadata(["a", "b"], "truncated", 2)
+    ('["a", "b"]', None)
+    >>> granules, count = _granule_metadata(["a"], "hashed", 2)
+    >>> granules[:7], count
+    ('sha256:', 1)
+    """
+    if not granule_ids:
+        return None, None
+    if policy == "truncated":
+        if len(granule_ids) <= limit:
+            return json.dumps(granule_ids), None
+        return json.dumps(granule_ids[:limit]), len(granule_ids)
+    if policy == "hashed":
+        digest = hashlib.sha256(json.dumps(granule_ids).encode("utf-8")).hexdigest()
+        return "sha256:" + digest, len(granule_ids)
+    return json.dumps(granule_ids), None
 
 
 def _get_exception_message(**kwargs):
@@ -85,9 +156,326 @@ def _get_exception_message(**kwargs):
     return logging.Formatter().formatException(exc_info)
 
 
+def _format_message(message, args, kwargs, exc_info):
+    # - In case message is not a string (e.g., exception) use str
+    # - Only call str.format() if args or kwargs are actually given, so
+    #   that curly braces in the message do not cause an IndexError or
+    #   KeyError here
+    fmt_message = str(message)
+    if args or kwargs:
+        fmt_message = fmt_message.format(*args, **kwargs)
+
+    ex_message = _get_exception_message(exc_info=exc_info)
+    return " ".join(filter(None, [fmt_message, ex_message]))
+
+
+def _log_fields(message, args, kwargs, exc_info):
+    """Returns the members of a log line that precede the metadata, timestamp
+    and level, with ``exc_info`` already resolved by the caller."""
+    if isinstance(message, Mapping):
+        return dict(message)
+    return {"message": _format_message(message, args, kwargs, exc_info)}
+
+
+class _CallSiteLimiter:
+    """Samples and rate limits log calls, per call site.
+
+    A call site is identified by its level and unformatted message, so that
+    e.g. ``logger.debug("processed {}", granule_id)`` in a loop is limited as
+    a whole.  Calls are kept with probability ``sample_rate`` if they are
+    below ``logging.WARNING``, then at most ``rate_limit`` of them per second.
+    The number of calls suppressed at a call site is reported by the first
+    call in the following second, or by ``flush_logs``.
+    """
+    MAX_CALL_SITES = 1024
+
+    def __init__(self, rate_limit=None, sample_rate=None, clock=time.monotonic):
+        self.rate_limit = rate_limit
+        self.sample_rate = sample_rate
+        self.clock = clock
+        self._random = random.Random()
+        self._lock = threading.Lock()
+        # call site -> [start of the current second, calls, suppressed calls]
+        self._windows = {}
+
+    def allow(self, call_site):
+        """Returns whether to log a call, and the number of calls suppressed
+        at its call site to report now."""
+        now = self.clock()
+        with self._lock:
+            window = self._windows.get(call_site)
+            report = 0
+            if window is None or now - window[0] >= 1:
+                if window is not None:
+                    report = window[2]
+                elif len(self._windows) >= self.MAX_CALL_SITES:
+                    self._prune(now)
+                window = self._windows[call_site] = [now, 0, 0]
+            if (self.sample_rate is not None and call_site[0] < logging.WARNING
+                    and self._random.random() >= self.sample_rate):
+                window[2] += 1
+                return False, report
+            window[1] += 1
+            if self.rate_limit is not None and window[1] > self.rate_limit:
+                window[2] += 1
+                return False, report
+            return True, report
+
+    def _prune(self, now):
+        for call_site, window in list(self._windows.items()):
+            if now - window[0] >= 1 and not window[2]:
+                del self._windows[call_site]
+
+    def pop_suppressed(self):
+        """Returns and resets the number of calls suppressed per call site."""
+        with self._lock:
+            suppressed = {call_site: window[2]
+                          for call_site, window in self._windows.items()
+                          if window[2]}
+            for call_site in suppressed:
+                self._windows[call_site][2] = 0
+        return suppressed
+
+
+_timestamp_cache = (None, "")
+
+
+def _timestamp():
+    """Returns the current local time in the format of
+    ``datetime.now().isoformat()``, formatting the date and time only once
+    per second."""
+    global _timestamp_cache  # pylint: disable=global-statement
+    seconds, nanoseconds = divmod(time.time_ns(), 1000000000)
+    cached_seconds, prefix = _timestamp_cache
+    if seconds != cached_seconds:
+        prefix = datetime.fromtimestamp(seconds).isoformat()
+        _timestamp_cache = (seconds, prefix)
+    microseconds = nanoseconds // 1000
+    return "%s.%06d" % (prefix, microseconds) if microseconds else prefix
+
+
+@functools.lru_cache(maxsize=None)
+def _encoded_level(level):
+    return cumulus_json.dumps(logging.getLevelName(level).lower())
+
+
+class _JsonMessage:
+    """Log record message that is encoded as JSON only when the record is
+    formatted, i.e. not at all when no handler writes it.
+
+    ``msg`` is a dict.  ``metadata`` and ``suffix`` are members that are
+    already encoded (without the enclosing braces), which are spliced in
+    after those of ``msg``.  The result is ``json.dumps`` of all the members,
+    byte for byte.
+    """
+    __slots__ = ("msg", "metadata", "suffix")
+
+    def __init__(self, msg, metadata="", suffix=""):
+        self.msg = msg
+        self.metadata = metadata
+        self.suffix = suffix
+
+    def __str__(self):
+        encoded = cumulus_json.dumps(self.msg)
+        if not (self.metadata or self.suffix):
+            return encoded
+        members = filter(None, (encoded[1:-1], self.metadata, self.suffix))
+        return "{" + ", ".join(members) + "}"
+
+
+class BufferedLogHandler(logging.Handler):
+    """Handler that queues log records in memory and has a background thread
+    write them with a ``target`` handler, so that logging does not block on
+    I/O.  The messages of the records are resolved before they are queued
+    (see ``prepare``).
+
+    At most ``capacity`` records are queued.  When the queue is full, the
+    ``overflow`` policy applies:
+
+    + ``"block"``: wait for the background thread to make room
+    + ``"drop-oldest"``: discard the oldest queued record
+    + ``"drop-debug"``: discard the new record if it is a debug record, or
+      else the oldest queued debug record, or else wait as with ``"block"``
+
+    The number of discarded records is logged by the next ``flush``, which
+    waits until every queued record has been written.  Call ``flush`` (or
+    ``flush_logs``) before the end of a Lambda invocation, since the
+    container may be frozen before the background thread gets to run.
+    """
+
+    def __init__(self, target, capacity=DEFAULT_BUFFER_CAPACITY,
+                 overflow="block"):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(
+                "Unsupported overflow policy %s, expected one of %s"
+                % (overflow, ", ".join(OVERFLOW_POLICIES)))
+        super().__init__()
+        self.target = target
+        self.capacity = capacity
+        self.overflow = overflow
+        self.dropped = 0
+        self._records = deque()
+        self._pending = 0
+        self._closed = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(
+            target=self._run, name="CumulusLogger", daemon=True)
+        self._thread.start()
+        _buffered_handlers.add(self)
+
+    def _drop_queued_debug_record(self):
+        for record in self._records:
+            if record.levelno <= logging.DEBUG:
+                self._records.remove(record)
+                return True
+        return False
+
+    def prepare(self, record):
+        """Returns a copy of ``record`` whose message is resolved to a string,
+        as ``logging.handlers.QueueHandler.prepare`` does, so that the
+        objects it refers to, which the caller may update after logging, are
+        written as they were logged."""
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def emit(self, record):
+        try:
+            record = self.prepare(record)
+        except Exception:  # pylint: disable=broad-except
+            self.handleError(record)
+            return
+        with self._cond:
+            while len(self._records) >= self.capacity and not self._closed:
+                if self.overflow == "drop-oldest":
+                    self._records.popleft()
+                elif self.overflow == "drop-debug" and record.levelno <= logging.DEBUG:
+                    self.dropped += 1
+                    return
+                elif not (self.overflow == "drop-debug"
+                          and self._drop_queued_debug_record()):
+                    self._cond.wait()
+                    continue
+                self._pending -= 1
+                self.dropped += 1
+            self._records.append(record)
+            self._pending += 1
+            self._cond.notify_all()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._records or self._closed)
+                if not self._records:
+                    return
+                records = list(self._records)
+                self._records.clear()
+                self._cond.notify_all()
+            for record in records:
+                self.target.handle(record)
+            self._flush_target()
+            with self._cond:
+                self._pending -= len(records)
+                self._cond.notify_all()
+
+    def flush(self, timeout=None):
+        """Waits until all queued records are written, or ``timeout`` seconds
+        have passed.  Returns True if all records were written."""
+        with self._cond:
+            done = self._cond.wait_for(lambda: self._pending <= 0, timeout)
+            dropped, self.dropped = self.dropped, 0
+        if dropped:
+            self.target.handle(logging.makeLogRecord({
+                "msg": _JsonMessage({
+                    "message": "Dropped %d log records" % dropped,
+                    "timestamp": datetime.now().isoformat(),
+                    "level": "warning",
+                }),
+                "levelno": logging.WARNING,
+                "levelname": "WARNING",
+            }))
+        self._flush_target()
+        return done
+
+    def _flush_target(self):
+        try:
+            self.target.flush()
+        except ValueError:  # The stream of the target is closed
+            pass
+
+    def close(self):
+        _buffered_handlers.discard(self)
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        if self._thread is not threading.current_thread():
+            self._thread.join()
+        self.target.close()
+        super().close()
+
+    def _after_fork(self):
+        # Only the forking thread survives in the child: the writer thread is
+        # gone and may have held the condition, and the queued records are
+        # the parent's to write.
+        self._cond = threading.Condition()
+        self._records = deque()
+        self._pending = 0
+        if not self._closed:
+            self._thread = threading.Thread(
+                target=self._run, name="CumulusLogger", daemon=True)
+            self._thread.start()
+
+
+def flush_logs(timeout=None):
+    """Logs the number of calls suppressed by rate limited or sampled
+    ``CumulusLogger`` instances, then waits until the records queued by every
+    ``BufferedLogHandler`` are written.  ``run_cumulus_task`` calls this
+    before it returns or raises."""
+    for logger in list(_limited_loggers):
+        logger.logSuppressed()
+    for handler in list(_buffered_handlers):
+        handler.flush(timeout)
+
+
+def _after_fork_in_child():
+    for handler in list(_buffered_handlers):
+        handler._after_fork()  # pylint: disable=protected-access
+
+
+atexit.register(flush_logs)
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
 class CumulusLogger:
-    def __init__(self, name=__name__, level=logging.DEBUG):
-        """Creates a logger with a name and loggging level."""
+    def __init__(self, name=__name__, level=logging.DEBUG,
+                 granule_metadata=None, granule_metadata_limit=None,
+                 buffered=None, rate_limit=None, sample_rate=None):
+        """Creates a logger with a name and loggging level.
+
+        ``granule_metadata`` is the policy used to log granule IDs (see
+        ``setMetadata``): ``"full"``, ``"truncated"`` or ``"hashed"``.  It
+        defaults to the ``CUMULUS_LOGGER_GRANULE_METADATA`` environment
+        variable, or ``"full"``.  ``granule_metadata_limit`` is the number of
+        granule IDs logged by the ``"truncated"`` policy, which defaults to
+        the ``CUMULUS_LOGGER_GRANULE_METADATA_LIMIT`` environment variable,
+        or 100.
+
+        When ``buffered`` is true, records are written by a
+        ``BufferedLogHandler`` rather than synchronously, with the capacity
+        and overflow policy given by the ``CUMULUS_LOGGER_BUFFER_SIZE`` and
+        ``CUMULUS_LOGGER_OVERFLOW`` environment variables.  It defaults to the
+        ``CUMULUS_LOGGER_BUFFERED`` environment variable, or false.  Like the
+        handler, this is only set up by the first logger with a given name.
+
+        ``rate_limit`` is the maximum number of calls logged per second for
+        each call site (level and unformatted message), and ``sample_rate``
+        the fraction of debug and info calls that are logged.  They default to
+        the ``CUMULUS_LOGGER_RATE_LIMIT`` and ``CUMULUS_LOGGER_SAMPLE_RATE``
+        environment variables, or no limit.  Suppressed calls are counted and
+        reported per call site.
+        """
 
         self.logger = logging.getLogger(name)
         self.logger.setLevel(level)
@@ -98,11 +486,44 @@ class CumulusLogger:
             log_handler = logging.StreamHandler()
             log_handler.setLevel(logging.DEBUG)
             log_handler.setFormatter(logging.Formatter('%(message)s'))
+            if buffered is None:
+                buffered = str(
+                    os.environ.get("CUMULUS_LOGGER_BUFFERED")).lower() == "true"
+            if buffered:
+                log_handler = BufferedLogHandler(
+                    log_handler,
+                    capacity=int(os.environ.get(
+                        "CUMULUS_LOGGER_BUFFER_SIZE", DEFAULT_BUFFER_CAPACITY)),
+                    overflow=os.environ.get("CUMULUS_LOGGER_OVERFLOW", "block"))
             self.logger.addHandler(log_handler)
 
+        if granule_metadata is None:
+            granule_metadata = os.environ.get(
+                "CUMULUS_LOGGER_GRANULE_METADATA", "full").lower()
+        if granule_metadata not in GRANULE_METADATA_POLICIES:
+            raise ValueError(
+                "Unsupported granule metadata policy %s, expected one of %s"
+                % (granule_metadata, ", ".join(GRANULE_METADATA_POLICIES)))
+        if granule_metadata_limit is None:
+            granule_metadata_limit = int(os.environ.get(
+                "CUMULUS_LOGGER_GRANULE_METADATA_LIMIT",
+                DEFAULT_GRANULE_METADATA_LIMIT))
+        self.granule_metadata = granule_metadata
+        self.granule_metadata_limit = granule_metadata_limit
+
+        if rate_limit is None and os.environ.get("CUMULUS_LOGGER_RATE_LIMIT"):
+            rate_limit = int(os.environ["CUMULUS_LOGGER_RATE_LIMIT"])
+        if sample_rate is None and os.environ.get("CUMULUS_LOGGER_SAMPLE_RATE"):
+            sample_rate = float(os.environ["CUMULUS_LOGGER_SAMPLE_RATE"])
+        self._limiter = None
+        if rate_limit is not None or sample_rate is not None:
+            self._limiter = _CallSiteLimiter(rate_limit, sample_rate)
+            _limited_loggers.add(self)
+
         self.event = None
         self.context = None
         self._msg = {}
+        self._encoded_msg = ""
 
     def setMetadata(self, event, context):
         """Sets metadata to be logged via one of the logging methods.
@@ -114,7 +535,10 @@ class CumulusLogger:
           execution
         + ``executions`` (``event``): singleton list containing the execution
           name
-        + ``granules`` (``event``): list of granule IDs
+        + ``granules`` (``event``): list of granule IDs, as JSON, truncated
+          or hashed according to the granule metadata policy of the logger
+        + ``granuleCount`` (``event``): number of granules, when
+          ``granules`` is truncated or hashed
         + ``parentArn`` (``event``): ARN of the parent execution
         + ``sender`` (``context``): function name (or ``"unknown"``)
         + ``stackName`` (``event``): stack name
@@ -131,18 +555,23 @@ class CumulusLogger:
         self.event = event
         self.context = context
 
-        granules = _get_granule_ids(event)
+        granules, granule_count = _granule_metadata(
+            _get_granule_ids(event), self.granule_metadata,
+            self.granule_metadata_limit)
 
         # Exclude items from self._msg where values are "empty"
         self._msg = dict((k, v) for k, v in {
             "asyncOperationId": _get_async_operation_id(event),
             "executions": _get_execution_name(event),
-            "granules": json.dumps(granules) if granules else None,
+            "granules": granules,
+            "granuleCount": granule_count,
             "parentArn": _get_parent_arn(event),
             "sender": getattr(context, "function_name", "unknown"),
             "stackName": _get_stack_name(event),
             "version": getattr(context, "function_version", "unknown")
         }.items() if v)
+        # Encoded once here rather than in every log line
+        self._encoded_msg = cumulus_json.dumps(self._msg)[1:-1]
 
     def createMessage(self, message, *args, **kwargs):
         """Returns a dict containing a string message along with metadata.
@@ -212,19 +641,11 @@ class CumulusLogger:
         if isinstance(message, Mapping):
             msg.update(message)
         else:
-            # - In case message is not a string (e.g., exception) use str
-            # - Only call str.format() if args or kwargs are actually given, so
-            #   that curly braces in the message do not cause an IndexError or
-            #   KeyError here
-            fmt_message = str(message)
-            if args or kwargs:
-                fmt_message = fmt_message.format(*args, **kwargs)
-
-            ex_message = _get_exception_message(**kwargs)
-            msg["message"] = " ".join(filter(None, [fmt_message, ex_message]))
+            msg["message"] = _format_message(
+                message, args, kwargs, kwargs.get('exc_info', False))
 
         msg.update(self._msg)
-        msg["timestamp"] = datetime.now().isoformat()
+        msg["timestamp"] = _timestamp()
 
         return msg
 
@@ -316,18 +737,71 @@ class CumulusLogger:
         """
         self._log(logging.CRITICAL, message, *args, **kwargs)
 
+    def flush(self, timeout=None):
+        """Waits until the records queued by this logger's buffered handler,
+        if any, are written."""
+        for handler in self.logger.handlers:
+            if isinstance(handler, BufferedLogHandler):
+                handler.flush(timeout)
+
     def _resolve_log_level(self, level_name):
         if not isinstance(level_name, str):
             return self.logger.level
         level = logging.getLevelName(level_name.upper())
         return level if isinstance(level, int) else self.logger.level
 
+    def logSuppressed(self):
+        """Logs the number of calls suppressed by rate limiting or sampling
+        since they were last reported, per call site."""
+        if self._limiter is None:
+            return
+        for call_site, suppressed in self._limiter.pop_suppressed().items():
+            self._log_suppressed(call_site, suppressed)
+
+    def _log_suppressed(self, call_site, suppressed):
+        level, template = call_site
+        msg = {"message": "Suppressed %d log records like: %s"
+                          % (suppressed, template),
+               "suppressed": suppressed}
+        suffix = '"timestamp": "%s", "level": %s' % (
+            _timestamp(), _encoded_level(level))
+        self.logger.log(level, _JsonMessage(msg, self._encoded_msg, suffix))
+
     def _log(self, level, message, *args, **kwargs):
-        msg = self.createMessage(message, *args, **kwargs)
+        is_mapping = isinstance(message, Mapping)
         if level == logging.NOTSET or not isinstance(level, int):
-            level = self._resolve_log_level(msg.get("level", None))
-        msg["level"] = logging.getLevelName(level).lower()
-        self.logger.log(level, json.dumps(msg))
+            level = self._resolve_log_level(
+                message.get("level", None) if is_mapping else None)
+        if not self.logger.isEnabledFor(level):
+            return
+        if self._limiter is not None:
+            template = message.get("message") if is_mapping else message
+            call_site = (level, template if isinstance(template, str)
+                         else type(template).__name__)
+            allowed, suppressed = self._limiter.allow(call_site)
+            if suppressed:
+                self._log_suppressed(call_site, suppressed)
+            if not allowed:
+                return
+
+        # Equivalent to encoding createMessage(...) plus the level, but with
+        # the metadata encoded by setMetadata, and the message encoded only
+        # when the record is formatted
+        exc_info = kwargs.get("exc_info", False)
+        if exc_info and not isinstance(exc_info, tuple):
+            exc_info = sys.exc_info()
+        fields = _log_fields(message, args, kwargs, exc_info)
+        timestamp = _timestamp()
+        if fields.keys().isdisjoint(self._msg) and not fields.keys() & _RESERVED_FIELDS:
+            suffix = '"timestamp": "%s", "level": %s' % (timestamp, _encoded_level(level))
+            self.logger.log(level, _JsonMessage(fields, self._encoded_msg, suffix))
+            return
+        # Members of the message that the metadata, timestamp or level
+        # replace keep their position, as with createMessage
+        fields.update(self._msg)
+        fields["timestamp"] = timestamp
+        fields["level"] = logging.getLevelName(level).lower()
+        self.logger.log(level, _JsonMessage(fields))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,434 @@
+"""
+Opt-in memoization of task responses, so that a step retried by Step
+Functions after a downstream failure or a throttle does not run its task
+again for the same input and config.
+
+Responses are keyed by a hash of the task function, of its keyword arguments
+and of the ``input``, resolved ``config`` and ``cumulus_config`` of its nested
+event (see ``TaskMemo.key``), and stored as JSON in one of three stores:
+
++ ``MemoryMemoStore``: a bounded LRU in the memory of a warm container
++ ``DirectoryMemoStore``: files in a local directory, such as ``/tmp``
++ ``S3MemoStore``: objects under an S3 prefix, shared by every container
+
+Stored responses expire ``ttl_seconds`` after they were stored, and the
+memory and directory stores evict the least recently used responses beyond
+``max_bytes``.  Only tasks whose response depends on nothing but their input
+and config should be memoized.
+"""
+from collections import OrderedDict
+from datetime import datetime, timezone
+import hashlib
+import os
+import tempfile
+import threading
+import time
+import types
+import weakref
+
+import cumulus_json
+import cumulus_remote
+from cumulus_streaming import has_streams, lazy_objects_pending, unwrap_lazy_views
+
+DEFAULT_MEMO_TTL_SECONDS = 3600
+DEFAULT_MEMO_MAX_BYTES = 64 * 1024 * 1024
+MISSING = object()
+
+
+class MemoryMemoStore:
+    """Bounded LRU of encoded responses in the memory of the process.
+    Responses larger than the whole ``max_bytes`` budget are not stored."""
+
+    def __init__(self, ttl_seconds=DEFAULT_MEMO_TTL_SECONDS,
+                 max_bytes=DEFAULT_MEMO_MAX_BYTES):
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """Returns the response stored under ``key``, or None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, data = entry
+            if expires is not None and expires <= time.time():
+                del self._entries[key]
+                self.size -= len(data)
+                return None
+            self._entries.move_to_end(key)
+            return data
+
+    def put(self, key, data):
+        """Stores the response ``data`` under ``key``, evicting the least
+        recently used responses to stay within budget."""
+        if len(data) > self.max_bytes:
+            return
+        expires = time.time() + self.ttl_seconds if self.ttl_seconds else None
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.size -= len(previous[1])
+            self._entries[key] = (expires, data)
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+class DirectoryMemoStore:
+    """Encoded responses in the files of a local directory.
+
+    A file's modification time is the time its response was stored, and its
+    access time that of its last use, which orders evictions beyond
+    ``max_bytes``.  Files are written to a temporary name and renamed, so
+    that concurrent readers never see a partial response.
+    """
+
+    def __init__(self, directory, ttl_seconds=DEFAULT_MEMO_TTL_SECONDS,
+                 max_bytes=DEFAULT_MEMO_MAX_BYTES):
+        self.directory = directory
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+
+    def _path(self, key):
+        return os.path.join(self.directory, f'{key}.json')
+
+    def _expired(self, stat, now):
+        return bool(self.ttl_seconds) and stat.st_mtime + self.ttl_seconds <= now
+
+    def get(self, key):
+        """Returns the response stored under ``key``, or None."""
+        path = self._path(key)
+        now = time.time()
+        try:
+            stat = os.stat(path)
+            if self._expired(stat, now):
+                _remove(path)
+                return None
+            with open(path, 'rb') as response_file:
+                data = response_file.read()
+        except FileNotFoundError:
+            return None
+        os.utime(path, (now, stat.st_mtime))
+        return data
+
+    def put(self, key, data):
+        """Stores the response ``data`` under ``key``, then evicts expired
+        responses and the least recently used ones beyond ``max_bytes``."""
+        if len(data) > self.max_bytes:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=self.directory, suffix='.tmp',
+                                         delete=False) as response_file:
+            response_file.write(data)
+        now = time.time()
+        os.utime(response_file.name, (now, now))
+        os.replace(response_file.name, self._path(key))
+        self._evict()
+
+    def _entries(self):
+        entries = []
+        with os.scandir(self.directory) as scan:
+            for entry in scan:
+                if entry.name.endswith('.json'):
+                    try:
+                        entries.append((entry.path, entry.stat()))
+                    except FileNotFoundError:
+                        pass
+        return entries
+
+    def _evict(self):
+        now = time.time()
+        entries = []
+        for path, stat in self._entries():
+            if self._expired(stat, now):
+                _remove(path)
+            else:
+                entries.append((stat.st_atime, stat.st_size, path))
+        size = sum(entry[1] for entry in entries)
+        for _, entry_size, path in sorted(entries):
+            if size <= self.max_bytes:
+                break
+            _remove(path)
+            size -= entry_size
+
+    def clear(self):
+        if os.path.isdir(self.directory):
+            for path, _ in self._entries():
+                _remove(path)
+
+
+class S3MemoStore:
+    """Encoded responses in the objects under an ``s3://bucket/prefix``,
+    shared by every container.
+
+    Responses larger than ``max_bytes`` are not stored, and expired ones are
+    deleted when next read.  The total size of the prefix is not bounded
+    here: an S3 lifecycle rule on the prefix removes responses that are no
+    longer read.
+    """
+
+    def __init__(self, uri, ttl_seconds=DEFAULT_MEMO_TTL_SECONDS,
+                 max_bytes=DEFAULT_MEMO_MAX_BYTES):
+        self.bucket, self.prefix = cumulus_remote.parse_s3_uri(uri)
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+
+    def _key(self, key):
+        return '/'.join(filter(None, (self.prefix, f'{key}.json')))
+
+    def get(self, key):
+        """Returns the response stored under ``key``, or None."""
+        client = cumulus_remote.s3_client()
+        try:
+            data = client.get_object(Bucket=self.bucket, Key=self._key(key))
+        except Exception as error:  # pylint: disable=broad-except
+            code = getattr(error, 'response', {}).get('Error', {}).get('Code')
+            if code in ('NoSuchKey', '404'):
+                return None
+            raise
+        if self.ttl_seconds:
+            age = datetime.now(timezone.utc) - data['LastModified']
+            if age.total_seconds() >= self.ttl_seconds:
+                data['Body'].close()
+                client.delete_object(Bucket=self.bucket, Key=self._key(key))
+                return None
+        return data['Body'].read()
+
+    def put(self, key, data):
+        """Stores the response ``data`` under ``key``."""
+        if len(data) > self.max_bytes:
+            return
+        cumulus_remote.s3_client().put_object(
+            Bucket=self.bucket, Key=self._key(key), Body=data,
+            ContentType='application/json')
+
+    def clear(self):
+        pass
+
+
+def create_store(backend, ttl_seconds=DEFAULT_MEMO_TTL_SECONDS,
+                 max_bytes=DEFAULT_MEMO_MAX_BYTES):
+    """Returns the store named by ``backend``: ``memory``, an
+    ``s3://bucket/prefix`` URI, or the path of a local directory."""
+    if backend == 'memory':
+        return MemoryMemoStore(ttl_seconds, max_bytes)
+    if backend.startswith('s3://'):
+        return S3MemoStore(backend, ttl_seconds, max_bytes)
+    return DirectoryMemoStore(backend, ttl_seconds, max_bytes)
+
+
+def _encode(value):
+    value = unwrap_lazy_views(value)
+    if not lazy_objects_pending():
+        return cumulus_json.dumpb_compact(value)
+    # Encodes the members of lazily parsed remote events without parsing them
+    return ''.join(cumulus_remote.iter_json(value)).encode('utf-8')
+
+
+def _constant_repr(value):
+    # Frozen sets of str are ordered by hash, which differs across processes
+    if isinstance(value, frozenset):
+        return 'frozenset({%s})' % ', '.join(sorted(map(_constant_repr, value)))
+    if isinstance(value, tuple):
+        return '(%s)' % ', '.join(map(_constant_repr, value))
+    return repr(value)
+
+
+def _hash_code(digest, code):
+    digest.update(code.co_code)
+    digest.update(' '.join(code.co_names).encode('utf-8'))
+    for constant in code.co_consts:
+        if isinstance(constant, types.CodeType):
+            _hash_code(digest, constant)
+        else:
+            digest.update(_constant_repr(constant).encode('utf-8', 'surrogatepass'))
+
+
+_CONSTANT_TYPES = (str, bytes, int, float, complex, type(None), tuple, frozenset)
+
+
+def _hash_function(digest, function, seen):
+    """Hashes the code of ``function``, the constants it closes over, and the
+    code of the functions it closes over or calls by name from its own
+    module."""
+    seen.add(function)
+    _hash_code(digest, function.__code__)
+    related = [cell.cell_contents for cell in function.__closure__ or ()
+               if _has_cell_contents(cell)]
+    for value in related:
+        if isinstance(value, _CONSTANT_TYPES):
+            digest.update(_constant_repr(value).encode('utf-8', 'surrogatepass'))
+    related.extend(function.__globals__.get(name) for name in function.__code__.co_names)
+    for value in related:
+        if (isinstance(value, types.FunctionType) and value not in seen
+                and value.__module__ == function.__module__):
+            _hash_function(digest, value, seen)
+
+
+def _has_cell_contents(cell):
+    try:
+        cell.cell_contents  # pylint: disable=pointless-statement
+    except ValueError:  # Empty cell
+        return False
+    return True
+
+
+# The identities of the task functions, as they do not change once loaded
+_task_identities = weakref.WeakKeyDictionary()
+
+
+def _task_identity(task_function, version=None):
+    """Returns the name of ``task_function``, the hash of its code and
+    ``version``, so that a changed task function does not reuse stale
+    responses.
+
+    The code hashed is that of the task function (or of the ``__call__``
+    method of a callable object), including its constants, and that of the
+    functions it closes over or calls from its own module.  Changes to
+    anything else the task depends on, such as modules it imports, are only
+    told apart by ``version``.  The hash is computed once per task function,
+    until ``configure_task_memo`` is called again.
+    """
+    try:
+        identity = _task_identities.get(task_function)
+    except TypeError:  # Neither hashable nor weakly referenceable
+        identity = None
+    if identity is None:
+        identity = _hash_task(task_function)
+        try:
+            _task_identities[task_function] = identity
+        except TypeError:
+            pass
+    return f'{identity}:{version or ""}'.encode('utf-8')
+
+
+def _hash_task(task_function):
+    name = '.'.join(filter(None, (getattr(task_function, '__module__', None),
+                                  getattr(task_function, '__qualname__', None))))
+    function = task_function
+    if not isinstance(function, types.FunctionType):
+        function = getattr(type(task_function), '__call__', None)
+    digest = hashlib.blake2b(digest_size=16)
+    if isinstance(function, types.FunctionType):
+        _hash_function(digest, function, set())
+    return f'{name or type(task_function).__name__}:{digest.hexdigest()}'
+
+
+class TaskMemo:
+    """Looks up and stores task responses in ``store``.
+
+    Failing to read or write the store is logged and otherwise ignored, so
+    the task runs as if nothing was memoized.  ``hits`` and ``misses`` count
+    the lookups of the process.  ``version`` identifies the deployed code,
+    e.g. the Lambda function version, and is part of every key.  With
+    ``ignore_cumulus_config``, keys leave out the ``cumulus_config`` of the
+    nested event, so that responses are reused across executions.
+    """
+
+    def __init__(self, store, version=None, ignore_cumulus_config=False):
+        self.store = store
+        self.version = version
+        self.ignore_cumulus_config = ignore_cumulus_config
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, task_function, nested_event, taskargs=None):
+        """Returns the key of the response of ``task_function`` to
+        ``nested_event`` when called with the keyword arguments ``taskargs``,
+        a hash of the task's identity (see ``_task_identity``), ``input``,
+        ``config``, ``cumulus_config`` (unless ``ignore_cumulus_config``) and
+        ``taskargs``, or None if they are not JSON serializable, in which case
+        the response is not memoized.
+
+        The members of lazily parsed remote events that are not parsed yet
+        are hashed as stored, without parsing them: a retried message has the
+        same key, but an equal message stored with other whitespace does not.
+        """
+        digest = hashlib.blake2b(_task_identity(task_function, self.version),
+                                 digest_size=32)
+        names = ('input', 'config') if self.ignore_cumulus_config else (
+            'input', 'config', 'cumulus_config')
+        try:
+            for name in names:
+                digest.update(b'\0')
+                digest.update(_encode(nested_event.get(name)))
+            if taskargs:
+                digest.update(b'\0')
+                digest.update(_encode(dict(sorted(taskargs.items()))))
+        except (TypeError, ValueError):  # Not JSON serializable
+            return None
+        return digest.hexdigest()
+
+    def get(self, key, logger):
+        """Returns the response stored under ``key``, or ``MISSING``."""
+        try:
+            data = self.store.get(key)
+        except Exception:  # pylint: disable=broad-except
+            logger.warn('Failed to read the memoized task response', exc_info=True)
+            data = None
+        if data is None:
+            self.misses += 1
+            return MISSING
+        self.hits += 1
+        logger.info('Reusing the memoized task response {}', key)
+        return cumulus_json.loads(data)
+
+    def put(self, key, response, logger):
+        """Stores ``response`` under ``key``, unless it streams its output
+        (see ``cumulus_streaming``)."""
+        if has_streams(response):
+            return
+        try:
+            self.store.put(key, _encode(response))
+        except (TypeError, ValueError):  # Not JSON serializable
+            pass
+        except Exception:  # pylint: disable=broad-except
+            logger.warn('Failed to memoize the task response', exc_info=True)
+
+
+_task_memo = None
+_task_memo_config = None
+
+
+def configure_task_memo(backend=None, ttl_seconds=DEFAULT_MEMO_TTL_SECONDS,
+                        max_bytes=DEFAULT_MEMO_MAX_BYTES, version=None,
+                        ignore_cumulus_config=False):
+    """Memoizes task responses in the store named by ``backend`` (see
+    ``create_store``), or disables memoization when ``backend`` is falsy.
+    Keys include ``version``, and leave out ``cumulus_config`` with
+    ``ignore_cumulus_config`` (see ``TaskMemo``).  The store is kept while
+    the arguments are unchanged.  Returns the ``TaskMemo``, or None."""
+    global _task_memo, _task_memo_config  # pylint: disable=global-statement
+    config = (backend, ttl_seconds, max_bytes, version, ignore_cumulus_config)
+    _task_identities.clear()
+    if not backend:
+        _task_memo = None
+    elif _task_memo is None or config != _task_memo_config:
+        _task_memo = TaskMemo(create_store(backend, ttl_seconds, max_bytes), version,
+                              ignore_cumulus_config)
+    _task_memo_config = config
+    return _task_memo
+
+
+def task_memo():
+    """Returns the process-level ``TaskMemo``, or None if disabled."""
+    return _task_memo
@@ -0,0 +1,210 @@
+"""
+Per-invocation metrics of ``run_cumulus_task``, logged by ``CumulusLogger``
+in the CloudWatch Embedded Metric Format (EMF), so that CloudWatch extracts
+them from the Lambda logs without any API calls.
+
+Each phase of the adapter is timed separately from the task function:
+
++ ``LoadRemoteEvent``: loading the remote message, if any, from S3
++ ``LoadNestedEvent``: resolving templates and validating input and config
++ ``Task``: the task function
++ ``CreateNextEvent``: validating the output and storing it in S3 if needed
+
+along with the size of the incoming and outgoing messages, the growth of the
+peak resident set size, and optionally the peak memory allocated by each
+phase as traced by ``tracemalloc``.
+
+The peak traced by ``tracemalloc`` is that of the whole process, so phase
+peaks are not recorded while several invocations trace memory at once, as
+the records of ``run_cumulus_task_batch`` may.  Tracing is shared with
+``cumulus_profiling`` through ``start_tracing`` and ``stop_tracing``, so
+that neither stops it while the other still traces.
+"""
+from contextlib import contextmanager
+import threading
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+import cumulus_remote
+
+DEFAULT_NAMESPACE = 'CumulusMessageAdapter'
+PHASES = ('LoadRemoteEvent', 'LoadNestedEvent', 'Task', 'CreateNextEvent')
+
+_tracing_lock = threading.Lock()
+_tracing_users = 0
+_tracing_invocations = 0
+_tracing_starts = 0
+_started_tracing = False
+
+
+def _acquire_tracing():
+    """Starts ``tracemalloc`` for one more user; ``_tracing_lock`` must be
+    held."""
+    global _tracing_users, _started_tracing  # pylint: disable=global-statement
+    _tracing_users += 1
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+        _started_tracing = True
+
+
+def _release_tracing():
+    """Stops ``tracemalloc`` once its last user is done, unless it was
+    started outside this module; ``_tracing_lock`` must be held."""
+    global _tracing_users, _started_tracing  # pylint: disable=global-statement
+    _tracing_users -= 1
+    if not _tracing_users and _started_tracing:
+        tracemalloc.stop()
+        _started_tracing = False
+
+
+def start_tracing():
+    """Starts tracing memory allocations with ``tracemalloc``, unless it
+    already traces them.  Every call must be paired with ``stop_tracing``."""
+    with _tracing_lock:
+        _acquire_tracing()
+
+
+def stop_tracing():
+    """Stops tracing memory allocations once every ``start_tracing`` call
+    has been paired, if tracing was started by ``start_tracing``."""
+    with _tracing_lock:
+        _release_tracing()
+
+
+def _start_tracing():
+    global _tracing_invocations, _tracing_starts  # pylint: disable=global-statement
+    with _tracing_lock:
+        _acquire_tracing()
+        _tracing_invocations += 1
+        _tracing_starts += 1
+
+
+def _stop_tracing():
+    global _tracing_invocations  # pylint: disable=global-statement
+    with _tracing_lock:
+        _tracing_invocations -= 1
+        _release_tracing()
+
+
+def _max_rss_kilobytes():
+    if resource is None:
+        return 0
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class InvocationMetrics:
+    """Collects the metrics of one invocation and logs them as an EMF record.
+
+    Metrics are only collected when ``enabled``; otherwise every method is a
+    cheap no-op, so callers need not check.
+    """
+
+    def __init__(self, enabled=True, namespace=DEFAULT_NAMESPACE,
+                 trace_memory=False):
+        self.enabled = enabled
+        self.namespace = namespace
+        self.trace_memory = trace_memory and enabled
+        self.values = {}
+        self.units = {}
+        self._start = None
+        self._start_rss = None
+        self._tracing = False
+
+    def _put(self, name, value, unit):
+        self.values[name] = value
+        self.units[name] = unit
+
+    def start(self):
+        """Starts timing the invocation."""
+        if not self.enabled:
+            return
+        if self.trace_memory and not self._tracing:
+            _start_tracing()
+            self._tracing = True
+        self._start_rss = _max_rss_kilobytes()
+        self._start = time.perf_counter()
+
+    @contextmanager
+    def phase(self, name):
+        """Times the ``with`` block as phase ``name``."""
+        if not self.enabled:
+            yield
+            return
+        # Only traced when no other invocation traces memory meanwhile
+        with _tracing_lock:
+            starts = _tracing_starts
+            trace_memory = self._tracing and _tracing_invocations == 1
+        if trace_memory:
+            tracemalloc.reset_peak()
+            allocated = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            # A phase repeated in an invocation (see ``run_cumulus_tasks``)
+            # adds up its times and keeps its highest peak
+            self._put(f'{name}Time',
+                      self.values.get(f'{name}Time', 0)
+                      + (time.perf_counter() - start) * 1000,
+                      'Milliseconds')
+            if trace_memory:
+                with _tracing_lock:
+                    peak = (tracemalloc.get_traced_memory()[1]
+                            if starts == _tracing_starts
+                            and tracemalloc.is_tracing() else None)
+                if peak is not None:
+                    self._put(f'{name}PeakAllocated',
+                              max(peak - allocated,
+                                  self.values.get(f'{name}PeakAllocated', 0)),
+                              'Bytes')
+
+    def size(self, name, value):
+        """Records the size of ``value`` encoded as JSON as ``name``, as the
+        message adapter measures messages (see ``cumulus_remote.json_size``),
+        without holding the encoding in memory."""
+        if not self.enabled:
+            return
+        try:
+            self._put(name, cumulus_remote.json_size(value), 'Bytes')
+        except (TypeError, ValueError):
+            pass
+
+    def record(self, context=None):
+        """Returns the EMF record of the metrics collected so far."""
+        self._put('TotalTime', (time.perf_counter() - self._start) * 1000,
+                  'Milliseconds')
+        max_rss = _max_rss_kilobytes()
+        self._put('MaxRSS', max_rss, 'Kilobytes')
+        self._put('MaxRSSGrowth', max_rss - self._start_rss, 'Kilobytes')
+        function_name = getattr(context, 'function_name', None) or 'unknown'
+        return {
+            'message': 'Cumulus task metrics',
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': self.namespace,
+                    'Dimensions': [['FunctionName']],
+                    'Metrics': [{'Name': name, 'Unit': unit}
+                                for name, unit in self.units.items()],
+                }],
+            },
+            'FunctionName': function_name,
+            **self.values,
+        }
+
+    def emit(self, logger, context=None):
+        """Logs the EMF record at the info level with ``logger``, a
+        ``CumulusLogger``, and stops tracing memory for the invocation."""
+        if not self.enabled:
+            return
+        try:
+            logger.info(self.record(context))
+        finally:
+            if self._tracing:
+                self._tracing = False
+                _stop_tracing()
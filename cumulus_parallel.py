@@ -0,0 +1,212 @@
+"""
+Maps a function over the granules of a task in worker processes, so that
+CPU-bound work such as checksumming or parsing metadata uses every vCPU of
+the Lambda function rather than the one the GIL allows.
+
+Lambda does not provide ``/dev/shm``, on which ``multiprocessing.Pool`` and
+``concurrent.futures.ProcessPoolExecutor`` rely for their queues, so workers
+are forked processes that receive granules and send back results through
+pipes.  Where ``fork`` is not available, or a single CPU is, granules are
+processed in the calling process.
+
+Granules are handed out in order, and no new granule is started once the
+``cumulus_deadline.Deadline`` of the invocation gets close, so that the task
+can still return what was processed along with the rest of the granules.
+"""
+from dataclasses import dataclass, field
+import os
+import time
+import traceback
+
+from cumulus_deadline import Deadline
+from cumulus_logger import CumulusLogger, flush_logs
+
+
+@dataclass
+class GranuleMapResult:
+    """The results of ``map_granules``: ``results`` holds the result of each
+    processed granule, in the order of the granules, and ``unprocessed``
+    the granules that were not started before the deadline."""
+    results: list = field(default_factory=list)
+    unprocessed: list = field(default_factory=list)
+
+    @property
+    def complete(self):
+        """Whether every granule was processed."""
+        return not self.unprocessed
+
+
+class _RemoteTraceback(Exception):
+    def __init__(self, tb):
+        super().__init__(tb)
+        self.tb = tb
+
+    def __str__(self):
+        return self.tb
+
+
+def available_cpus():
+    """Returns the number of CPUs the process may run on."""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:  # Not available on macOS or Windows
+        return os.cpu_count() or 1
+
+
+def _worker(connection, function, cumulus_message, context, kwargs):
+    logger = CumulusLogger()
+    logger.setMetadata(cumulus_message or {}, context)
+    try:
+        while True:
+            job = connection.recv()
+            if job is None:
+                return
+            index, granule = job
+            try:
+                reply = (index, True, function(granule, logger=logger, **kwargs))
+            except Exception as exception:  # pylint: disable=broad-except
+                reply = (index, False, (exception, traceback.format_exc()))
+            try:
+                connection.send(reply)
+            except Exception as exception:  # pylint: disable=broad-except
+                # e.g. a result or an exception that cannot be pickled
+                connection.send((index, False, (
+                    RuntimeError(f'Cannot return the result of granule {index}: '
+                                 f'{exception!r}'),
+                    traceback.format_exc())))
+    except (EOFError, KeyboardInterrupt):
+        return
+    finally:
+        flush_logs()
+        connection.close()
+
+
+def _fork_context():
+    import multiprocessing
+    if 'fork' not in multiprocessing.get_all_start_methods():
+        return None
+    return multiprocessing.get_context('fork')
+
+
+def _allows_more(deadline, slowest_ms):
+    """Tells whether there is time left to start a granule: the remaining
+    time must exceed the margin of ``deadline`` plus the longest time a
+    granule took so far."""
+    remaining = deadline.remaining_ms()
+    return remaining is None or remaining > deadline.margin_ms + slowest_ms
+
+
+def _elapsed_ms(started):
+    return (time.monotonic() - started) * 1000
+
+
+def _map_in_process(function, granules, deadline, logger, kwargs):
+    results = []
+    slowest_ms = 0
+    for granule in granules:
+        if not _allows_more(deadline, slowest_ms):
+            break
+        started = time.monotonic()
+        results.append(function(granule, logger=logger, **kwargs))
+        slowest_ms = max(slowest_ms, _elapsed_ms(started))
+    return GranuleMapResult(results, granules[len(results):])
+
+
+def _map_in_workers(mp_context, workers, function, granules, deadline,
+                    cumulus_message, context, kwargs):
+    from multiprocessing.connection import wait
+
+    connections, processes = [], []
+    try:
+        for _ in range(workers):
+            parent_end, child_end = mp_context.Pipe()
+            process = mp_context.Process(
+                target=_worker, daemon=True,
+                args=(child_end, function, cumulus_message, context, kwargs))
+            process.start()
+            child_end.close()
+            connections.append(parent_end)
+            processes.append(process)
+
+        results = [None] * len(granules)
+        idle = list(reversed(connections))
+        started = {}
+        dispatched = 0
+        slowest_ms = 0
+        while True:
+            while (idle and dispatched < len(granules)
+                   and _allows_more(deadline, slowest_ms)):
+                connection = idle.pop()
+                connection.send((dispatched, granules[dispatched]))
+                started[connection] = time.monotonic()
+                dispatched += 1
+            if not started:
+                break
+            for connection in wait(list(started)):
+                try:
+                    index, succeeded, value = connection.recv()
+                except EOFError:
+                    raise RuntimeError(
+                        'A map_granules worker process exited unexpectedly') from None
+                slowest_ms = max(slowest_ms, _elapsed_ms(started.pop(connection)))
+                if not succeeded:
+                    exception, remote_traceback = value
+                    raise exception from _RemoteTraceback(remote_traceback)
+                results[index] = value
+                idle.append(connection)
+        return GranuleMapResult(results[:dispatched], granules[dispatched:])
+    finally:
+        for connection in connections:
+            try:
+                connection.send(None)
+            except OSError:
+                pass
+        for process in processes:
+            process.join(timeout=1)
+            if process.is_alive():
+                process.terminate()
+                process.join()
+        for connection in connections:
+            connection.close()
+
+
+def map_granules(function, granules, context=None, cumulus_message=None,
+                 max_workers=None, deadline=None, **kwargs):
+    """
+    Calls ``function(granule, logger=logger, **kwargs)`` for each granule,
+    in a pool of worker processes, and returns a ``GranuleMapResult``.
+
+    ``logger`` is a ``CumulusLogger`` of the worker, with the metadata of
+    ``cumulus_message`` and ``context``.  Workers are forked, so
+    ``function`` need not be importable, but ``granules``, ``kwargs`` and
+    the results must be picklable.  An exception raised by ``function`` is
+    raised again as soon as it is received, with the traceback of the worker
+    as its cause; workers still processing other granules are terminated.
+
+    Arguments:
+        function -- Required. The function called for each granule
+        granules -- Required. The granules, e.g. ``event['input']['granules']``
+        context -- AWS Lambda context object
+        cumulus_message -- Optional. The Cumulus message (or the event given
+            to the task) whose metadata the workers log
+        max_workers -- Optional. Number of worker processes; defaults to the
+            number of available CPUs
+        deadline -- Optional. The ``cumulus_deadline.Deadline`` given to the
+            task, ``Deadline(context)`` by default.  No granule is started
+            once the remaining execution time is less than its margin plus
+            the longest time a granule took so far
+        kwargs -- Optional. Additional keyword arguments for ``function``
+    """
+    granules = list(granules)
+    if deadline is None:
+        deadline = Deadline(context)
+    workers = min(max_workers or available_cpus(), len(granules))
+    mp_context = _fork_context() if workers > 1 else None
+    if mp_context is None:
+        logger = CumulusLogger()
+        logger.setMetadata(cumulus_message or {}, context)
+        return _map_in_process(function, granules, deadline, logger, kwargs)
+    # Records queued before forking would otherwise be written by each worker
+    flush_logs()
+    return _map_in_workers(mp_context, workers, function, granules, deadline,
+                           cumulus_message, context, kwargs)
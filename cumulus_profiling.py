@@ -0,0 +1,129 @@
+"""
+Opt-in profiling of sampled ``run_cumulus_task`` invocations.
+
+A sampled invocation runs the adapter phases and the task function under
+``cProfile``, and optionally takes a ``tracemalloc`` snapshot at the end.
+The artifacts are written to a local directory (``/tmp`` by default), or
+uploaded to S3, and their location is logged.  Profiles can be read with
+``pstats`` or tools such as snakeviz, and snapshots with
+``tracemalloc.Snapshot.load``.
+
+Only the thread running the invocation is profiled, so the remote message
+loading and storing that ``run_cumulus_task_async`` runs in worker threads is
+not included.  Only one invocation per process is profiled at a time: since
+Python 3.12, a second active ``cProfile`` profiler raises ``ValueError``, so
+the other records of a ``run_cumulus_task_batch`` sampled meanwhile, and
+invocations started while another profiler is active, run unprofiled.
+Memory is traced through ``cumulus_metrics.start_tracing``, so that profiling
+and metrics do not stop each other's tracing.
+"""
+import cProfile
+from contextlib import contextmanager
+from datetime import datetime, timezone
+import os
+import random
+import threading
+import tempfile
+import tracemalloc
+import uuid
+
+import cumulus_metrics
+import cumulus_remote
+
+DEFAULT_PROFILE_DIR = '/tmp'
+
+_random = random.Random()
+_profile_lock = threading.Lock()
+
+
+class InvocationProfiler:
+    """Profiles a sample of invocations and stores the artifacts.
+
+    ``rate`` is the fraction of invocations profiled, between 0 and 1.
+    Artifacts are uploaded under ``s3_uri`` if given, or written to
+    ``directory`` otherwise.
+
+    Profiling is process-wide, so only one invocation is profiled at a time:
+    a sampled invocation that starts while another is profiled, as under
+    ``run_cumulus_task_batch`` or concurrent ``run_cumulus_task_async`` calls,
+    silently runs unprofiled, and ``rate`` then overstates the fraction of
+    invocations actually profiled.
+    """
+
+    def __init__(self, rate=0.0, trace_memory=False,
+                 directory=DEFAULT_PROFILE_DIR, s3_uri=None):
+        self.rate = rate
+        self.trace_memory = trace_memory
+        self.directory = directory
+        self.s3_uri = s3_uri
+
+    def sampled(self):
+        """Returns whether to profile the next invocation."""
+        return self.rate > 0 and _random.random() < self.rate
+
+    def _store(self, name, write):
+        """Stores the artifact written to a local path by ``write``, and
+        returns its location."""
+        if not self.s3_uri:
+            path = os.path.join(self.directory, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            write(path)
+            return path
+        bucket, prefix = cumulus_remote.parse_s3_uri(self.s3_uri)
+        key = '/'.join(filter(None, (prefix, name)))
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, os.path.basename(name))
+            write(path)
+            with open(path, 'rb') as artifact:
+                cumulus_remote.s3_client().put_object(
+                    Bucket=bucket, Key=key, Body=artifact.read())
+        return f's3://{bucket}/{key}'
+
+    @contextmanager
+    def profile(self, logger, context=None):
+        """Profiles the ``with`` block if the invocation is sampled, then
+        stores the artifacts and logs their location with ``logger``, a
+        ``CumulusLogger``.  Failing to profile the block or to store the
+        artifacts is logged, not raised."""
+        if not self.sampled() or not _profile_lock.acquire(blocking=False):
+            yield
+            return
+        try:
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError:  # Another profiling tool is already active
+                logger.warn('Failed to profile the invocation', exc_info=True)
+                yield
+                return
+            if self.trace_memory:
+                cumulus_metrics.start_tracing()
+            try:
+                yield
+            finally:
+                profiler.disable()
+                snapshot = None
+                if self.trace_memory:
+                    try:
+                        snapshot = tracemalloc.take_snapshot()
+                    finally:
+                        cumulus_metrics.stop_tracing()
+                self._store_artifacts(profiler, snapshot, logger, context)
+        finally:
+            _profile_lock.release()
+
+    def _store_artifacts(self, profiler, snapshot, logger, context):
+        """Stores the profile and snapshot, and logs their location."""
+        function_name = getattr(context, 'function_name', None) or 'unknown'
+        stamp = datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S')
+        name = f'{function_name}/{stamp}-{uuid.uuid4()}'
+        try:
+            artifacts = [self._store(f'{name}.prof', profiler.dump_stats)]
+            if snapshot is not None:
+                artifacts.append(
+                    self._store(f'{name}.tracemalloc', snapshot.dump))
+        except Exception:  # pylint: disable=broad-except
+            logger.warn('Failed to store the invocation profile', exc_info=True)
+        else:
+            logger.info({'message': 'Stored the invocation profile',
+                         'profileArtifacts': artifacts})
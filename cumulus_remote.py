@@ -0,0 +1,635 @@
+"""
+Reads and writes the remote part of Cumulus Remote Messages in S3.
+
+Remote events can be read through a process-level cache of parsed events, or
+parsed lazily when they are large, and are written by streaming their JSON
+encoding into a multipart upload.  The parts of a lazily
+parsed remote event that were never parsed are copied within S3 when large
+enough, rather than uploaded again.
+
+Every request goes through a single S3 client per process (see
+``s3_client``), which tasks may share for their own S3 requests.  boto3 and
+jsonpath are only imported when a remote message is loaded or stored.
+"""
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+import hashlib
+import itertools
+import marshal
+import os
+import shutil
+import tempfile
+import threading
+import uuid
+
+import cumulus_json
+from cumulus_streaming import (
+    LazyObject, LazyView, RawJson, SpooledArray, load_lazy, parse_lazy_objects,
+    unwrap_lazy_views)
+
+MULTIPART_CHUNK_SIZE = 8 * 1024 * 1024
+# S3 limits on the size of the parts of a multipart upload, but the last one
+MULTIPART_MIN_PART_SIZE = 5 * 1024 * 1024
+MULTIPART_MAX_PART_SIZE = 5 * 1024 * 1024 * 1024
+# Containers with more items than this, or less deeply nested than this, are
+# encoded item by item
+STREAMING_CONTAINER_SIZE = 64
+STREAMING_DEPTH = 3
+S3_RETRY_MODES = ('legacy', 'standard', 'adaptive')
+DEFAULT_S3_RETRY_MODE = 'standard'
+
+
+def parse_s3_uri(uri):
+    """Returns the bucket and key prefix of an ``s3://bucket/prefix`` URI.
+
+    >>> parse_s3_uri('s3://bucket/profiles/')
+    ('bucket', 'profiles')
+    >>> parse_s3_uri('s3://bucket')
+    ('bucket', '')
+    """
+    if not uri.startswith('s3://'):
+        raise ValueError(f'Invalid S3 URI {uri}, expected s3://bucket/prefix')
+    bucket, _, prefix = uri[len('s3://'):].partition('/')
+    return bucket, prefix.strip('/')
+
+
+def _localhost_s3_url():
+    """Returns configured LOCALSTACK_HOST url or default for localstack s3"""
+    host = os.environ.get('LOCALSTACK_HOST', 'localhost')
+    return f'http://{host}:4566'
+
+
+_s3_client = None
+_s3_client_config = {'tcp_keepalive': True, 'retries': {'mode': DEFAULT_S3_RETRY_MODE}}
+_s3_client_lock = threading.Lock()
+
+
+def configure_s3_client(max_pool_connections=None, tcp_keepalive=True, max_attempts=None,
+                        retry_mode=DEFAULT_S3_RETRY_MODE, connect_timeout=None,
+                        read_timeout=None):
+    """
+    Sets the connection pool, timeouts and retry policy of the S3 client
+    returned by ``s3_client`` (see ``botocore.config.Config``); None keeps
+    botocore's default.  The client is created again, with these settings,
+    when next used if they changed.
+
+    Arguments:
+        max_pool_connections -- Optional. The number of connections kept
+            open, which bounds the number of concurrent requests
+        tcp_keepalive -- Optional. Whether to send TCP keep-alive probes on
+            idle connections, which keeps them open between invocations
+        max_attempts -- Optional. The number of attempts of a request,
+            including the first one
+        retry_mode -- Optional. ``'legacy'``, ``'standard'`` or
+            ``'adaptive'``
+        connect_timeout -- Optional. In seconds
+        read_timeout -- Optional. In seconds
+    """
+    global _s3_client, _s3_client_config  # pylint: disable=global-statement
+    if retry_mode and retry_mode not in S3_RETRY_MODES:
+        raise ValueError(
+            f'Unsupported S3 retry mode {retry_mode}, '
+            f'expected one of {", ".join(S3_RETRY_MODES)}')
+    retries = {'total_max_attempts': max_attempts, 'mode': retry_mode or None}
+    config = {'max_pool_connections': max_pool_connections,
+              'tcp_keepalive': tcp_keepalive,
+              'connect_timeout': connect_timeout,
+              'read_timeout': read_timeout,
+              'retries': {key: value for key, value in retries.items() if value}}
+    config = {key: value for key, value in config.items() if value is not None}
+    with _s3_client_lock:
+        if config != _s3_client_config:
+            _s3_client_config = config
+            _s3_client = None
+
+
+def s3_client():
+    """
+    Returns the S3 client of the process, creating it on first use, and
+    configured for localstack when ``CUMULUS_ENV`` is ``testing`` (as the
+    message adapter does).
+
+    The client, and its pool of open connections, is reused by every remote
+    message loaded or stored in the process, and tasks may use it for their
+    own S3 requests rather than creating clients of their own.  boto3 clients
+    are thread safe; a forked process creates a new one.
+    """
+    global _s3_client  # pylint: disable=global-statement
+    client = _s3_client
+    if client is None:
+        with _s3_client_lock:
+            if _s3_client is None:
+                _s3_client = _create_s3_client(_s3_client_config)
+            client = _s3_client
+    return client
+
+
+def _create_s3_client(config):
+    import boto3
+    from botocore.config import Config
+    if os.environ.get('CUMULUS_ENV') == 'testing':
+        return boto3.client(
+            service_name='s3',
+            endpoint_url=_localhost_s3_url(),
+            aws_access_key_id='my-id',
+            aws_secret_access_key='my-secret',
+            region_name='us-east-1',
+            verify=False,
+            config=Config(**config)
+        )
+    return boto3.client('s3', config=Config(**config))
+
+
+def _after_fork_in_child():
+    # The connections of the parent's client are not the child's to use
+    global _s3_client, _s3_client_lock  # pylint: disable=global-statement
+    _s3_client = None
+    _s3_client_lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+class RemoteEventCache:
+    """Bounded LRU cache of parsed remote events, keyed by S3 bucket, key and
+    ETag.
+
+    Events are stored as immutable ``marshal`` snapshots, which count towards
+    the ``max_bytes`` budget, and every ``get`` materializes a private copy,
+    so that a task mutating its event cannot corrupt the cache.  Restoring a
+    snapshot is cheaper than downloading and parsing the JSON document again.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, bucket, key, etag):
+        """Returns a copy of the cached event, or None."""
+        with self._lock:
+            snapshot = self._entries.get((bucket, key, etag))
+            if snapshot is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end((bucket, key, etag))
+            self.hits += 1
+        return marshal.loads(snapshot)
+
+    def put(self, bucket, key, etag, event):
+        """Caches ``event``, evicting the least recently used events to stay
+        within budget.  Events larger than the whole budget are not cached."""
+        try:
+            snapshot = marshal.dumps(event)
+        except ValueError:
+            return
+        if len(snapshot) > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop((bucket, key, etag), None)
+            if previous is not None:
+                self.size -= len(previous)
+            self._entries[(bucket, key, etag)] = snapshot
+            self.size += len(snapshot)
+            while self.size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+
+_remote_event_cache = None
+
+
+def configure_remote_event_cache(max_bytes):
+    """Enables the process-level remote event cache with a budget of
+    ``max_bytes``, or disables it when ``max_bytes`` is falsy.  Returns the
+    cache, or None."""
+    global _remote_event_cache  # pylint: disable=global-statement
+    if not max_bytes:
+        _remote_event_cache = None
+    elif _remote_event_cache is None or _remote_event_cache.max_bytes != max_bytes:
+        _remote_event_cache = RemoteEventCache(max_bytes)
+    return _remote_event_cache
+
+
+def remote_event_cache():
+    """Returns the process-level remote event cache, or None if disabled."""
+    return _remote_event_cache
+
+
+_lazy_parse_bytes = 0
+
+
+def set_lazy_parse_bytes(min_bytes):
+    """Parses remote events of at least ``min_bytes`` bytes (as stored)
+    lazily, or none when ``min_bytes`` is falsy."""
+    global _lazy_parse_bytes  # pylint: disable=global-statement
+    _lazy_parse_bytes = min_bytes or 0
+
+
+def _spool(body):
+    """Copies the remote event read from ``body`` to a temporary file."""
+    spool = tempfile.TemporaryFile()  # pylint: disable=consider-using-with
+    try:
+        shutil.copyfileobj(body, spool, MULTIPART_CHUNK_SIZE)
+    except Exception:
+        spool.close()
+        raise
+    spool.seek(0)
+    return spool
+
+
+def fetch_remote_event(bucket, key, cache=None):
+    """Downloads and parses the remote event stored at ``bucket``/``key``,
+    consulting ``cache`` first when given.
+
+    Remote events of at least the size set by ``set_lazy_parse_bytes`` are
+    spooled to a temporary file and parsed lazily (see
+    ``cumulus_streaming.LazyObject``), and are not cached.  Their parts are
+    tagged with the object they were read from, so that storing them again
+    copies them within S3.
+    """
+    client = s3_client()
+    if cache is not None:
+        etag = client.head_object(Bucket=bucket, Key=key)['ETag']
+        remote_event = cache.get(bucket, key, etag)
+        if remote_event is not None:
+            return remote_event
+
+    data = client.get_object(Bucket=bucket, Key=key)
+    if _lazy_parse_bytes and data.get('ContentLength', 0) >= _lazy_parse_bytes:
+        return load_lazy(_spool(data['Body']),
+                         {'Bucket': bucket, 'Key': key, 'ETag': data['ETag']})
+    remote_event = cumulus_json.loads(data['Body'].read())
+    if cache is not None:
+        cache.put(bucket, key, data['ETag'], remote_event)
+    return remote_event
+
+
+def load_remote_event(event, cache=None):
+    """
+    Given a Cumulus message, checks for a 'replace' key and fetches a remote
+    stored object from S3 and inserts it into the configured path.  Equivalent
+    to ``message_adapter.cumulus_message.load_remote_event``.
+
+    Arguments:
+        event -- An event in the Cumulus message format, updated in place
+        cache -- Optional. A ``RemoteEventCache``; defaults to the
+            process-level cache, if enabled
+    """
+    if 'replace' not in event:
+        return event
+    from jsonpath_ng import parse
+
+    if cache is None:
+        cache = _remote_event_cache
+    local_exception = event.get('exception', None)
+    remote_event = fetch_remote_event(
+        event['replace']['Bucket'], event['replace']['Key'], cache)
+    target_json_path = event['replace']['TargetPath']
+    parsed_json_path = parse(target_json_path)
+    replacement_targets = parsed_json_path.find(event)
+    if not replacement_targets or len(replacement_targets) != 1:
+        raise ValueError(f'Remote event configuration target {target_json_path} invalid')
+    try:
+        replacement_targets[0].value.update(remote_event)
+    except AttributeError:
+        parsed_json_path.update(event, remote_event)
+
+    event.pop('replace')
+    exception_bool = (local_exception and local_exception != 'None')
+    if exception_bool and (not event['exception'] or event['exception'] == 'None'):
+        event['exception'] = local_exception
+    return event
+
+
+# The separators of ``json.dumps``, which every stored JSON document uses
+ITEM_SEPARATOR = ', '
+KEY_SEPARATOR = ': '
+
+
+def _encode_key(key):
+    # Non-string keys (e.g. the indexes of meta.workflow_tasks) are converted
+    # the same way the encoder converts them
+    if isinstance(key, str):
+        return cumulus_json.dumps(key)
+    return cumulus_json.dumps({key: 0})[1:-len(KEY_SEPARATOR) - 2]
+
+
+def _utf8_size(text):
+    return len(text) if text.isascii() else len(text.encode('utf-8'))
+
+
+def iter_json(value, depth=0):
+    """Yields the JSON encoding of ``value`` in chunks, without holding all
+    of it in memory.  The chunks add up to ``json.dumps(value)``.
+
+    The top levels of the document, and large dicts and lists at any level,
+    are encoded item by item; everything else is encoded by the codec.
+    Arrays spilled to disk by ``SpooledArray`` are read back in chunks.  The
+    members of a ``LazyObject`` that are not parsed yet are copied as they
+    are stored.
+    """
+    return _iter_json(value, depth)
+
+
+def _iter_json(value, depth=0, raw_sources=False):
+    # With ``raw_sources``, the members of lazy objects read from S3 are
+    # yielded as ``RawJson`` rather than as text
+    if isinstance(value, SpooledArray):
+        if value.spilled:
+            yield from value.iter_encoded()
+            return
+        value = value.to_list()
+    if isinstance(value, LazyView):
+        value = unwrap_lazy_views(value)
+    if isinstance(value, LazyObject) and not value.parsed:
+        yield '{'
+        for index, (key, item, raw) in enumerate(value.raw_items()):
+            yield (ITEM_SEPARATOR if index else '') + _encode_key(key) + KEY_SEPARATOR
+            if raw is None:
+                yield from _iter_json(item, depth + 1, raw_sources)
+            elif raw_sources and raw.source is not None:
+                yield raw
+            else:
+                yield from raw
+        yield '}'
+        return
+    streamed = depth < STREAMING_DEPTH
+    if isinstance(value, dict) and (streamed or len(value) > STREAMING_CONTAINER_SIZE):
+        yield '{'
+        for index, (key, item) in enumerate(value.items()):
+            yield (ITEM_SEPARATOR if index else '') + _encode_key(key) + KEY_SEPARATOR
+            yield from _iter_json(item, depth + 1, raw_sources)
+        yield '}'
+    elif (isinstance(value, (list, tuple))
+          and (streamed or len(value) > STREAMING_CONTAINER_SIZE)):
+        yield '['
+        for index, item in enumerate(value):
+            if index:
+                yield ITEM_SEPARATOR
+            yield from _iter_json(item, depth + 1, raw_sources)
+        yield ']'
+    else:
+        # Lazy objects held deeper than the streamed levels are parsed first
+        yield cumulus_json.dumps(parse_lazy_objects(value))
+
+
+def json_size(value):
+    """Returns the size in bytes of ``json.dumps(value)`` encoded as UTF-8,
+    which is how the message adapter measures messages."""
+    return sum(_utf8_size(chunk) for chunk in iter_json(value))
+
+
+def _encode_if_larger(value, max_size):
+    """
+    Returns None if ``json_size(value)`` is less than ``max_size``, and the
+    JSON encoding of ``value`` in chunks otherwise, encoding every part of
+    ``value`` once: measuring stops as soon as ``max_size`` is reached, and
+    the chunks encoded until then are the first ones returned.  All the
+    chunks are those of ``iter_json``, so what is uploaded is the document
+    that was measured.
+
+    The members of lazy objects read from S3 are returned as ``RawJson``
+    (see ``S3StreamWriter.copy``).
+    """
+    chunks = _iter_json(value, raw_sources=True)
+    encoded = []
+    size = 0
+    for chunk in chunks:
+        encoded.append(chunk)
+        size += chunk.size if isinstance(chunk, RawJson) else _utf8_size(chunk)
+        if size >= max_size:
+            return itertools.chain(encoded, chunks)
+    return None
+
+
+class S3StreamWriter:
+    """File-like object that uploads what is written to it to S3, in a
+    multipart upload once more than ``chunk_size`` bytes have been written,
+    or in a single request otherwise."""
+
+    def __init__(self, client, bucket, key, chunk_size=None, **params):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.chunk_size = chunk_size or MULTIPART_CHUNK_SIZE
+        self.params = params
+        self.upload_id = None
+        self.parts = []
+        self._buffer = bytearray()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._buffer += data
+        if len(self._buffer) >= self.chunk_size:
+            self._upload_part()
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def _create_upload(self):
+        if self.upload_id is None:
+            self.upload_id = self.client.create_multipart_upload(
+                Bucket=self.bucket, Key=self.key, **self.params)['UploadId']
+
+    def _upload_part(self):
+        self._create_upload()
+        part_number = len(self.parts) + 1
+        response = self.client.upload_part(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+            PartNumber=part_number, Body=bytes(self._buffer))
+        self.parts.append({'ETag': response['ETag'], 'PartNumber': part_number})
+        self._buffer = bytearray()
+
+    def copy(self, raw):
+        """
+        Writes the ``RawJson`` ``raw``, copying it from the S3 object it was
+        read from, as parts of the multipart upload, when it is large enough.
+
+        Every part but the last must be at least ``MULTIPART_MIN_PART_SIZE``:
+        what was written before is topped up with the start of ``raw`` to
+        make a part, and the rest is copied if still large enough.
+        """
+        top_up = max(MULTIPART_MIN_PART_SIZE - len(self._buffer), 0) if self._buffer else 0
+        if raw.source is None or raw.size - top_up < MULTIPART_MIN_PART_SIZE:
+            for chunk in raw.iter_bytes():
+                self.write(chunk)
+            return
+        start = raw.start + top_up
+        self._buffer += raw.buffer[raw.start:start]
+        if self._buffer:
+            self._upload_part()
+        self._create_upload()
+        source = {'Bucket': raw.source['Bucket'], 'Key': raw.source['Key']}
+        count = -(-(raw.end - start) // MULTIPART_MAX_PART_SIZE)
+        for index in range(count):
+            end = start + (raw.end - start) // (count - index)
+            part_number = len(self.parts) + 1
+            response = self.client.upload_part_copy(
+                Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                PartNumber=part_number, CopySource=source,
+                CopySourceRange=f'bytes={start}-{end - 1}',
+                CopySourceIfMatch=raw.source['ETag'])
+            self.parts.append({'ETag': response['CopyPartResult']['ETag'],
+                               'PartNumber': part_number})
+            start = end
+
+    def close(self):
+        """Completes the upload."""
+        if self.upload_id is None:
+            self.client.put_object(Bucket=self.bucket, Key=self.key,
+                                   Body=bytes(self._buffer), **self.params)
+            return
+        if self._buffer:
+            self._upload_part()
+        self.client.complete_multipart_upload(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+            MultipartUpload={'Parts': self.parts})
+
+    def abort(self):
+        """Aborts a multipart upload in progress."""
+        if self.upload_id is not None:
+            self.client.abort_multipart_upload(
+                Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+
+
+def upload_json(value, bucket, key, client=None, **params):
+    """Streams ``json.dumps(value)`` to S3."""
+    _upload_chunks(_iter_json(value, raw_sources=True), bucket, key, client, **params)
+
+
+def _upload_chunks(chunks, bucket, key, client=None, **params):
+    """Streams the JSON text ``chunks``, strings or ``RawJson``, to S3."""
+    if client is None:
+        client = s3_client()
+    writer = S3StreamWriter(client, bucket, key, ContentType='application/json', **params)
+    try:
+        buffer = []
+        buffered = 0
+        for chunk in chunks:
+            if isinstance(chunk, RawJson):
+                writer.write(''.join(buffer).encode('utf-8'))
+                buffer, buffered = [], 0
+                writer.copy(chunk)
+                continue
+            buffer.append(chunk)
+            buffered += len(chunk)
+            if buffered >= 64 * 1024:
+                writer.write(''.join(buffer).encode('utf-8'))
+                buffer, buffered = [], 0
+        writer.write(''.join(buffer).encode('utf-8'))
+        writer.close()
+    except Exception:
+        writer.abort()
+        raise
+
+
+def store_remote_response(event, default_max_size, config_keys):
+    """
+    Stores part of a response message in S3 if it is too big to send to
+    StepFunctions, streaming its JSON encoding.  Equivalent to
+    ``message_adapter.cumulus_message.store_remote_response``, except that
+    ``event`` is updated in place rather than copied.
+
+    Arguments:
+        event -- The response message
+        default_max_size -- The maximum size (in bytes) a response message
+            portion can be before the method will store it in s3
+        config_keys -- A list of valid CMA configuration keys
+    """
+    replace_config = event.get('ReplaceConfig', None)
+    if not replace_config:
+        return event
+    from jsonpath_ng import parse
+
+    # Set default value if FullMessage flag set
+    if replace_config.get('FullMessage', False):
+        replace_config['Path'] = '$'
+
+    source_path = replace_config['Path']
+    target_path = replace_config.get('TargetPath', replace_config['Path'])
+    max_size = replace_config.get('MaxSize', default_max_size)
+    parsed_json_path = parse(source_path)
+
+    for key in config_keys:
+        if event.get(key):
+            del event[key]
+
+    cumulus_meta = event['cumulus_meta']
+    replacement_data = parsed_json_path.find(event)
+    if len(replacement_data) != 1:
+        raise ValueError(f'JSON path invalid: {parsed_json_path}')
+    replacement_data = replacement_data[0]
+
+    # Measured and encoded for the upload in a single pass
+    chunks = _encode_if_larger(replacement_data.value, max_size)
+    if chunks is None:
+        return event
+
+    s3_bucket = event['cumulus_meta']['system_bucket']
+    s3_key = '/'.join(['events', str(uuid.uuid4())])
+    _upload_chunks(chunks, s3_bucket, s3_key,
+                   Expires=datetime.now(timezone.utc) + timedelta(days=7))  # Expire in a week
+
+    try:
+        replacement_data.value.clear()
+    except AttributeError:
+        parsed_json_path.update(event, '')
+
+    event['cumulus_meta'] = event.get('cumulus_meta', cumulus_meta)
+    event['replace'] = {'Bucket': s3_bucket, 'Key': s3_key, 'TargetPath': target_path}
+    return event
+
+
+def checkpoint_location(message):
+    """
+    Returns the ``Bucket`` and ``Key`` where the checkpoint of a task invoked
+    with the Cumulus message ``message`` is stored, or None if the message has
+    no ``cumulus_meta.system_bucket``.  The key is a digest of the message,
+    which Step Functions passes unchanged to every attempt of a task.
+    """
+    bucket = (message.get('cumulus_meta') or {}).get('system_bucket')
+    if not bucket:
+        return None
+    digest = hashlib.sha256(cumulus_json.dumpb_compact(message)).hexdigest()
+    return {'Bucket': bucket, 'Key': '/'.join(['checkpoints', digest])}
+
+
+def save_checkpoint(checkpoint, location):
+    """Stores ``checkpoint`` at ``location`` (see ``checkpoint_location``)."""
+    upload_json(checkpoint, location['Bucket'], location['Key'],
+                Expires=datetime.now(timezone.utc) + timedelta(days=7))
+
+
+def find_checkpoint(location):
+    """Returns the checkpoint stored at ``location`` by ``save_checkpoint``,
+    or None if there is none."""
+    try:
+        data = s3_client().get_object(Bucket=location['Bucket'], Key=location['Key'])
+    except Exception as error:  # pylint: disable=broad-except
+        code = getattr(error, 'response', {}).get('Error', {}).get('Code')
+        # Without s3:ListBucket, S3 answers 403 rather than 404 for a missing key
+        if code in ('NoSuchKey', '404', 'AccessDenied', '403'):
+            return None
+        raise
+    return cumulus_json.loads(data['Body'].read())
+
+
+def delete_checkpoint(location):
+    """Deletes the checkpoint stored at ``location`` by ``save_checkpoint``."""
+    s3_client().delete_object(Bucket=location['Bucket'], Key=location['Key'])
@@ -0,0 +1,371 @@
+"""
+Compiles the JSON schemas of a task into Python functions that tell whether
+a document is valid, as an opt-in alternative to the interpreting validators
+of jsonschema (``CUMULUS_SCHEMA_VALIDATION=compiled``).
+
+The generated code checks what jsonschema would check, keyword by keyword,
+for drafts 4 to 2020-12, but only answers valid or invalid: the message
+adapter validates invalid documents again with jsonschema, so that errors are
+reported exactly as before.  A compiled function may therefore be stricter
+than jsonschema (which only costs time) but never more lenient.  Schemas
+using keywords that are not compiled (e.g. ``dependencies``, ``contains``,
+``unevaluatedProperties``, remote or anchored ``$ref``\\ s) are left to
+jsonschema.
+
+With ``sample_items``, only the first items of each array are checked
+against ``items``, which trades completeness for speed on large arrays.
+"""
+from collections.abc import Sequence
+from fractions import Fraction
+import itertools
+import numbers
+import re
+from urllib.parse import unquote
+
+ENGINES = ('jsonschema', 'compiled')
+
+_engine = 'jsonschema'
+_sample_items = 0
+
+
+def set_validation_engine(engine=None, sample_items=0):
+    """Sets how schemas are validated: ``'jsonschema'`` (the default) or
+    ``'compiled'``, checking only the first ``sample_items`` items of arrays
+    when set."""
+    global _engine, _sample_items  # pylint: disable=global-statement
+    engine = engine or 'jsonschema'
+    if engine not in ENGINES:
+        raise ValueError(
+            f'Unsupported schema validation engine {engine}, '
+            f'expected one of {", ".join(ENGINES)}')
+    _engine = engine
+    _sample_items = sample_items or 0
+
+
+def validation_engine():
+    """Returns the engine and ``sample_items`` set by
+    ``set_validation_engine``."""
+    return _engine, _sample_items
+
+
+class UnsupportedSchema(Exception):
+    """Raised for schemas that are not compiled."""
+
+
+# Runtime helpers of the generated code, mirroring ``jsonschema._utils``
+
+
+def _keyword_check(validator_class, keyword):
+    """Returns a function telling whether a document satisfies ``keyword``
+    with a given value, as checked by the implementation of the keyword in
+    the installed jsonschema itself.  Used for ``enum`` and ``const``, whose
+    rules for comparing booleans and numbers change between versions."""
+    check = validator_class.VALIDATORS[keyword]
+    validator = validator_class({})
+    return lambda value, document: next(check(validator, value, document, {}), None) is None
+
+
+def _freeze(value):
+    """Returns a hashable key of ``value``; values that jsonschema deems
+    equal have equal keys."""
+    if isinstance(value, bool):
+        return (bool, value)
+    if isinstance(value, str):
+        return (str, value)
+    if isinstance(value, list):
+        return (list, tuple(map(_freeze, value)))
+    if isinstance(value, dict):
+        return (dict, frozenset((key, _freeze(item)) for key, item in value.items()))
+    return (None, value)
+
+
+def _unique(values):
+    try:
+        keys = [_freeze(value) for value in values]
+        return len(set(keys)) == len(keys)
+    except TypeError:  # Unhashable: reported invalid, and checked by jsonschema
+        return False
+
+
+def _not_multiple(value, divisor):
+    if isinstance(divisor, float):
+        quotient = value / divisor
+        try:
+            return int(quotient) != quotient
+        except OverflowError:
+            return (Fraction(value) / Fraction(divisor)).denominator != 1
+    return value % divisor
+
+
+_HELPERS = {
+    '_Number': numbers.Number, '_islice': itertools.islice,
+    '_unique': _unique, '_not_multiple': _not_multiple,
+}
+_TYPE_CHECKS = {
+    'object': 'isinstance(x, dict)',
+    'array': 'isinstance(x, list)',
+    'string': 'isinstance(x, str)',
+    'boolean': 'isinstance(x, bool)',
+    'null': 'x is None',
+    'number': '(isinstance(x, _Number) and not isinstance(x, bool))',
+    'integer': '(isinstance(x, int) and not isinstance(x, bool))',
+}
+_FLOAT_INTEGER_CHECK = ('(isinstance(x, int) and not isinstance(x, bool)'
+                        ' or isinstance(x, float) and x.is_integer())')
+# Keywords that only matter to the keywords that read them, or not at all
+_HANDLED = frozenset((
+    'type', 'enum', 'const', 'allOf', 'anyOf', 'oneOf', 'not', 'if', '$ref', 'format',
+    'properties', 'patternProperties', 'additionalProperties', 'required',
+    'minProperties', 'maxProperties', 'items', 'minItems', 'maxItems', 'uniqueItems',
+    'minLength', 'maxLength', 'pattern', 'minimum', 'maximum', 'exclusiveMinimum',
+    'exclusiveMaximum', 'multipleOf',
+))
+_LENGTH_CHECKS = {'minProperties': '<', 'maxProperties': '>', 'minItems': '<',
+                  'maxItems': '>', 'minLength': '<', 'maxLength': '>'}
+
+
+def _has_scopes(schema, root=True):
+    """Whether ``schema`` holds identifiers or anchors that ``$ref``\\ s may
+    resolve to, which are not compiled."""
+    if isinstance(schema, dict):
+        if not root and any(isinstance(schema.get(key), str) for key in ('id', '$id')):
+            return True
+        if '$anchor' in schema or '$dynamicAnchor' in schema:
+            return True
+        return any(_has_scopes(value, False) for value in schema.values())
+    if isinstance(schema, list):
+        return any(_has_scopes(value, False) for value in schema)
+    return False
+
+
+class _Compiler:
+    def __init__(self, root, keywords, draft, sample_items):
+        self.root = root
+        self.keywords = keywords
+        self.draft = draft
+        self.sample_items = sample_items
+        self.functions = {}
+        self.trivial = set()
+        self.sources = []
+        self.namespace = dict(_HELPERS)
+
+    def constant(self, value):
+        name = f'_c{len(self.namespace)}'
+        self.namespace[name] = value
+        return name
+
+    def regex(self, pattern):
+        return self.constant(re.compile(pattern))
+
+    def resolve(self, ref):
+        if not ref.startswith('#'):
+            raise UnsupportedSchema(f'$ref {ref}')
+        fragment = ref[1:].lstrip('/')
+        document = self.root
+        for part in unquote(fragment).split('/') if fragment else []:
+            part = part.replace('~1', '/').replace('~0', '~')
+            if isinstance(document, Sequence):
+                try:
+                    part = int(part)
+                except ValueError:
+                    pass
+            try:
+                document = document[part]
+            except (TypeError, LookupError) as exception:
+                raise UnsupportedSchema(f'$ref {ref}') from exception
+        return document
+
+    def call(self, schema, value='x'):
+        """Returns the expression checking ``value`` against ``schema``, or
+        None if any value is valid."""
+        name = self.function(schema)
+        return None if name in self.trivial else f'{name}({value})'
+
+    def function(self, schema):
+        key = id(schema)
+        if key in self.functions:
+            return self.functions[key][0]
+        name = f'_v{len(self.functions)}'
+        # Keeps ``schema`` alive so that its id is not reused
+        self.functions[key] = (name, schema)
+        lines = self.body(schema)
+        if not lines:
+            self.trivial.add(name)
+        self.sources.append('\n'.join(
+            [f'def {name}(x):'] + ['    ' + line for line in lines] + ['    return True']))
+        return name
+
+    def body(self, schema):
+        if schema is True:
+            return []
+        if schema is False:
+            return ['return False']
+        if not isinstance(schema, dict):
+            raise UnsupportedSchema(f'schema {schema!r}')
+        if '$ref' in schema and self.draft < 2019:
+            # Siblings of $ref are ignored up to draft 7
+            schema = {'$ref': schema['$ref']}
+        unsupported = [keyword for keyword in schema
+                       if keyword in self.keywords and keyword not in _HANDLED]
+        if unsupported:
+            raise UnsupportedSchema(', '.join(unsupported))
+
+        lines = self.type_lines(schema) + self.generic_lines(schema)
+        for type_check, block in (
+                (_TYPE_CHECKS['object'], self.object_lines(schema)),
+                (_TYPE_CHECKS['array'], self.array_lines(schema)),
+                (_TYPE_CHECKS['string'], self.string_lines(schema)),
+                (_TYPE_CHECKS['number'], self.number_lines(schema))):
+            if block:
+                lines.append(f'if {type_check}:')
+                lines.extend('    ' + line for line in block)
+        return lines
+
+    def type_lines(self, schema):
+        if 'type' not in schema:
+            return []
+        types = schema['type'] if isinstance(schema['type'], list) else [schema['type']]
+        checks = []
+        for type_name in types:
+            if type_name not in _TYPE_CHECKS:
+                raise UnsupportedSchema(f'type {type_name!r}')
+            if type_name == 'integer' and self.draft >= 6:
+                checks.append(_FLOAT_INTEGER_CHECK)
+            else:
+                checks.append(_TYPE_CHECKS[type_name])
+        return [f'if not ({" or ".join(checks) or "False"}):', '    return False']
+
+    def generic_lines(self, schema):
+        lines = []
+        if '$ref' in schema:
+            check = self.call(self.resolve(schema['$ref']))
+            if check:
+                lines += [f'if not {check}:', '    return False']
+        if 'enum' in schema:
+            lines += [f'if not _enum({self.constant(schema["enum"])}, x):',
+                      '    return False']
+        if 'const' in schema and 'const' in self.keywords:
+            lines += [f'if not _const({self.constant(schema["const"])}, x):',
+                      '    return False']
+        for subschema in schema.get('allOf', ()):
+            check = self.call(subschema)
+            if check:
+                lines += [f'if not {check}:', '    return False']
+        if 'anyOf' in schema:
+            checks = [self.call(subschema) for subschema in schema['anyOf']]
+            if None not in checks:
+                lines += [f'if not ({" or ".join(checks) or "False"}):', '    return False']
+        if 'oneOf' in schema:
+            checks = [self.call(subschema) or 'True' for subschema in schema['oneOf']]
+            lines += [f'if [{", ".join(checks)}].count(True) != 1:', '    return False']
+        if 'not' in schema:
+            check = self.call(schema['not']) or 'True'
+            lines += [f'if {check}:', '    return False']
+        if 'if' in schema and 'if' in self.keywords:
+            condition = self.call(schema['if']) or 'True'
+            then = self.call(schema['then']) if 'then' in schema else None
+            otherwise = self.call(schema['else']) if 'else' in schema else None
+            if then or otherwise:
+                lines.append(f'if {condition}:')
+                lines += [f'    if not {then}:', '        return False'] if then else ['    pass']
+                if otherwise:
+                    lines += ['else:', f'    if not {otherwise}:', '        return False']
+        return lines
+
+    def length_lines(self, schema, keywords):
+        return [line for keyword in keywords if keyword in schema
+                for line in (f'if len(x) {_LENGTH_CHECKS[keyword]} {schema[keyword]!r}:',
+                             '    return False')]
+
+    def object_lines(self, schema):
+        lines = [line for name in schema.get('required', ())
+                 for line in (f'if {name!r} not in x:', '    return False')]
+        lines += self.length_lines(schema, ('minProperties', 'maxProperties'))
+        properties = schema.get('properties', {})
+        for name, subschema in properties.items():
+            check = self.call(subschema, f'x[{name!r}]')
+            if check:
+                lines += [f'if {name!r} in x and not {check}:', '    return False']
+        patterns = schema.get('patternProperties', {})
+        for pattern, subschema in patterns.items():
+            check = self.call(subschema, 'v')
+            if check:
+                lines += ['for k, v in x.items():',
+                          f'    if {self.regex(pattern)}.search(k) and not {check}:',
+                          '        return False']
+        additional = schema.get('additionalProperties', True)
+        check = self.call(additional, 'v') if isinstance(additional, dict) else (
+            None if additional else 'False')
+        if check:
+            condition = f'k not in {self.constant(frozenset(properties))}'
+            if patterns:
+                condition += f' and not {self.regex("|".join(patterns))}.search(k)'
+            lines += ['for k, v in x.items():',
+                      f'    if {condition} and not {check}:', '        return False']
+        return lines
+
+    def array_lines(self, schema):
+        lines = self.length_lines(schema, ('minItems', 'maxItems'))
+        if schema.get('uniqueItems'):
+            lines += ['if not _unique(x):', '    return False']
+        if 'items' in schema:
+            if isinstance(schema['items'], list):
+                raise UnsupportedSchema('items array')
+            check = self.call(schema['items'], 'item')
+            if check:
+                items = f'_islice(x, {self.sample_items})' if self.sample_items else 'x'
+                lines += [f'for item in {items}:', f'    if not {check}:',
+                          '        return False']
+        return lines
+
+    def string_lines(self, schema):
+        lines = self.length_lines(schema, ('minLength', 'maxLength'))
+        if 'pattern' in schema:
+            lines += [f'if not {self.regex(schema["pattern"])}.search(x):', '    return False']
+        return lines
+
+    def number_lines(self, schema):
+        lines = []
+        for keyword, exclusive, operator in (('minimum', 'exclusiveMinimum', '<'),
+                                             ('maximum', 'exclusiveMaximum', '>')):
+            if self.draft == 4:
+                if keyword in schema:
+                    operator += '=' if schema.get(exclusive, False) else ''
+                    lines += [f'if x {operator} {schema[keyword]!r}:', '    return False']
+                continue
+            if keyword in schema:
+                lines += [f'if x {operator} {schema[keyword]!r}:', '    return False']
+            if exclusive in schema:
+                lines += [f'if x {operator}= {schema[exclusive]!r}:', '    return False']
+        if 'multipleOf' in schema:
+            lines += [f'if _not_multiple(x, {schema["multipleOf"]!r}):', '    return False']
+        return lines
+
+
+def compile_schema(schema, validator_class, sample_items=0):
+    """
+    Returns a function telling whether a document is valid against
+    ``schema``, as ``validator_class`` (a jsonschema validator class) would
+    validate it, or None if the schema cannot be compiled.  The generated
+    source code is available as the ``source`` attribute of the function.
+    """
+    from jsonschema import validators
+    drafts = {validators.Draft4Validator: 4, validators.Draft6Validator: 6,
+              validators.Draft7Validator: 7, validators.Draft201909Validator: 2019,
+              validators.Draft202012Validator: 2020}
+    draft = drafts.get(validator_class)
+    if draft is None or _has_scopes(schema):
+        return None
+    compiler = _Compiler(schema, frozenset(validator_class.VALIDATORS), draft, sample_items)
+    try:
+        name = compiler.function(schema)
+    except UnsupportedSchema:
+        return None
+    source = '\n\n'.join(compiler.sources)
+    compiler.namespace['_enum'] = _keyword_check(validator_class, 'enum')
+    if 'const' in compiler.keywords:
+        compiler.namespace['_const'] = _keyword_check(validator_class, 'const')
+    exec(compile(source, '<schema>', 'exec'), compiler.namespace)  # pylint: disable=exec-used
+    function = compiler.namespace[name]
+    function.source = source
+    return function
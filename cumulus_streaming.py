@@ -0,0 +1,589 @@
+"""
+Streaming of task outputs that are produced incrementally, and lazy parsing
+of large remote inputs.
+
+A task function may return an iterator (such as a generator) of items rather
+than a list, or a dict some of whose values are iterators, e.g.
+``{'granules': discover_granules()}``.  The message adapter consumes each
+iterator into a ``SpooledArray``, validating the items one at a time, so that
+the task never holds the whole list.
+
+A ``SpooledArray`` keeps its items in memory up to a budget, and then spills
+their JSON encoding to a temporary file (in ``/tmp`` on Lambda).  When the
+outgoing message stores the array in S3 (see ``ReplaceConfig``), the spilled
+items are uploaded straight from the file; otherwise they are read back into
+a list.
+
+Large remote events may instead be spooled to a temporary file, which is
+memory-mapped, and parsed lazily (see ``load_lazy``): each JSON object of at
+least ``LAZY_OBJECT_BYTES`` is a ``LazyObject``, whose members are only parsed
+when they are first accessed.  Objects that are never accessed are never
+parsed, and are copied as they are when the outgoing message is stored in S3.
+Tasks are given read-only ``LazyView`` mappings of them, which parse each
+member when the task first accesses it.
+"""
+from collections.abc import ItemsView, Iterator, KeysView, Mapping, ValuesView
+import codecs
+from copy import copy, deepcopy
+import mmap
+import re
+import tempfile
+import weakref
+
+import cumulus_json
+
+DEFAULT_MEMORY_BUDGET = 32 * 1024 * 1024
+READ_CHUNK_SIZE = 64 * 1024
+LAZY_OBJECT_BYTES = 256 * 1024
+# The item separator of ``json.dumps``, used between spilled items
+ITEM_SEPARATOR = b', '
+
+_WHITESPACE = re.compile(rb'[ \t\n\r]*')
+# Possessive quantifiers keep the regex engine from saving a backtracking
+# state per string, which would take memory in proportion to the document
+_STRING = re.compile(rb'"[^"\\]*+(?:\\.[^"\\]*+)*+"')
+_SCALAR = re.compile(rb'[^,}\]\s]*')
+# Anything up to the next bracket that is not within a string
+_SKIP = re.compile(rb'[^"\[\]{}]*+(?:"[^"\\]*+(?:\\.[^"\\]*+)*+"[^"\[\]{}]*+)*+')
+
+_memory_budget = DEFAULT_MEMORY_BUDGET
+
+
+def set_memory_budget(budget):
+    """Sets the number of bytes of encoded items a ``SpooledArray`` holds in
+    memory before spilling them to disk, or the default when falsy."""
+    global _memory_budget  # pylint: disable=global-statement
+    _memory_budget = budget or DEFAULT_MEMORY_BUDGET
+
+
+def is_stream(value):
+    """Returns whether ``value`` is an iterator that should be spooled.
+
+    >>> is_stream(iter([1])), is_stream(x for x in 'ab'), is_stream([1])
+    (True, True, False)
+    """
+    return isinstance(value, Iterator)
+
+
+def has_streams(response):
+    """Returns whether ``response`` is, or is a dict holding, an iterator."""
+    if is_stream(response):
+        return True
+    # dict.values does not parse the members of a LazyObject
+    return isinstance(response, dict) and any(map(is_stream, dict.values(response)))
+
+
+class SpooledArray:
+    """JSON array of the items of an iterator, held in memory up to ``budget``
+    bytes of encoded items, and in a temporary file in ``directory`` beyond.
+
+    ``validate``, if given, is called with each item and its index as the
+    iterator is consumed.
+    """
+
+    def __init__(self, items, validate=None, budget=None, directory=None):
+        self.budget = _memory_budget if budget is None else budget
+        self.directory = directory
+        # Size of the JSON encoding (that of ``json.dumps``), brackets included
+        self.size = 2
+        self._items = []
+        self._count = 0
+        self._file = None
+        try:
+            for index, item in enumerate(items):
+                if validate is not None:
+                    validate(item, index)
+                self._append(item)
+        except BaseException:
+            self.close()
+            raise
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def spilled(self):
+        """Whether the items were spilled to disk."""
+        return self._file is not None
+
+    def _append(self, item):
+        encoded = cumulus_json.dumpb(item)
+        self.size += len(encoded) + (len(ITEM_SEPARATOR) if self._count else 0)
+        self._count += 1
+        if self._file is not None:
+            # The file always holds at least one item
+            self._file.write(ITEM_SEPARATOR + encoded)
+            return
+        self._items.append(item)
+        if self.size > self.budget:
+            self._spill()
+
+    def _spill(self):
+        # pylint: disable-next=consider-using-with
+        self._file = tempfile.TemporaryFile(dir=self.directory)
+        for index, item in enumerate(self._items):
+            self._file.write((ITEM_SEPARATOR if index else b'') + cumulus_json.dumpb(item))
+        self._items = []
+
+    def iter_encoded(self):
+        """Yields the JSON encoding of the array, that of ``json.dumps``, in
+        chunks."""
+        if self._file is None:
+            yield cumulus_json.dumps(self._items)
+            return
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        self._file.seek(0)
+        yield '['
+        while True:
+            chunk = self._file.read(READ_CHUNK_SIZE)
+            if not chunk:
+                break
+            yield decoder.decode(chunk)
+        yield decoder.decode(b'', final=True) + ']'
+
+    def to_list(self):
+        """Returns the items as a list, reading them back from disk if they
+        were spilled."""
+        if self._file is None:
+            return self._items
+        self._file.seek(0)
+        return cumulus_json.loads(b'[' + self._file.read() + b']')
+
+    def clear(self):
+        """Discards the items, as ``list.clear`` would."""
+        self.close()
+        self._items = []
+        self._count = 0
+        self.size = 2
+
+    def close(self):
+        """Deletes the spill file, if any."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def materialize(value):
+    """Replaces the ``SpooledArray`` ``value``, or those held by the dict
+    ``value``, by lists."""
+    if isinstance(value, SpooledArray):
+        return value.to_list()
+    if isinstance(value, dict):
+        for key, item in value.items():
+            if isinstance(item, SpooledArray):
+                value[key] = item.to_list()
+    return value
+
+
+def _skip_value(buffer, position):
+    """Returns the end of the JSON value starting at ``position``.
+
+    >>> _skip_value(b'{"a": ["}", {"b": 1}], "c": 2}', 0)
+    30
+    >>> _skip_value(b'[1, 2] ', 0), _skip_value(b'"a\\\\"b"', 0), _skip_value(b'12,', 0)
+    (6, 6, 2)
+    """
+    char = buffer[position:position + 1]
+    if char == b'"':
+        return _STRING.match(buffer, position).end()
+    if char not in (b'{', b'['):
+        return _SCALAR.match(buffer, position).end()
+    depth = 0
+    while True:
+        position = _SKIP.match(buffer, position).end()
+        char = buffer[position:position + 1]
+        if char in (b'{', b'['):
+            depth += 1
+        elif char in (b'}', b']'):
+            depth -= 1
+        else:
+            raise ValueError(f'Unterminated JSON value at {position}')
+        position += 1
+        if not depth:
+            return position
+
+
+def _index_object(buffer, start):
+    """Returns the keys of the JSON object starting at ``start``, mapped to
+    the spans of their values, without parsing the values.
+
+    >>> _index_object(b' {"a": [1], "b" : {"c": "}"}}', 1)
+    {'a': (7, 10), 'b': (18, 28)}
+    """
+    spans = {}
+    position = _WHITESPACE.match(buffer, start + 1).end()
+    if buffer[position:position + 1] == b'}':
+        return spans
+    while True:
+        key = _STRING.match(buffer, position)
+        if key is None:
+            raise ValueError(f'Expected a JSON object key at {position}')
+        position = _WHITESPACE.match(buffer, key.end()).end()
+        if buffer[position:position + 1] != b':':
+            raise ValueError(f'Expected ":" at {position}')
+        position = _WHITESPACE.match(buffer, position + 1).end()
+        end = _skip_value(buffer, position)
+        spans[cumulus_json.loads(key.group())] = (position, end)
+        position = _WHITESPACE.match(buffer, end).end()
+        char = buffer[position:position + 1]
+        if char == b'}':
+            return spans
+        if char != b',':
+            raise ValueError(f'Expected "," or "}}" at {position}')
+        position = _WHITESPACE.match(buffer, position + 1).end()
+
+
+def _parse(buffer, start, end, source=None):
+    if buffer[start:start + 1] == b'{' and end - start >= LAZY_OBJECT_BYTES:
+        return LazyObject(buffer, start, end, source)
+    return cumulus_json.loads(buffer[start:end])
+
+
+class RawJson:
+    """JSON text held in ``buffer`` between ``start`` and ``end``, which is
+    iterated in chunks of text.  ``source`` is the S3 object whose bytes are
+    ``buffer`` (a dict with its ``Bucket``, ``Key`` and ``ETag``), if any."""
+    __slots__ = ('buffer', 'start', 'end', 'source')
+
+    def __init__(self, buffer, start, end, source=None):
+        self.buffer = buffer
+        self.start = start
+        self.end = end
+        self.source = source
+
+    @property
+    def size(self):
+        """The size of the text in bytes."""
+        return self.end - self.start
+
+    def iter_bytes(self):
+        """Yields the text encoded as UTF-8, in chunks."""
+        for position in range(self.start, self.end, READ_CHUNK_SIZE):
+            yield self.buffer[position:min(position + READ_CHUNK_SIZE, self.end)]
+
+    def __iter__(self):
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        for chunk in self.iter_bytes():
+            yield decoder.decode(chunk)
+        yield decoder.decode(b'', final=True)
+
+
+# Lazy objects with members that are not parsed yet, by id (they are not
+# hashable)
+_unparsed = weakref.WeakValueDictionary()
+
+
+class LazyObject(dict):
+    """JSON object held in ``buffer`` between ``start`` and ``end``, whose
+    members are parsed when they are first accessed.
+
+    It is a dict, for the benefit of code that checks, but its members are
+    only stored in the dict once parsed, and JSON encoders read that storage
+    directly: use ``parse_lazy_objects`` before encoding a value that may
+    hold lazy objects with anything other than ``cumulus_remote.iter_json``.
+    Once all its members are parsed, it is an ordinary dict.
+    """
+    __slots__ = ('_buffer', '_start', '_end', '_source', '_spans', '_order', '__weakref__')
+
+    def __init__(self, buffer, start, end, source=None):  # pylint: disable=super-init-not-called
+        self._buffer = buffer
+        self._start = start
+        self._end = end
+        # The S3 object read into the buffer, if any (see ``RawJson``)
+        self._source = source
+        # The members not parsed yet, and the order of all members, once the
+        # object is indexed
+        self._spans = None
+        self._order = None
+        _unparsed[id(self)] = self
+
+    @property
+    def parsed(self):
+        """Whether all the members are parsed."""
+        return self._buffer is None
+
+    def _pending(self):
+        if self._buffer is None:
+            return {}
+        if self._spans is None:
+            self._spans = _index_object(self._buffer, self._start)
+            self._order = dict.fromkeys(self._spans)
+            if not self._spans:
+                self._finish()
+                return {}
+        return self._spans
+
+    def _finish(self):
+        # Stores the members in their order, now that they are all parsed
+        members = [(key, dict.__getitem__(self, key)) for key in self._order]
+        dict.clear(self)
+        dict.update(self, members)
+        self._buffer = self._spans = self._order = None
+        _unparsed.pop(id(self), None)
+
+    def _load(self, key):
+        spans = self._pending()
+        if key in spans:
+            start, end = spans.pop(key)
+            dict.__setitem__(self, key, _parse(self._buffer, start, end, self._source))
+            if not spans:
+                self._finish()
+
+    def raw_items(self):
+        """Yields the key, value and encoded value of each member, without
+        parsing them: the value is None and the encoded value is a
+        ``RawJson`` for the members not parsed yet, and the encoded value is
+        None for the others."""
+        spans = self._pending()
+        for key in list(self if self._buffer is None else self._order):
+            if key in spans:
+                yield key, None, RawJson(self._buffer, *spans[key], self._source)
+            else:
+                yield key, dict.__getitem__(self, key), None
+
+    def __getitem__(self, key):
+        if self._buffer is not None:
+            self._load(key)
+        return dict.__getitem__(self, key)
+
+    def __contains__(self, key):
+        return dict.__contains__(self, key) or key in self._pending()
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def __iter__(self):
+        if self._pending():
+            return iter(list(self._order))
+        return dict.__iter__(self)
+
+    def __len__(self):
+        if self._pending():
+            return len(self._order)
+        return dict.__len__(self)
+
+    def keys(self):
+        return KeysView(self)
+
+    def values(self):
+        return ValuesView(self)
+
+    def items(self):
+        return ItemsView(self)
+
+    def __setitem__(self, key, value):
+        spans = self._pending()
+        if spans:
+            spans.pop(key, None)
+            self._order[key] = None
+        dict.__setitem__(self, key, value)
+        if self._buffer is not None and not spans:
+            self._finish()
+
+    def __delitem__(self, key):
+        spans = self._pending()
+        if not spans:
+            dict.__delitem__(self, key)
+            return
+        if spans.pop(key, None) is None:
+            dict.__delitem__(self, key)
+        del self._order[key]
+        if not spans:
+            self._finish()
+
+    def pop(self, key, *default):
+        if key not in self:
+            if default:
+                return default[0]
+            raise KeyError(key)
+        value = self[key]
+        del self[key]
+        return value
+
+    def popitem(self):
+        for key in list(self._pending()):
+            self._load(key)
+        return dict.popitem(self)
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def update(self, *args, **kwargs):  # pylint: disable=arguments-differ
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def clear(self):
+        dict.clear(self)
+        self._buffer = self._spans = self._order = None
+        _unparsed.pop(id(self), None)
+
+    def copy(self):
+        """Returns a shallow copy, which parses its members separately."""
+        if not self._pending():
+            return dict(dict.items(self))
+        clone = LazyObject(self._buffer, self._start, self._end, self._source)
+        clone._spans = dict(self._spans)  # pylint: disable=protected-access
+        clone._order = dict(self._order)  # pylint: disable=protected-access
+        dict.update(clone, dict.items(self))
+        return clone
+
+    __copy__ = copy
+
+    def __deepcopy__(self, memo):
+        return deepcopy(parse_lazy_objects(self), memo)
+
+    def __eq__(self, other):
+        return dict.__eq__(parse_lazy_objects(self), other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(parse_lazy_objects(self))
+
+    def __reduce__(self):
+        return dict, (dict(self.items()),)
+
+
+_lazy_views = weakref.WeakValueDictionary()
+
+
+class LazyView(Mapping):
+    """
+    Read-only mapping given to a task in place of a ``LazyObject`` of the
+    message, so that its members are only parsed when the task accesses
+    them, without the task updating the message.
+
+    Members are returned as ``wrap(member)``, e.g. copy-on-write views of
+    them, once per member, so that the updates the task makes to them are
+    kept.  A view is not a dict: JSON encoders reject it, rather than reading
+    it as empty as they would a lazy object, so a task encoding its input
+    itself should parse it with ``parse_lazy_objects`` first, and ``copy``
+    returns a dict that the task may update.
+    """
+    __slots__ = ('_target', '_wrap', '_members', '__weakref__')
+
+    def __init__(self, target, wrap=None):
+        self._target = target
+        self._wrap = wrap
+        self._members = {}
+        _lazy_views[id(self)] = self
+
+    def __getitem__(self, key):
+        if key not in self._members:
+            value = self._target[key]
+            self._members[key] = self._wrap(value) if self._wrap else value
+        return self._members[key]
+
+    def __contains__(self, key):
+        return key in self._members or key in self._target
+
+    def __iter__(self):
+        return iter(self._target)
+
+    def __len__(self):
+        return len(self._target)
+
+    def copy(self):
+        """Returns a dict of the members of the view."""
+        return {key: self[key] for key in self}
+
+    def __deepcopy__(self, memo):
+        return deepcopy(parse_lazy_objects(self.unwrap()), memo)
+
+    def __eq__(self, other):
+        return parse_lazy_objects(self.unwrap()) == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return f'LazyView({self._target!r})'
+
+    def __reduce__(self):
+        return dict, (parse_lazy_objects(self.unwrap()),)
+
+    def unwrap(self):
+        """Returns the object viewed, or a shallow copy of it holding the
+        members accessed through the view, once they were, so that the
+        members that were not stay unparsed.  Views held by the members are
+        left as they are (see ``unwrap_lazy_views``)."""
+        if not self._members:
+            return self._target
+        target = copy(self._target)
+        for key, value in self._members.items():
+            target[key] = value
+        return target
+
+
+def unwrap_lazy_views(value):
+    """Returns ``value`` with the ``LazyView`` objects it holds replaced by the
+    objects they view (see ``LazyView.unwrap``), without parsing them."""
+    if not _lazy_views:
+        return value
+    if isinstance(value, LazyView):
+        value = value.unwrap()
+    # dict.items and list.__iter__ do not parse the members of lazy objects,
+    # nor replace the members of copy-on-write views
+    if isinstance(value, dict):
+        for key, item in list(dict.items(value)):
+            unwrapped = unwrap_lazy_views(item)
+            if unwrapped is not item:
+                dict.__setitem__(value, key, unwrapped)
+    elif isinstance(value, list):
+        for index, item in enumerate(list.__iter__(value)):
+            unwrapped = unwrap_lazy_views(item)
+            if unwrapped is not item:
+                list.__setitem__(value, index, unwrapped)
+    return value
+
+
+def lazy_objects_pending():
+    """Returns whether any ``LazyObject`` is not entirely parsed yet."""
+    return bool(_unparsed)
+
+
+def parse_lazy_objects(value):
+    """Returns ``value`` with the ``LazyObject``s it holds parsed entirely,
+    replacing those that are not parsed yet by dicts, and the ``LazyView``
+    objects it holds by dicts."""
+    value = unwrap_lazy_views(value)
+    if not _unparsed:
+        return value
+    if isinstance(value, LazyObject) and not value.parsed:
+        return {key: parse_lazy_objects(item) for key, item in value.items()}
+    # Including parsed lazy objects, whose members may not be
+    if isinstance(value, dict):
+        for key, item in dict.items(value):
+            parsed = parse_lazy_objects(item)
+            if parsed is not item:
+                dict.__setitem__(value, key, parsed)
+    elif isinstance(value, list):
+        for index, item in enumerate(list.__iter__(value)):
+            parsed = parse_lazy_objects(item)
+            if parsed is not item:
+                list.__setitem__(value, index, parsed)
+    return value
+
+
+def load_lazy(spool, source=None):
+    """Returns the JSON document written to the file ``spool``, which is
+    memory-mapped where possible, as a ``LazyObject`` if it is an object.
+    The file is closed.  ``source`` is the S3 object the file is a copy of,
+    if any (see ``RawJson``)."""
+    with spool:
+        spool.seek(0)
+        try:
+            buffer = mmap.mmap(spool.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, OSError):
+            buffer = spool.read()
+    start = _WHITESPACE.match(buffer).end()
+    if buffer[start:start + 1] != b'{':
+        return cumulus_json.loads(buffer[:])
+    return LazyObject(buffer, start, len(buffer), source)
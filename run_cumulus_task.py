@@ -2,22 +2,397 @@
 Interprets incoming messages, passes them to an inner handler, gets the
 response and transforms it into an outgoing message, returned by Lambda.
 """
+import asyncio
+import base64
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+from copy import deepcopy
+from dataclasses import dataclass
+import functools
+import inspect
+import json
 import os
 import sys
+import threading
 
-from cumulus_logger import CumulusLogger
+from cumulus_deadline import (
+    DEFAULT_DEADLINE_MARGIN_MS, CheckpointSaved, Deadline, DeadlineExceeded)
+from cumulus_logger import CumulusLogger, flush_logs
+from cumulus_memo import (
+    DEFAULT_MEMO_MAX_BYTES, DEFAULT_MEMO_TTL_SECONDS, MISSING, configure_task_memo,
+    task_memo)
+from cumulus_metrics import DEFAULT_NAMESPACE, InvocationMetrics
+from cumulus_profiling import DEFAULT_PROFILE_DIR, InvocationProfiler
+from cumulus_remote import (
+    DEFAULT_S3_RETRY_MODE, checkpoint_location, configure_remote_event_cache,
+    configure_s3_client, delete_checkpoint, find_checkpoint, save_checkpoint,
+    set_lazy_parse_bytes)
+from cumulus_schema import set_validation_engine
+from cumulus_streaming import set_memory_budget
 
+MESSAGE_ADAPTER_ZIP = 'cumulus-message-adapter.zip'
+DEFAULT_BATCH_WORKERS = 10
+
+
+@dataclass(frozen=True)
+class Settings:
+    """Snapshot of the environment that configures the message adapter,
+    taken once per process by ``bootstrap``."""
+    message_adapter_dir: str = None
+    message_adapter_zip: str = None
+    message_adapter_disabled: bool = False
+    task_root: str = ''
+    remote_event_cache_bytes: int = 0
+    remote_event_lazy_bytes: int = 0
+    s3_max_pool_connections: int = None
+    s3_tcp_keepalive: bool = True
+    s3_max_attempts: int = None
+    s3_retry_mode: str = DEFAULT_S3_RETRY_MODE
+    s3_connect_timeout: float = None
+    s3_read_timeout: float = None
+    stream_memory_bytes: int = 0
+    deadline_margin_ms: int = DEFAULT_DEADLINE_MARGIN_MS
+    memoize: str = None
+    memoize_ttl_seconds: int = DEFAULT_MEMO_TTL_SECONDS
+    memoize_max_bytes: int = DEFAULT_MEMO_MAX_BYTES
+    memoize_version: str = None
+    memoize_ignore_cumulus_config: bool = False
+    schema_validation: str = None
+    schema_sample_items: int = 0
+    metrics_enabled: bool = False
+    metrics_namespace: str = DEFAULT_NAMESPACE
+    metrics_trace_memory: bool = False
+    profile_rate: float = 0.0
+    profile_trace_memory: bool = False
+    profile_dir: str = DEFAULT_PROFILE_DIR
+    profile_s3_uri: str = None
+
+    @classmethod
+    def from_environ(cls):
+        return cls(
+            message_adapter_dir=os.environ.get('CUMULUS_MESSAGE_ADAPTER_DIR') or None,
+            message_adapter_zip=(
+                MESSAGE_ADAPTER_ZIP if os.path.isfile(MESSAGE_ADAPTER_ZIP) else None),
+            message_adapter_disabled=str(
+                os.environ.get('CUMULUS_MESSAGE_ADAPTER_DISABLED')
+            ).lower() == 'true',
+            task_root=os.environ.get('LAMBDA_TASK_ROOT', ''),
+            remote_event_cache_bytes=int(
+                os.environ.get('CUMULUS_REMOTE_EVENT_CACHE_BYTES') or 0),
+            remote_event_lazy_bytes=int(
+                os.environ.get('CUMULUS_REMOTE_EVENT_LAZY_BYTES') or 0),
+            s3_max_pool_connections=int(
+                os.environ.get('CUMULUS_S3_MAX_POOL_CONNECTIONS') or 0) or None,
+            s3_tcp_keepalive=str(
+                os.environ.get('CUMULUS_S3_TCP_KEEPALIVE')).lower() != 'false',
+            s3_max_attempts=int(os.environ.get('CUMULUS_S3_MAX_ATTEMPTS') or 0) or None,
+            s3_retry_mode=(
+                os.environ.get('CUMULUS_S3_RETRY_MODE', '').lower() or DEFAULT_S3_RETRY_MODE),
+            s3_connect_timeout=float(
+                os.environ.get('CUMULUS_S3_CONNECT_TIMEOUT') or 0) or None,
+            s3_read_timeout=float(os.environ.get('CUMULUS_S3_READ_TIMEOUT') or 0) or None,
+            stream_memory_bytes=int(os.environ.get('CUMULUS_STREAM_MEMORY_BYTES') or 0),
+            deadline_margin_ms=int(
+                os.environ.get('CUMULUS_DEADLINE_MARGIN_MS') or DEFAULT_DEADLINE_MARGIN_MS),
+            memoize=os.environ.get('CUMULUS_MEMOIZE') or None,
+            memoize_ttl_seconds=int(
+                os.environ.get('CUMULUS_MEMOIZE_TTL_SECONDS') or DEFAULT_MEMO_TTL_SECONDS),
+            memoize_max_bytes=int(
+                os.environ.get('CUMULUS_MEMOIZE_MAX_BYTES') or DEFAULT_MEMO_MAX_BYTES),
+            memoize_version=(os.environ.get('CUMULUS_MEMOIZE_VERSION')
+                             or os.environ.get('AWS_LAMBDA_FUNCTION_VERSION') or None),
+            memoize_ignore_cumulus_config=str(
+                os.environ.get('CUMULUS_MEMOIZE_IGNORE_CUMULUS_CONFIG')).lower() == 'true',
+            schema_validation=(
+                os.environ.get('CUMULUS_SCHEMA_VALIDATION', '').lower() or None),
+            schema_sample_items=int(os.environ.get('CUMULUS_SCHEMA_SAMPLE_ITEMS') or 0),
+            metrics_enabled=str(os.environ.get('CUMULUS_METRICS')).lower() == 'true',
+            metrics_namespace=(
+                os.environ.get('CUMULUS_METRICS_NAMESPACE') or DEFAULT_NAMESPACE),
+            metrics_trace_memory=str(
+                os.environ.get('CUMULUS_METRICS_TRACEMALLOC')).lower() == 'true',
+            profile_rate=float(os.environ.get('CUMULUS_PROFILE_RATE') or 0),
+            profile_trace_memory=str(
+                os.environ.get('CUMULUS_PROFILE_TRACEMALLOC')).lower() == 'true',
+            profile_dir=os.environ.get('CUMULUS_PROFILE_DIR') or DEFAULT_PROFILE_DIR,
+            profile_s3_uri=os.environ.get('CUMULUS_PROFILE_S3_URI') or None,
+        )
+
+    def invocation_metrics(self):
+        """Returns the metrics collector of a new invocation."""
+        return InvocationMetrics(self.metrics_enabled, self.metrics_namespace,
+                                 self.metrics_trace_memory)
+
+    def deadline(self, context, checkpoint=None):
+        """Returns the deadline of an invocation, with the checkpoint of the
+        previous attempt."""
+        return Deadline(context, self.deadline_margin_ms, checkpoint)
+
+    def invocation_profiler(self):
+        """Returns the profiler of sampled invocations."""
+        return InvocationProfiler(self.profile_rate, self.profile_trace_memory,
+                                  self.profile_dir, self.profile_s3_uri)
+
+
+_settings = None
+_bootstrap_lock = threading.Lock()
+
+
+def _prepend_sys_path(entry):
+    if entry not in sys.path:
+        sys.path.insert(0, entry)
+
+def set_sys_path(settings=None):
+    if settings is None:
+        settings = Settings.from_environ()
 
-def set_sys_path():
     # If the lambda has CUMULUS_MESSAGE_ADAPTER_DIR set, use the CMA lib
     # present at that location
-    if os.environ.get('CUMULUS_MESSAGE_ADAPTER_DIR'):
-        sys.path.insert(0, os.environ.get('CUMULUS_MESSAGE_ADAPTER_DIR'))
+    if settings.message_adapter_dir:
+        _prepend_sys_path(settings.message_adapter_dir)
 
     # if the message adapter zip file has been included, put it in the path
     # it'll be used instead of the version from the requirements file
-    if os.path.isfile('cumulus-message-adapter.zip'):
-        sys.path.insert(0, 'cumulus-message-adapter.zip')
+    if settings.message_adapter_zip:
+        _prepend_sys_path(settings.message_adapter_zip)
+
+def bootstrap(refresh=False):
+    """
+    Captures the message adapter settings from the environment and puts the
+    message adapter on ``sys.path``, once per process.  Subsequent calls
+    return the same ``Settings`` without touching the environment or
+    ``sys.path``.
+
+    Arguments:
+        refresh -- Optional. Re-read the environment, e.g. after changing it
+            in tests
+    """
+    global _settings  # pylint: disable=global-statement
+    if _settings is None or refresh:
+        with _bootstrap_lock:
+            if _settings is None or refresh:
+                settings = Settings.from_environ()
+                set_sys_path(settings)
+                configure_remote_event_cache(settings.remote_event_cache_bytes)
+                set_lazy_parse_bytes(settings.remote_event_lazy_bytes)
+                configure_s3_client(
+                    settings.s3_max_pool_connections, settings.s3_tcp_keepalive,
+                    settings.s3_max_attempts, settings.s3_retry_mode,
+                    settings.s3_connect_timeout, settings.s3_read_timeout)
+                set_memory_budget(settings.stream_memory_bytes)
+                configure_task_memo(settings.memoize, settings.memoize_ttl_seconds,
+                                    settings.memoize_max_bytes, settings.memoize_version,
+                                    settings.memoize_ignore_cumulus_config)
+                set_validation_engine(settings.schema_validation,
+                                      settings.schema_sample_items)
+                _settings = settings
+    return _settings
+
+def _cumulus_adapter():
+    """Returns the ``cumulus_adapter`` module, imported on first use: it
+    imports the message adapter, which ``bootstrap`` puts on ``sys.path``,
+    along with its dependencies (boto3, jsonschema and jsonpath), which are
+    not needed until a message is adapted."""
+    import cumulus_adapter  # pylint: disable=import-outside-toplevel
+    return cumulus_adapter
+
+def prepare(schemas=None):
+    """
+    Loads the schemas and builds the message adapter for a task ahead of its
+    first invocation, and caches them for the life of the process.
+
+    Calling this at module import moves the setup cost into the Lambda init
+    phase.  ``run_cumulus_task`` reuses the cached adapter as long as the
+    resolved schema files are unchanged.  Returns the adapter, or None when
+    the message adapter is disabled.
+
+    Arguments:
+        schemas -- Optional. The same dict of schema filepaths that is passed
+            to ``run_cumulus_task``
+    """
+    settings = bootstrap()
+    if settings.message_adapter_disabled:
+        return None
+    return _cumulus_adapter().get_adapter(schemas, settings.task_root)
+
+def cumulus_task(schemas=None):
+    """
+    Decorator that turns a task function into a Lambda handler which calls
+    ``run_cumulus_task``, preparing the message adapter at decoration time.
+    Coroutine task functions are run with ``run_cumulus_task_async`` in a new
+    event loop.  The undecorated function remains available as
+    ``handler.task_function``.
+
+    Arguments:
+        schemas -- Optional. The same dict of schema filepaths that is passed
+            to ``run_cumulus_task``
+    """
+    def decorator(task_function):
+        prepare(schemas)
+
+        @functools.wraps(task_function)
+        def handler(cumulus_message, context=None, **taskargs):
+            if inspect.iscoroutinefunction(task_function):
+                return asyncio.run(run_cumulus_task_async(
+                    task_function, cumulus_message, context, schemas, **taskargs))
+            return run_cumulus_task(
+                task_function, cumulus_message, context, schemas, **taskargs)
+
+        handler.task_function = task_function
+        return handler
+    return decorator
+
+def _signature_accepts_deadline(task_function):
+    try:
+        return 'deadline' in inspect.signature(task_function).parameters
+    except (TypeError, ValueError):
+        return False
+
+_cached_accepts_deadline = functools.lru_cache(maxsize=128)(_signature_accepts_deadline)
+
+def _accepts_deadline(task_function):
+    try:
+        return _cached_accepts_deadline(task_function)
+    except TypeError:  # Unhashable task functions are not cached
+        return _signature_accepts_deadline(task_function)
+
+def _takes_deadline(task_function, taskargs):
+    """Tells whether the task function is given a ``deadline`` by the adapter."""
+    return 'deadline' not in taskargs and _accepts_deadline(task_function)
+
+def _task_kwargs(task_function, taskargs, settings, context, checkpoint=None):
+    """Adds a ``deadline`` to ``taskargs`` for task functions that take one."""
+    if not _takes_deadline(task_function, taskargs):
+        return taskargs
+    return dict(taskargs, deadline=settings.deadline(context, checkpoint))
+
+def _find_checkpoint(task_functions, cumulus_message, taskargs):
+    """Returns where the checkpoint of a task invoked with ``cumulus_message``
+    is stored, and the checkpoint stored there by the previous attempt, if
+    any.  Only tasks given a ``deadline`` save checkpoints, so the message is
+    only hashed and looked up for them."""
+    if not any(_takes_deadline(task_function, taskargs)
+               for task_function in task_functions):
+        return None, None
+    location = checkpoint_location(cumulus_message)
+    return location, find_checkpoint(location) if location is not None else None
+
+def _delete_checkpoint(location, logger):
+    """Deletes the checkpoint a task resumed from once it completed."""
+    try:
+        delete_checkpoint(location)
+    except Exception:  # pylint: disable=broad-except
+        logger.warn('Failed to delete the checkpoint s3://{}/{}', location['Bucket'],
+                    location['Key'], exc_info=True)
+
+@contextmanager
+def _checkpoint(task_functions, cumulus_message, taskargs, logger):
+    """Yields the location and the checkpoint returned by ``_find_checkpoint``,
+    and deletes the checkpoint once the tasks resumed from it complete, i.e.
+    unless an exception is raised."""
+    location, saved = _find_checkpoint(task_functions, cumulus_message, taskargs)
+    yield location, saved
+    if saved is not None:
+        _delete_checkpoint(location, logger)
+
+@asynccontextmanager
+async def _checkpoint_async(task_functions, cumulus_message, taskargs, logger):
+    """Asynchronous counterpart of ``_checkpoint``, which reads and deletes
+    the checkpoint in a worker thread."""
+    location, saved = await asyncio.to_thread(
+        _find_checkpoint, task_functions, cumulus_message, taskargs)
+    yield location, saved
+    if saved is not None:
+        await asyncio.to_thread(_delete_checkpoint, location, logger)
+
+def _save_checkpoint(exception, location, checkpoint, logger):
+    """Stores the ``checkpoint`` of a task that raised the ``DeadlineExceeded``
+    ``exception`` and raises ``CheckpointSaved``, so that Step Functions
+    retries the task, or raises ``exception`` if it cannot be stored."""
+    if location is None:
+        logger.error('Deadline exceeded, without a cumulus_meta.system_bucket '
+                     'to save a checkpoint in')
+        raise exception
+    save_checkpoint(checkpoint, location)
+    error = CheckpointSaved(location['Bucket'], location['Key'])
+    logger.info(str(error))
+    raise error from exception
+
+def _memoized(task_function, nested_event, taskargs, logger):
+    """Returns the memo key of a call of the task function with its nested
+    event, or None if not memoized, and the response memoized under that key,
+    or ``MISSING`` (see ``cumulus_memo``)."""
+    memo = task_memo()
+    if memo is None:
+        return None, MISSING
+    key = memo.key(task_function, nested_event, taskargs)
+    if key is None:
+        return None, MISSING
+    return key, memo.get(key, logger)
+
+def _memoize(key, task_response, logger):
+    """Memoizes ``task_response`` under the key returned by ``_memoized``."""
+    if key is not None:
+        task_memo().put(key, task_response, logger)
+
+def _call_task(task_function, nested_event, context, taskargs, settings, logger,
+               checkpoint=None):
+    """Calls the task function with its nested event, and the ``checkpoint``
+    it resumes from in its deadline, or returns the response memoized for the
+    same task, input and config, if enabled (see ``cumulus_memo``)."""
+    key, task_response = _memoized(task_function, nested_event, taskargs, logger)
+    if task_response is MISSING:
+        task_response = task_function(nested_event, context, **_task_kwargs(
+            task_function, taskargs, settings, context, checkpoint))
+        _memoize(key, task_response, logger)
+    return task_response
+
+async def _awaited(value):
+    """Returns ``value``, awaited if it is awaitable."""
+    if inspect.isawaitable(value):
+        value = await value
+    return value
+
+async def _call_task_async(task_function, nested_event, context, taskargs, settings,
+                           logger, checkpoint=None):
+    """Asynchronous counterpart of ``_call_task``, which reads and writes the
+    memo in a worker thread."""
+    key, task_response = await asyncio.to_thread(
+        _memoized, task_function, nested_event, taskargs, logger)
+    if task_response is MISSING:
+        task_response = await _awaited(task_function(
+            nested_event, context, **_task_kwargs(
+                task_function, taskargs, settings, context, checkpoint)))
+        await asyncio.to_thread(_memoize, key, task_response, logger)
+    return task_response
+
+def _start_invocation(cumulus_message, context):
+    """Returns the settings, logger and started metrics of an invocation."""
+    settings = bootstrap()
+    logger = CumulusLogger()
+    logger.setMetadata(cumulus_message, context)
+    metrics = settings.invocation_metrics()
+    metrics.start()
+    metrics.size('MessageBytesIn', cumulus_message)
+    return settings, logger, metrics
+
+def _load_event(adapter, cumulus_message, context, metrics):
+    """Loads the incoming message of a task, and returns it along with the
+    nested event of the task."""
+    with metrics.phase('LoadRemoteEvent'):
+        full_event = adapter.load_and_update_remote_event(
+            cumulus_message, vars(context) if context else {})
+    with metrics.phase('LoadNestedEvent'):
+        nested_event = adapter.load_nested_event(full_event)
+    return full_event, nested_event
+
+def _create_next_event(adapter, task_response, full_event, nested_event, metrics):
+    """Creates the outgoing message of a task from its response."""
+    with metrics.phase('CreateNextEvent'):
+        result = adapter.create_next_event(
+            task_response, full_event, nested_event.get('messageConfig', {}))
+    metrics.size('MessageBytesOut', result)
+    return result
 
 def handle_task_exception(
     exception,
@@ -56,32 +431,383 @@ def run_cumulus_task(
             if not found there, will be ignored.
         taskargs -- Optional. Additional keyword arguments for the
             task_function
+
+    Task functions that take a ``deadline`` argument are given a
+    ``cumulus_deadline.Deadline``.  If they raise ``DeadlineExceeded``, their
+    checkpoint is stored in S3 under ``cumulus_meta.system_bucket`` and
+    ``CheckpointSaved`` is raised, so that the next attempt of the task on the
+    same message resumes from it.  The checkpoint is deleted once the task
+    resumed from it completes.
+
+    When ``CUMULUS_MEMOIZE`` is set, the response of the task function to an
+    input and config it already processed is reused instead of calling it
+    again (see ``cumulus_memo``).
+
+    Log records queued by buffered ``CumulusLogger`` handlers are written
+    before this returns or raises.
     """
+    try:
+        return _run_cumulus_task(
+            task_function, cumulus_message, context, schemas, **taskargs)
+    finally:
+        flush_logs()
+
+
+def _run_cumulus_task(task_function, cumulus_message, context, schemas, **taskargs):
+    settings, logger, metrics = _start_invocation(cumulus_message, context)
+    try:
+        with settings.invocation_profiler().profile(logger, context), \
+                _checkpoint([task_function], cumulus_message, taskargs,
+                            logger) as (location, saved):
+            if settings.message_adapter_disabled:
+                with metrics.phase('Task'):
+                    try:
+                        result = task_function(cumulus_message, context, **_task_kwargs(
+                            task_function, taskargs, settings, context,
+                            saved and saved['state']))
+                    except DeadlineExceeded as exception:
+                        _save_checkpoint(
+                            exception, location, {'state': exception.checkpoint}, logger)
+                    except Exception as exception:
+                        result = handle_task_exception(exception, cumulus_message, logger)
+                metrics.size('MessageBytesOut', result)
+                return result
+
+            adapter = _cumulus_adapter().get_adapter(schemas, settings.task_root)
+            full_event, nested_event = _load_event(
+                adapter, cumulus_message, context, metrics)
+
+            with metrics.phase('Task'):
+                try:
+                    task_response = _call_task(
+                        task_function, nested_event, context, taskargs, settings, logger,
+                        saved and saved['state'])
+                except DeadlineExceeded as exception:
+                    _save_checkpoint(
+                        exception, location, {'state': exception.checkpoint}, logger)
+                except Exception as exception:
+                    result = handle_task_exception(exception, cumulus_message, logger)
+                    metrics.size('MessageBytesOut', result)
+                    return result
+
+            return _create_next_event(adapter, task_response, full_event, nested_event,
+                                      metrics)
+    finally:
+        metrics.emit(logger, context)
+
+
+@dataclass(frozen=True)
+class CumulusStep:
+    """A step of the workflow run by ``run_cumulus_tasks``: the task function,
+    the name under which its ``task_config`` is found, and its schemas (see
+    ``run_cumulus_task``)."""
+    name: str
+    task_function: object
+    schemas: dict = None
+
+
+def _as_step(step):
+    if isinstance(step, CumulusStep):
+        return step
+    if callable(step):
+        return CumulusStep(step.__name__, step)
+    return CumulusStep(*step)
 
-    set_sys_path()
-    from message_adapter.message_adapter import MessageAdapter
 
+def _step_index(steps, name):
+    """Returns the index of the step named ``name``."""
+    names = [step.name for step in steps]
+    if name not in names:
+        raise ValueError(f'Unknown step {name}')
+    return names.index(name)
+
+
+def run_cumulus_tasks(steps, cumulus_message, context=None, **taskargs):
+    """
+    Runs consecutive steps of a workflow in a single invocation, passing the
+    outgoing message of each step to the next in memory, and returns the
+    outgoing message of the last one.
+
+    Each step is run as ``run_cumulus_task`` would run it on its incoming
+    message: its ``input`` and ``config`` are resolved, validated against its
+    schemas, and its output assigned per its ``cumulus_message``
+    configuration, and the step is recorded in ``meta.workflow_tasks``.  Only
+    the message returned by the last step run is stored in S3 per
+    ``ReplaceConfig``.
+
+    The ``task_config`` of each step is the member of the message's
+    ``task_config.workflow_tasks`` named after the step, when the message has
+    one (e.g. ``{"workflow_tasks": {"ParsePdr": {...}, "QueueGranules":
+    {...}}}``); otherwise every step is given the message's ``task_config``.
+
+    A step raising a ``WorkflowError`` ends the workflow with that step's
+    incoming message, as ``run_cumulus_task`` does.  A step raising
+    ``DeadlineExceeded`` has its checkpoint stored along with its name and
+    incoming message before ``CheckpointSaved`` is raised, so that the next
+    attempt resumes from that step.
+
+    Arguments:
+        steps -- Required. The ordered steps: ``CumulusStep``s, tuples of
+            their arguments, or task functions, named after the function
+        cumulus_message -- Required. Either a full Cumulus Message or a Cumulus
+            Remote Message
+        context -- AWS Lambda context object
+        taskargs -- Optional. Additional keyword arguments for every task
+            function
+    """
+    try:
+        return _run_cumulus_tasks(
+            [_as_step(step) for step in steps], cumulus_message, context, **taskargs)
+    finally:
+        flush_logs()
+
+
+def _run_cumulus_tasks(steps, cumulus_message, context, **taskargs):
+    settings, logger, metrics = _start_invocation(cumulus_message, context)
     context_dict = vars(context) if context else {}
-    logger = CumulusLogger()
-    logger.setMetadata(cumulus_message, context)
-    message_adapter_disabled = str(
-        os.environ.get('CUMULUS_MESSAGE_ADAPTER_DISABLED')
-    ).lower()
+    try:
+        with settings.invocation_profiler().profile(logger, context), \
+                _checkpoint([step.task_function for step in steps], cumulus_message,
+                            taskargs, logger) as (location, saved):
+            result = cumulus_message
+            if settings.message_adapter_disabled:
+                first, checkpoint = 0, None
+                if saved is not None:
+                    first = _step_index(steps, saved['step'])
+                    result, checkpoint = saved['message'], saved['state']
+                for step in steps[first:]:
+                    with metrics.phase('Task'):
+                        try:
+                            result = step.task_function(result, context, **_task_kwargs(
+                                step.task_function, taskargs, settings, context,
+                                checkpoint))
+                        except DeadlineExceeded as exception:
+                            _save_checkpoint(exception, location, {
+                                'step': step.name, 'state': exception.checkpoint,
+                                'message': result}, logger)
+                        except Exception as exception:
+                            result = handle_task_exception(exception, result, logger)
+                            break
+                    checkpoint = None
+                metrics.size('MessageBytesOut', result)
+                return result
+
+            # Loading the message does not depend on the schemas of any step
+            with metrics.phase('LoadRemoteEvent'):
+                adapter = _cumulus_adapter().CumulusMessageAdapter()
+                event = adapter.load_and_update_remote_event(cumulus_message, context_dict)
+            # Applied to the message returned to Step Functions only
+            replace_config = event.pop('ReplaceConfig', None)
+            step_configs = (event.get('task_config') or {}).get('workflow_tasks')
+            first, checkpoint = 0, None
+            if saved is not None:
+                # The incoming message of the step that stopped
+                first, event = _step_index(steps, saved['step']), saved['message']
+                checkpoint = saved['state']
+
+            for index in range(first, len(steps)):
+                step = steps[index]
+                adapter = _cumulus_adapter().get_adapter(step.schemas, settings.task_root)
+                if index > first:
+                    event = adapter.load_and_update_remote_event(result, context_dict)
+                if step_configs is not None:
+                    event['task_config'] = deepcopy(step_configs.get(step.name, {}))
+                with metrics.phase('LoadNestedEvent'):
+                    nested_event = adapter.load_nested_event(event)
+                message_config = nested_event.get('messageConfig', {})
+
+                with metrics.phase('Task'):
+                    try:
+                        task_response = _call_task(
+                            step.task_function, nested_event, context, taskargs,
+                            settings, logger, checkpoint)
+                    except DeadlineExceeded as exception:
+                        _save_checkpoint(exception, location, {
+                            'step': step.name, 'state': exception.checkpoint,
+                            'message': event}, logger)
+                    except Exception as exception:
+                        result = handle_task_exception(exception, result, logger)
+                        if result is not cumulus_message and replace_config is not None:
+                            # The outgoing message of the previous step
+                            result['ReplaceConfig'] = replace_config
+                            result = adapter.store_response(result)
+                        metrics.size('MessageBytesOut', result)
+                        return result
+                checkpoint = None
+
+                last = index == len(steps) - 1
+                if last and replace_config is not None:
+                    event['ReplaceConfig'] = replace_config
+                with metrics.phase('CreateNextEvent'):
+                    result = adapter.create_next_event(task_response, event, message_config)
+            metrics.size('MessageBytesOut', result)
+            return result
+    finally:
+        metrics.emit(logger, context)
+
+
+async def run_cumulus_task_async(
+        task_function,
+        cumulus_message,
+        context=None,
+        schemas=None,
+        **taskargs):
+    """
+    Asynchronous counterpart of ``run_cumulus_task`` for coroutine task
+    functions, so that a task can overlap its I/O-bound work within a single
+    invocation.
+
+    Loading a remote message and storing a large outgoing message in S3 run in
+    a worker thread, so they do not block the event loop, as does writing the
+    queued log records at the end.  Exceptions raised by the task are handled
+    as in ``run_cumulus_task``.
+
+    Arguments:
+        task_function -- Required. The coroutine function (or function
+            returning an awaitable) containing the business logic of the
+            cumulus task.  Plain functions are also accepted.
+        cumulus_message -- Required. Either a full Cumulus Message or a Cumulus
+            Remote Message
+        context -- AWS Lambda context object
+        schemas -- Optional. See ``run_cumulus_task``
+        taskargs -- Optional. Additional keyword arguments for the
+            task_function
+    """
+    try:
+        return await _run_cumulus_task_async(
+            task_function, cumulus_message, context, schemas, **taskargs)
+    finally:
+        await asyncio.to_thread(flush_logs)
 
-    if message_adapter_disabled == 'true':
+
+async def _run_cumulus_task_async(
+        task_function, cumulus_message, context, schemas, **taskargs):
+    settings, logger, metrics = _start_invocation(cumulus_message, context)
+    try:
+        with settings.invocation_profiler().profile(logger, context):
+            async with _checkpoint_async([task_function], cumulus_message, taskargs,
+                                         logger) as (location, saved):
+                if settings.message_adapter_disabled:
+                    with metrics.phase('Task'):
+                        try:
+                            result = await _awaited(task_function(
+                                cumulus_message, context, **_task_kwargs(
+                                    task_function, taskargs, settings, context,
+                                    saved and saved['state'])))
+                        except DeadlineExceeded as exception:
+                            await asyncio.to_thread(
+                                _save_checkpoint, exception, location,
+                                {'state': exception.checkpoint}, logger)
+                        except Exception as exception:
+                            result = handle_task_exception(exception, cumulus_message, logger)
+                    metrics.size('MessageBytesOut', result)
+                    return result
+
+                adapter = _cumulus_adapter().get_adapter(schemas, settings.task_root)
+                full_event, nested_event = await asyncio.to_thread(
+                    _load_event, adapter, cumulus_message, context, metrics)
+
+                with metrics.phase('Task'):
+                    try:
+                        task_response = await _call_task_async(
+                            task_function, nested_event, context, taskargs, settings, logger,
+                            saved and saved['state'])
+                    except DeadlineExceeded as exception:
+                        await asyncio.to_thread(
+                            _save_checkpoint, exception, location,
+                            {'state': exception.checkpoint}, logger)
+                    except Exception as exception:
+                        result = handle_task_exception(exception, cumulus_message, logger)
+                        metrics.size('MessageBytesOut', result)
+                        return result
+
+                return await asyncio.to_thread(
+                    _create_next_event, adapter, task_response, full_event, nested_event,
+                    metrics)
+    finally:
+        metrics.emit(logger, context)
+
+
+def _record_identifier(record):
+    """Returns the identifier Lambda expects in ``batchItemFailures``."""
+    if 'kinesis' in record:
+        return record['kinesis']['sequenceNumber']
+    return record.get('messageId', record.get('eventID'))
+
+def _record_message(record):
+    """Returns the Cumulus message carried by an SQS or Kinesis record."""
+    if 'kinesis' in record:
+        return json.loads(base64.b64decode(record['kinesis']['data']))
+    body = record['body']
+    return json.loads(body) if isinstance(body, (str, bytes)) else body
+
+def run_cumulus_task_batch(
+        task_function,
+        records,
+        context=None,
+        schemas=None,
+        max_workers=DEFAULT_BATCH_WORKERS,
+        **taskargs):
+    """
+    Runs ``run_cumulus_task`` for each Cumulus message in a batch of SQS or
+    Kinesis records, on a bounded pool of threads, and reports the records
+    that failed so that only those are retried.
+
+    Each message is logged with its own ``CumulusLogger`` metadata.  A record
+    fails when its message cannot be parsed, or when ``run_cumulus_task``
+    raises; tasks that raise a ``WorkflowError`` do not fail their record.
+
+    Arguments:
+        task_function -- Required. The function containing the business logic
+            of the cumulus task
+        records -- Required. Either the Lambda event of an SQS or Kinesis
+            trigger, or its list of ``Records``
+        context -- AWS Lambda context object
+        schemas -- Optional. See ``run_cumulus_task``
+        max_workers -- Optional. Maximum number of messages processed
+            concurrently
+        taskargs -- Optional. Additional keyword arguments for the
+            task_function
+
+    Returns:
+        A dict in the Lambda partial batch response format, e.g.
+        ``{"batchItemFailures": [{"itemIdentifier": "<messageId>"}]}``
+    """
+    if isinstance(records, dict):
+        records = records.get('Records', [])
+
+    def run_record(record):
+        try:
+            cumulus_message = _record_message(record)
+        except (KeyError, TypeError, ValueError) as exception:
+            CumulusLogger().error(
+                'Invalid Cumulus message in record {}: {}',
+                _record_identifier(record), exception)
+            return False
         try:
-            return task_function(cumulus_message, context, **taskargs)
-        except Exception as exception:
-            return handle_task_exception(exception, cumulus_message, logger)
+            _run_cumulus_task(
+                task_function, cumulus_message, context, schemas, **taskargs)
+        except Exception:  # pylint: disable=broad-except
+            logger = CumulusLogger()
+            logger.setMetadata(cumulus_message, context)
+            logger.error('Failed to process record {}',
+                         _record_identifier(record), exc_info=True)
+            return False
+        return True
 
-    adapter = MessageAdapter(schemas)
-    full_event = adapter.load_and_update_remote_event(cumulus_message, context_dict)
-    nested_event = adapter.load_nested_event(full_event)
-    message_config = nested_event.get('messageConfig', {})
+    if not records:
+        return {'batchItemFailures': []}
 
+    bootstrap()
     try:
-        task_response = task_function(nested_event, context, **taskargs)
-    except Exception as exception:
-        return handle_task_exception(exception, cumulus_message, logger)
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(records))) as pool:
+            succeeded = list(pool.map(run_record, records))
+    finally:
+        flush_logs()
 
-    return adapter.create_next_event(task_response, full_event, message_config)
+    return {
+        'batchItemFailures': [
+            {'itemIdentifier': _record_identifier(record)}
+            for record, success in zip(records, succeeded) if not success
+        ]
+    }
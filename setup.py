@@ -57,7 +57,10 @@ setup(
     ],
     keywords='nasa cumulus',  # Optional
     packages=find_packages(exclude=['.circleci', 'contrib', 'docs', 'tests']),
-    py_modules=['run_cumulus_task', 'cumulus_logger'],
+    py_modules=['run_cumulus_task', 'cumulus_logger', 'cumulus_adapter',
+                'cumulus_remote', 'cumulus_json', 'cumulus_metrics',
+                'cumulus_profiling', 'cumulus_streaming', 'cumulus_parallel',
+                'cumulus_deadline', 'cumulus_schema', 'cumulus_memo'],
     install_requires=install_requires,
     dependency_links=dependency_links
 )
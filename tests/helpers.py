@@ -1,5 +1,12 @@
+from datetime import datetime, timezone
+import hashlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import threading
+import time
 from os import path
 
+from botocore.exceptions import ClientError
+
 
 def create_parameter_event():
     event = create_event()
@@ -69,3 +76,193 @@ class LambdaContextMock:
         self.function_name = "function_name_example"
         self.function_version = 1
         self.invoked_function_arn = "arn:aws:lambda:us-east-1:123:function:function_name_example:1"
+
+
+class DeadlineContextMock(LambdaContextMock):
+    def __init__(self, remaining_ms):
+        super().__init__()
+        self.deadline = time.monotonic() + remaining_ms / 1000
+
+    def get_remaining_time_in_millis(self):
+        return max(int((self.deadline - time.monotonic()) * 1000), 0)
+
+
+class FakeS3Body:
+    def __init__(self, data):
+        self._data = data
+        self._position = 0
+
+    def read(self, amt=None):
+        start = self._position
+        end = len(self._data) if amt is None else min(start + amt, len(self._data))
+        self._position = end
+        return self._data if (start, end) == (0, len(self._data)) else self._data[start:end]
+
+    def close(self):
+        pass
+
+
+class FakeS3Client:
+    """Local in-memory stand-in for the subset of the boto3 S3 client used by
+    the adapter, recording the calls made to it.  With ``keep_data=False``
+    only the sizes of the stored objects are kept.  With
+    ``list_bucket=False``, reading a missing object is denied, as S3 does for
+    roles without ``s3:ListBucket``."""
+    def __init__(self, keep_data=True, list_bucket=True):
+        self.keep_data = keep_data
+        self.list_bucket = list_bucket
+        self.objects = {}
+        self.sizes = {}
+        self.modified = {}
+        self.calls = []
+        self._uploads = {}
+
+    def _etag(self, data):
+        return '"%s"' % hashlib.md5(data).hexdigest()
+
+    def _store(self, bucket, key, data, size):
+        self.objects[(bucket, key)] = data if self.keep_data else b''
+        self.sizes[(bucket, key)] = size
+        self.modified[(bucket, key)] = datetime.now(timezone.utc)
+
+    def put_object(self, Bucket, Key, Body, **kwargs):  # pylint: disable=unused-argument
+        self.calls.append(('put_object', Bucket, Key))
+        if isinstance(Body, str):
+            Body = Body.encode('utf-8')
+        self._store(Bucket, Key, Body, len(Body))
+        return {'ETag': self._etag(Body)}
+
+    def create_multipart_upload(self, Bucket, Key, **kwargs):  # pylint: disable=unused-argument
+        self.calls.append(('create_multipart_upload', Bucket, Key))
+        upload_id = 'upload-%d' % len(self.calls)
+        self._uploads[upload_id] = ([], [0])
+        return {'UploadId': upload_id}
+
+    # pylint: disable-next=unused-argument
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        self.calls.append(('upload_part', Bucket, Key))
+        parts, size = self._uploads[UploadId]
+        if self.keep_data:
+            parts.append(Body)
+        size[0] += len(Body)
+        return {'ETag': self._etag(Body)}
+
+    # pylint: disable-next=unused-argument
+    def upload_part_copy(self, Bucket, Key, UploadId, PartNumber, CopySource,
+                         CopySourceRange, CopySourceIfMatch):
+        self.calls.append(('upload_part_copy', Bucket, Key))
+        data = self.objects[(CopySource['Bucket'], CopySource['Key'])]
+        assert self._etag(data) == CopySourceIfMatch
+        start, end = map(int, CopySourceRange[len('bytes='):].split('-'))
+        body = data[start:end + 1]
+        parts, size = self._uploads[UploadId]
+        if self.keep_data:
+            parts.append(body)
+        size[0] += len(body)
+        return {'CopyPartResult': {'ETag': self._etag(body)}}
+
+    # pylint: disable-next=unused-argument
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        self.calls.append(('complete_multipart_upload', Bucket, Key))
+        parts, size = self._uploads.pop(UploadId)
+        self._store(Bucket, Key, b''.join(parts), size[0])
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.calls.append(('abort_multipart_upload', Bucket, Key))
+        self._uploads.pop(UploadId)
+
+    def head_object(self, Bucket, Key):
+        self.calls.append(('head_object', Bucket, Key))
+        data = self.objects[(Bucket, Key)]
+        return {'ETag': self._etag(data), 'ContentLength': len(data)}
+
+    def get_object(self, Bucket, Key):
+        self.calls.append(('get_object', Bucket, Key))
+        if (Bucket, Key) not in self.objects:
+            code = 'NoSuchKey' if self.list_bucket else 'AccessDenied'
+            raise ClientError({'Error': {'Code': code}}, 'GetObject')
+        data = self.objects[(Bucket, Key)]
+        return {'Body': FakeS3Body(data), 'ETag': self._etag(data),
+                'ContentLength': len(data), 'LastModified': self.modified[(Bucket, Key)]}
+
+    def delete_object(self, Bucket, Key):
+        self.calls.append(('delete_object', Bucket, Key))
+        self.objects.pop((Bucket, Key), None)
+        self.sizes.pop((Bucket, Key), None)
+        self.modified.pop((Bucket, Key), None)
+
+    def count(self, method):
+        return sum(1 for call in self.calls if call[0] == method)
+
+
+class _LocalS3Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+    def _respond(self, status, body=b'', etag=None):
+        self.send_response(status)
+        if etag:
+            self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def _read_body(self):
+        data = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if 'aws-chunked' not in self.headers.get('Content-Encoding', ''):
+            return data
+        # Chunks of ``<size in hex>[;...]\r\n<data>\r\n``, then trailers
+        body, position = b'', 0
+        while True:
+            line_end = data.index(b'\r\n', position)
+            size = int(data[position:line_end].split(b';')[0], 16)
+            if not size:
+                return body
+            body += data[line_end + 2:line_end + 2 + size]
+            position = line_end + 4 + size
+
+    def do_PUT(self):
+        data = self._read_body()
+        self.server.objects[self.path.split('?')[0]] = data
+        self._respond(200, etag='"%s"' % hashlib.md5(data).hexdigest())
+
+    def do_GET(self):
+        data = self.server.objects.get(self.path.split('?')[0])
+        if data is None:
+            self._respond(404)
+        else:
+            self._respond(200, data, '"%s"' % hashlib.md5(data).hexdigest())
+
+    do_HEAD = do_GET
+
+
+class LocalS3Server(ThreadingHTTPServer):
+    """Local HTTP stand-in for the object requests of S3 (PUT, GET and HEAD
+    of whole objects, with path-style URLs), counting the connections
+    opened to it."""
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), _LocalS3Handler)
+        self.objects = {}
+        self.connections = 0
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return 'http://%s:%d' % self.server_address
+
+    def process_request(self, request, client_address):
+        self.connections += 1
+        super().process_request(request, client_address)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+        self.server_close()
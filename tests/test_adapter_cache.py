@@ -0,0 +1,88 @@
+import copy
+import json
+import os
+import unittest
+from mock import patch
+
+from helpers import LambdaContextMock, create_event, create_handler_config
+
+import cumulus_adapter
+from run_cumulus_task import bootstrap, cumulus_task, prepare, run_cumulus_task
+
+
+class TestAdapterCache(unittest.TestCase):
+    def setUp(self):
+        self.osenv = copy.deepcopy(os.environ)
+        os.environ.pop('CUMULUS_MESSAGE_ADAPTER_DISABLED', None)
+        self.task_root = create_handler_config()['task']['root']
+        self.schemas = create_handler_config()['task']['schemas']
+        os.environ['LAMBDA_TASK_ROOT'] = self.task_root
+        bootstrap(refresh=True)
+        cumulus_adapter.clear_cache()
+
+    def tearDown(self):
+        os.environ = self.osenv
+        bootstrap(refresh=True)
+        cumulus_adapter.clear_cache()
+
+    def test_prepare_returns_cached_adapter(self):
+        adapter = prepare(self.schemas)
+        self.assertIs(adapter, prepare(self.schemas))
+        self.assertIs(adapter, cumulus_adapter.get_adapter(self.schemas))
+        self.assertEqual(
+            set(adapter.schema_set.schemas), {'input', 'config', 'output'})
+
+    def test_schema_files_are_read_once(self):
+        def handler_fn(event, context):
+            return {"goodbye": "bye"}
+        with patch('cumulus_adapter.json.load', wraps=json.load) as load_mock:
+            for _ in range(3):
+                run_cumulus_task(handler_fn, create_event(),
+                                 LambdaContextMock(), self.schemas)
+        self.assertEqual(load_mock.call_count, 3)
+
+    def test_modified_schema_file_invalidates_cache(self):
+        adapter = prepare(self.schemas)
+        schema_path = os.path.join(self.task_root, self.schemas['input'])
+        stat = os.stat(schema_path)
+        try:
+            os.utime(schema_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+            self.assertIsNot(adapter, prepare(self.schemas))
+        finally:
+            os.utime(schema_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+    def test_least_recently_used_adapters_are_discarded(self):
+        adapter = prepare(self.schemas)
+        others = [dict(self.schemas, input=path) for path in (
+            'schemas/config.json', 'schemas/output.json', 'schemas/missing.json')]
+        with patch('cumulus_adapter.ADAPTER_CACHE_SIZE', 2):
+            prepare(others[0])
+            self.assertIs(adapter, prepare(self.schemas))
+            prepare(others[1])
+            self.assertIs(adapter, prepare(self.schemas))
+            prepare(others[2])
+            prepare(others[0])
+            self.assertEqual(len(cumulus_adapter._adapters), 2)
+            self.assertIsNot(adapter, prepare(self.schemas))
+
+    def test_missing_schemas_are_ignored(self):
+        adapter = prepare({'input': 'schemas/missing.json'})
+        self.assertNotIn('input', adapter.schema_set.schemas)
+
+    def test_cached_validation_errors(self):
+        def handler_fn(event, context):
+            return {"goodbye": 42}
+        with self.assertRaises(Exception) as raised:
+            run_cumulus_task(handler_fn, create_event(),
+                             LambdaContextMock(), self.schemas)
+        self.assertTrue(raised.exception.message.startswith('output schema: '))
+
+    def test_cumulus_task_decorator(self):
+        @cumulus_task(schemas=self.schemas)
+        def handler(event, context):
+            return {"goodbye": event['config']['Example']['foo']}
+
+        self.assertEqual(len(cumulus_adapter._adapters), 1)
+        response = handler(create_event(), LambdaContextMock())
+        self.assertEqual(response['payload'], {"goodbye": "wut"})
+        self.assertEqual(handler.task_function.__name__, 'handler')
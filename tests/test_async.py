@@ -0,0 +1,69 @@
+import asyncio
+import time
+import unittest
+
+from helpers import LambdaContextMock, create_event
+
+from run_cumulus_task import cumulus_task, run_cumulus_task_async
+
+
+class TestAsyncHandler(unittest.TestCase):
+    def test_simple_handler(self):
+        async def handler_fn(event, context):
+            await asyncio.sleep(0)
+            return event
+        response = asyncio.run(run_cumulus_task_async(
+            handler_fn, create_event(), LambdaContextMock()))
+        self.assertEqual(response['cumulus_meta']['task'], 'Example')
+        self.assertEqual(response['payload']['input']['anykey'], 'anyvalue')
+
+    def test_plain_function(self):
+        def handler_fn(event, context):
+            return event['input']
+        response = asyncio.run(run_cumulus_task_async(handler_fn, create_event()))
+        self.assertEqual(response['payload'], {'anykey': 'anyvalue'})
+
+    def test_workflow_error(self):
+        async def workflow_error_fn(event, context):
+            raise Exception('SomeWorkflowError')
+        response = asyncio.run(run_cumulus_task_async(
+            workflow_error_fn, create_event(), LambdaContextMock()))
+        self.assertIsNone(response['payload'])
+        self.assertEqual(response['exception'], 'SomeWorkflowError')
+
+    def test_other_error(self):
+        async def other_error_fn(event, context):
+            raise Exception('SomeError')
+        with self.assertRaises(Exception) as raised:
+            asyncio.run(run_cumulus_task_async(
+                other_error_fn, create_event(), LambdaContextMock()))
+        self.assertEqual(raised.exception.args[0], 'SomeError')
+
+    def test_task_function_with_additional_arguments(self):
+        async def handler_fn(event, context, taskArgOne):
+            return {"arg": taskArgOne}
+        response = asyncio.run(run_cumulus_task_async(
+            handler_fn, create_event(), taskArgOne="one"))
+        self.assertEqual(response['payload'], {"arg": "one"})
+
+    def test_invocations_overlap(self):
+        async def sleep_fn(event, context):
+            await asyncio.sleep(0.2)
+            return event['input']
+
+        async def run_all():
+            return await asyncio.gather(*(
+                run_cumulus_task_async(sleep_fn, create_event())
+                for _ in range(5)))
+
+        start = time.monotonic()
+        responses = asyncio.run(run_all())
+        self.assertLess(time.monotonic() - start, 0.2 * 5)
+        self.assertEqual(len(responses), 5)
+
+    def test_cumulus_task_decorator_with_coroutine(self):
+        @cumulus_task()
+        async def handler(event, context):
+            return {"async": True}
+        response = handler(create_event(), LambdaContextMock())
+        self.assertEqual(response['payload'], {"async": True})
@@ -0,0 +1,92 @@
+import base64
+import json
+import threading
+import time
+import unittest
+
+from helpers import LambdaContextMock, create_event
+
+from run_cumulus_task import run_cumulus_task_batch
+
+
+def create_sqs_event(messages):
+    return {
+        "Records": [
+            {"messageId": f"message-{i}", "body": json.dumps(message)}
+            for i, message in enumerate(messages)
+        ]
+    }
+
+
+class TestBatchHandler(unittest.TestCase):
+    def test_all_records_succeed(self):
+        seen = []
+
+        def handler_fn(event, context):
+            seen.append(event['input']['index'])
+            return event['input']
+
+        messages = [create_event() for _ in range(5)]
+        for index, message in enumerate(messages):
+            message['payload'] = {"index": index}
+        response = run_cumulus_task_batch(
+            handler_fn, create_sqs_event(messages), LambdaContextMock())
+        self.assertEqual(response, {"batchItemFailures": []})
+        self.assertEqual(sorted(seen), list(range(5)))
+
+    def test_failed_records_are_reported(self):
+        def handler_fn(event, context):
+            if event['input']['index'] % 2:
+                raise Exception('SomeError')
+            return event['input']
+
+        messages = [create_event() for _ in range(4)]
+        for index, message in enumerate(messages):
+            message['payload'] = {"index": index}
+        records = create_sqs_event(messages)['Records']
+        records.append({"messageId": "invalid", "body": "not json"})
+        response = run_cumulus_task_batch(handler_fn, records)
+        self.assertEqual(response["batchItemFailures"], [
+            {"itemIdentifier": "message-1"},
+            {"itemIdentifier": "message-3"},
+            {"itemIdentifier": "invalid"},
+        ])
+
+    def test_workflow_error_does_not_fail_record(self):
+        def workflow_error_fn(event, context):
+            raise Exception('SomeWorkflowError')
+        response = run_cumulus_task_batch(
+            workflow_error_fn, create_sqs_event([create_event()]))
+        self.assertEqual(response, {"batchItemFailures": []})
+
+    def test_kinesis_records(self):
+        def handler_fn(event, context):
+            raise Exception('SomeError')
+        data = base64.b64encode(json.dumps(create_event()).encode()).decode()
+        records = [{"eventID": "shardId-000:1",
+                    "kinesis": {"sequenceNumber": "1", "data": data}}]
+        response = run_cumulus_task_batch(handler_fn, records)
+        self.assertEqual(response["batchItemFailures"], [{"itemIdentifier": "1"}])
+
+    def test_worker_pool_is_bounded(self):
+        lock = threading.Lock()
+        running = [0, 0]
+
+        def handler_fn(event, context):
+            with lock:
+                running[0] += 1
+                running[1] = max(running)
+            time.sleep(0.05)
+            with lock:
+                running[0] -= 1
+            return {}
+
+        messages = [create_event() for _ in range(8)]
+        response = run_cumulus_task_batch(
+            handler_fn, create_sqs_event(messages), max_workers=2)
+        self.assertEqual(response, {"batchItemFailures": []})
+        self.assertEqual(running[1], 2)
+
+    def test_empty_batch(self):
+        self.assertEqual(run_cumulus_task_batch(lambda e, c: e, {"Records": []}),
+                         {"batchItemFailures": []})
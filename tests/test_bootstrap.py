@@ -0,0 +1,69 @@
+import copy
+import dataclasses
+import os
+import subprocess
+import sys
+import unittest
+
+from helpers import LambdaContextMock, create_event
+
+from run_cumulus_task import bootstrap, run_cumulus_task
+
+PACKAGE_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class TestBootstrap(unittest.TestCase):
+    def setUp(self):
+        self.osenv = copy.deepcopy(os.environ)
+        self.stored_sys_path = copy.copy(sys.path)
+
+    def tearDown(self):
+        os.environ = self.osenv
+        sys.path = self.stored_sys_path
+        bootstrap(refresh=True)
+
+    def test_bootstrap_is_idempotent(self):
+        os.environ['CUMULUS_MESSAGE_ADAPTER_DIR'] = '/opt/'
+        settings = bootstrap(refresh=True)
+        self.assertEqual(settings.message_adapter_dir, '/opt/')
+        path_length = len(sys.path)
+        for _ in range(3):
+            run_cumulus_task(lambda event, context: event,
+                             create_event(), LambdaContextMock())
+            bootstrap(refresh=True)
+        self.assertIs(bootstrap(), bootstrap())
+        self.assertEqual(len(sys.path), path_length)
+        self.assertEqual(sys.path.count('/opt/'), 1)
+
+    def test_settings_are_frozen(self):
+        settings = bootstrap()
+        with self.assertRaises(dataclasses.FrozenInstanceError):
+            settings.message_adapter_disabled = True
+
+    def test_settings_snapshot_ignores_later_environment_changes(self):
+        bootstrap(refresh=True)
+        os.environ['CUMULUS_MESSAGE_ADAPTER_DISABLED'] = 'true'
+        response = run_cumulus_task(lambda event, context: {"a": 1},
+                                    create_event(), LambdaContextMock())
+        self.assertEqual(response['payload'], {"a": 1})
+
+    def test_heavy_dependencies_are_imported_lazily(self):
+        # The message adapter is only imported when a message is adapted
+        probe = (
+            "import sys\n"
+            "from helpers import create_event\n"
+            "from run_cumulus_task import bootstrap, run_cumulus_task\n"
+            "bootstrap()\n"
+            "run_cumulus_task(lambda event, context: event, create_event())\n"
+            "print(sorted(m for m in ('boto3', 'jsonschema', 'jsonpath_ng')"
+            " if m in sys.modules))\n"
+        )
+        env = dict(os.environ)
+        env.pop('LAMBDA_TASK_ROOT', None)
+        env['CUMULUS_MESSAGE_ADAPTER_DISABLED'] = 'true'
+        env['PYTHONPATH'] = os.pathsep.join(
+            [PACKAGE_ROOT, os.path.join(PACKAGE_ROOT, 'tests')])
+        output = subprocess.run(
+            [sys.executable, '-c', probe], cwd=PACKAGE_ROOT, env=env,
+            check=True, capture_output=True, text=True).stdout
+        self.assertEqual(output.strip(), '[]')
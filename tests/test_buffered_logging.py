@@ -0,0 +1,208 @@
+import io
+import json
+import logging
+import os
+import threading
+import unittest
+import uuid
+from mock import patch
+
+import cumulus_logger
+from cumulus_logger import BufferedLogHandler, CumulusLogger, flush_logs
+from helpers import LambdaContextMock, create_event
+from run_cumulus_task import run_cumulus_task
+
+
+class GatedHandler(logging.Handler):
+    """Collects formatted messages, blocking until ``gate`` is set."""
+
+    def __init__(self):
+        super().__init__()
+        self.gate = threading.Event()
+        self.messages = []
+
+    def emit(self, record):
+        self.gate.wait()
+        self.messages.append(record.getMessage())
+
+
+def make_record(message, level=logging.INFO):
+    return logging.makeLogRecord(
+        {'msg': message, 'levelno': level, 'levelname': logging.getLevelName(level)})
+
+
+class TestBufferedLogHandler(unittest.TestCase):
+    def setUp(self):
+        self.target = GatedHandler()
+
+    def handler(self, **kwargs):
+        handler = BufferedLogHandler(self.target, **kwargs)
+        self.addCleanup(handler.close)
+        self.addCleanup(self.target.gate.set)
+        return handler
+
+    def fill(self, handler, records):
+        # the first record is taken by the worker thread, which then blocks
+        handler.emit(make_record('first'))
+        while handler._records:
+            pass
+        for record in records:
+            handler.emit(record)
+
+    def test_records_are_written_in_order(self):
+        handler = self.handler()
+        self.target.gate.set()
+        for i in range(100):
+            handler.emit(make_record(str(i)))
+        self.assertTrue(handler.flush(timeout=5))
+        self.assertEqual(self.target.messages, [str(i) for i in range(100)])
+
+    def test_emit_does_not_wait_for_target(self):
+        handler = self.handler()
+        self.fill(handler, [make_record('a'), make_record('b')])
+        self.assertEqual(self.target.messages, [])
+        self.assertFalse(handler.flush(timeout=0.01))
+        self.target.gate.set()
+        self.assertTrue(handler.flush(timeout=5))
+        self.assertEqual(self.target.messages, ['first', 'a', 'b'])
+
+    def test_drop_oldest(self):
+        handler = self.handler(capacity=2, overflow='drop-oldest')
+        self.fill(handler, [make_record(m) for m in 'abcd'])
+        self.target.gate.set()
+        handler.flush(timeout=5)
+        self.assertEqual(self.target.messages[:3], ['first', 'c', 'd'])
+        self.assertEqual(json.loads(self.target.messages[3])['message'],
+                         'Dropped 2 log records')
+
+    def test_drop_debug(self):
+        handler = self.handler(capacity=2, overflow='drop-debug')
+        self.fill(handler, [make_record('a', logging.DEBUG), make_record('b'),
+                            make_record('c', logging.DEBUG), make_record('d')])
+        self.target.gate.set()
+        handler.flush(timeout=5)
+        self.assertEqual(self.target.messages[:3], ['first', 'b', 'd'])
+        self.assertIn('Dropped 2 log records', self.target.messages[3])
+
+    def test_block(self):
+        handler = self.handler(capacity=1, overflow='block')
+        self.fill(handler, [make_record('a')])
+        emitter = threading.Thread(target=handler.emit, args=(make_record('b'),))
+        emitter.start()
+        emitter.join(timeout=0.05)
+        self.assertTrue(emitter.is_alive())
+        self.target.gate.set()
+        emitter.join(timeout=5)
+        handler.flush(timeout=5)
+        self.assertEqual(self.target.messages, ['first', 'a', 'b'])
+        self.assertEqual(handler.dropped, 0)
+
+    @unittest.skipUnless(hasattr(os, 'fork'), 'requires fork')
+    def test_forked_child(self):
+        handler = self.handler()
+        self.fill(handler, [make_record('a')])
+        pid = os.fork()
+        if pid == 0:
+            # The parent's records and writer thread are not inherited
+            self.target.gate.set()
+            handler.emit(make_record('child'))
+            written = handler.flush(timeout=5) and self.target.messages == ['child']
+            os._exit(0 if written else 1)
+        self.assertEqual(os.waitstatus_to_exitcode(os.waitpid(pid, 0)[1]), 0)
+        self.target.gate.set()
+        handler.flush(timeout=5)
+        self.assertEqual(self.target.messages, ['first', 'a'])
+
+    def test_invalid_overflow_policy(self):
+        with self.assertRaises(ValueError):
+            BufferedLogHandler(self.target, overflow='drop-newest')
+
+
+class TestBufferedCumulusLogger(unittest.TestCase):
+    def setUp(self):
+        self.name = f'test-{uuid.uuid4()}'
+
+    def tearDown(self):
+        logger = logging.getLogger(self.name)
+        for handler in list(logger.handlers):
+            logger.removeHandler(handler)
+            handler.close()
+
+    def test_buffered_logger(self):
+        logger = CumulusLogger(self.name, buffered=True)
+        handler, = logger.logger.handlers
+        self.assertIsInstance(handler, BufferedLogHandler)
+        target = GatedHandler()
+        target.gate.set()
+        handler.target = target
+        logger.setMetadata(create_event(), LambdaContextMock())
+        logger.info('hello {}', 'world')
+        logger.flush()
+        self.assertEqual(json.loads(target.messages[0])['message'], 'hello world')
+
+    def test_messages_are_formatted_when_logged(self):
+        logger = CumulusLogger(self.name, buffered=True)
+        handler, = logger.logger.handlers
+        target = GatedHandler()
+        handler.target = target
+        granules = ['a']
+        message = {'message': 'queued', 'granules': granules}
+        logger.info(message)
+        logger.info('granules {}', granules)
+        granules.append('b')
+        message['message'] = 'updated'
+        target.gate.set()
+        logger.flush()
+        first, second = (json.loads(logged) for logged in target.messages)
+        self.assertEqual((first['message'], first['granules']), ('queued', ['a']))
+        self.assertEqual(second['message'], "granules ['a']")
+
+    def test_env_var(self):
+        with patch.dict('os.environ', {'CUMULUS_LOGGER_BUFFERED': 'true',
+                                       'CUMULUS_LOGGER_BUFFER_SIZE': '5',
+                                       'CUMULUS_LOGGER_OVERFLOW': 'drop-oldest'}):
+            handler, = CumulusLogger(self.name).logger.handlers
+        self.assertEqual((handler.capacity, handler.overflow), (5, 'drop-oldest'))
+
+    def test_unbuffered_by_default(self):
+        handler, = CumulusLogger(self.name).logger.handlers
+        self.assertNotIsInstance(handler, BufferedLogHandler)
+
+
+class TestFlushAtInvocationEnd(unittest.TestCase):
+    def test_flush_on_return(self):
+        with patch('run_cumulus_task.flush_logs') as flush:
+            run_cumulus_task(lambda event, context: {}, create_event(),
+                             LambdaContextMock())
+        flush.assert_called_once_with()
+
+    def test_flush_on_raise(self):
+        def handler_fn(event, context):
+            raise RuntimeError('boom')
+        with patch('run_cumulus_task.flush_logs') as flush:
+            with self.assertRaises(RuntimeError):
+                run_cumulus_task(handler_fn, create_event(), LambdaContextMock())
+        flush.assert_called_once_with()
+
+    def test_flush_logs_with_a_closed_stream(self):
+        stream = io.StringIO()
+        handler = BufferedLogHandler(logging.StreamHandler(stream))
+        self.addCleanup(handler.close)
+        handler.emit(make_record('a'))
+        self.assertTrue(handler.flush(timeout=5))
+        stream.close()
+        with patch('logging.raiseExceptions', False):
+            handler.emit(make_record('b'))
+            flush_logs(timeout=5)
+            self.assertTrue(handler.flush(timeout=5))
+        handler.close()
+        self.assertNotIn(handler, list(cumulus_logger._buffered_handlers))
+
+    def test_flush_logs(self):
+        target = GatedHandler()
+        handler = BufferedLogHandler(target)
+        self.addCleanup(handler.close)
+        handler.emit(make_record('a'))
+        target.gate.set()
+        flush_logs()
+        self.assertEqual(target.messages, ['a'])
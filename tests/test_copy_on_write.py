@@ -0,0 +1,177 @@
+import copy
+import json
+import tracemalloc
+import unittest
+
+from helpers import LambdaContextMock, create_event
+
+from cumulus_adapter import _DictView, _ListView, _view
+from run_cumulus_task import run_cumulus_task
+
+
+def create_large_event(granules=5000):
+    event = create_event()
+    event['payload'] = {
+        "granules": [
+            {"granuleId": f"granule-{i}",
+             "files": [{"bucket": "protected", "key": f"granule-{i}.h5",
+                        "checksum": {"type": "md5", "value": str(i)}}]}
+            for i in range(granules)
+        ]
+    }
+    return event
+
+
+def traced_peak(function, *args):
+    tracemalloc.start()
+    try:
+        function(*args)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+class TestViews(unittest.TestCase):
+    def test_views_copy_what_they_update(self):
+        source = {"a": {"b": [1, {"c": 2}]}, "d": [3]}
+        snapshot = copy.deepcopy(source)
+        view = _view(source)
+        view["a"]["b"][1]["c"] = 20
+        view["a"]["b"].append(4)
+        view["d"].pop()
+        view["e"] = 5
+        self.assertEqual(source, snapshot)
+        self.assertEqual(view, {"a": {"b": [1, {"c": 20}, 4]}, "d": [], "e": 5})
+        self.assertEqual(json.loads(json.dumps(view)), view)
+
+    def test_views_through_iteration(self):
+        source = {"granules": [{"id": 1}, {"id": 2}], "other": {"x": []}}
+        snapshot = copy.deepcopy(source)
+        view = _view(source)
+        for granule in view["granules"]:
+            granule["id"] += 10
+        for granule in reversed(view["granules"]):
+            granule["seen"] = True
+        for value in view.values():
+            self.assertIsInstance(value, (_DictView, _ListView))
+        for _, value in view.items():
+            value.clear()
+        view.get("other").setdefault("y", []).append(1)
+        self.assertEqual(source, snapshot)
+
+    def test_unvisited_parts_are_shared(self):
+        source = {"visited": {"x": 1}, "unvisited": {"y": [2]}}
+        view = _view(source)
+        view["visited"]["x"] = 2
+        self.assertIs(dict.__getitem__(view, "unvisited"), source["unvisited"])
+        self.assertIsInstance(view, dict)
+        self.assertIsInstance(view["visited"], dict)
+
+    def test_slices_and_copies_are_views(self):
+        source = [{"a": 1}, {"a": 2}]
+        view = _view(source)
+        view[:1][0]["a"] = 10
+        view.copy()[1]["a"] = 20
+        copy.deepcopy(view)[0]["a"] = 30
+        self.assertEqual(source, [{"a": 1}, {"a": 2}])
+
+    def test_concatenations_are_views(self):
+        source = {"granules": [{"a": 1}, {"a": 2}], "meta": {"b": {"c": 3}}}
+        snapshot = copy.deepcopy(source)
+        view = _view(source)
+        combined = view["granules"] + [{"a": 3}]
+        combined[0]["a"] = 10
+        ([{"a": 0}] + view["granules"])[1]["a"] = 10
+        (view["granules"] * 2)[3]["a"] = 20
+        (2 * view["granules"])[0]["a"] = 20
+        (view["meta"] | {"d": 4})["b"]["c"] = 30
+        ({"d": 4} | view["meta"])["b"]["c"] = 30
+        self.assertEqual(source, snapshot)
+        self.assertEqual(combined, [{"a": 10}, {"a": 2}, {"a": 3}])
+        self.assertIsInstance(combined, _ListView)
+
+
+class TestCopyOnWrite(unittest.TestCase):
+    def test_task_updates_do_not_change_the_incoming_message(self):
+        event = create_large_event(10)
+        snapshot = copy.deepcopy(event)
+
+        def task(nested, context):
+            nested['input']['granules'][0]['granuleId'] = 'updated'
+            nested['input']['granules'].append({'granuleId': 'new'})
+            nested['config']['Example']['foo'] = 'updated'
+            return nested['input']
+
+        result = run_cumulus_task(task, event, LambdaContextMock())
+        self.assertEqual(event, snapshot)
+        self.assertEqual(result['payload']['granules'][0]['granuleId'], 'updated')
+        self.assertEqual(len(result['payload']['granules']), 11)
+        self.assertEqual(result['task_config'], snapshot['task_config'])
+        self.assertNotIn('workflow_tasks', event['meta'])
+        self.assertEqual(len(result['meta']['workflow_tasks']), 1)
+
+    def test_copies_made_by_the_task_do_not_change_the_incoming_message(self):
+        event = create_large_event(10)
+        snapshot = copy.deepcopy(event)
+
+        def task(nested, context):
+            granules = dict(nested['input'])['granules']
+            granules[0]['files'][0]['checksum']['value'] = 'updated'
+            {**nested['input']}['granules'][1]['granuleId'] = 'updated'
+            (nested['input']['granules'] + [])[2]['granuleId'] = 'updated'
+            dict(nested['config'])['Example']['foo'] = 'updated'
+            return {**nested['input']}
+
+        result = run_cumulus_task(task, event, LambdaContextMock())
+        self.assertEqual(event, snapshot)
+        self.assertEqual(result['payload']['granules'][0]['files'][0]['checksum'],
+                         {"type": "md5", "value": "updated"})
+        self.assertEqual(result['payload']['granules'][1]['granuleId'], 'updated')
+
+    def test_unchanged_parts_are_reused(self):
+        event = create_large_event(10)
+        result = run_cumulus_task(
+            lambda nested, context: {"count": 1}, event, LambdaContextMock())
+        self.assertIs(result['cumulus_meta'], event['cumulus_meta'])
+        self.assertIs(result['meta']['input_granules'], event['meta']['input_granules'])
+        self.assertIsNot(result['meta'], event['meta'])
+
+    def test_stored_outputs_do_not_change_the_incoming_message(self):
+        event = create_large_event(10)
+        event['meta']['output_granules'] = {"existing": True}
+        event['task_config']['cumulus_message'] = {
+            "outputs": [{"source": "{$.count}",
+                         "destination": "{$.meta.output_granules.count}"}]}
+        snapshot = copy.deepcopy(event)
+        result = run_cumulus_task(
+            lambda nested, context: {"count": 1}, event, LambdaContextMock())
+        self.assertEqual(event, snapshot)
+        self.assertEqual(result['meta']['output_granules'],
+                         {"existing": True, "count": 1})
+
+
+class TestMemoryRegression(unittest.TestCase):
+    """The adapter must not duplicate the message: its peak allocation, which
+    was over twice the size of the message when the message was deep copied,
+    must stay a fraction of it.  What remains is mostly the granule metadata
+    of the logger, and the views of the granules a task visits."""
+
+    def test_identity_task(self):
+        event = create_large_event()
+        message_size = traced_peak(create_large_event)
+        run_cumulus_task(lambda nested, context: nested['input'], event)
+        peak = traced_peak(
+            run_cumulus_task, lambda nested, context: nested['input'], event)
+        self.assertLess(peak, message_size / 4)
+
+    def test_task_visiting_its_input(self):
+        event = create_large_event()
+        message_size = traced_peak(create_large_event)
+
+        def task(nested, context):
+            return {"ids": [granule['granuleId']
+                            for granule in nested['input']['granules']]}
+
+        run_cumulus_task(task, event)
+        peak = traced_peak(run_cumulus_task, task, event)
+        self.assertLess(peak, message_size / 2)
@@ -0,0 +1,175 @@
+import copy
+import os
+import unittest
+from mock import patch
+
+from helpers import LambdaContextMock, create_event, create_handler_config
+
+from run_cumulus_task import bootstrap
+
+bootstrap()
+# pylint: disable=wrong-import-position
+import cumulus_adapter
+from cumulus_adapter import (
+    CumulusMessageAdapter, SchemaSet, _cache_key, _resolve_config_object,
+    _resolve_path_str)
+import jsonpath_ng
+from message_adapter.message_adapter import MessageAdapter
+
+
+def create_templated_event():
+    event = create_event()
+    event['task_config']['Example'].update({
+        "stack": "{$.meta.stack}",
+        "granules": "{{$.meta.input_granules}}",
+        "ids": "{[$.meta.input_granules[*].granuleId]}",
+        "list": ["{$.meta.foo}", "plain"],
+        "cumulus_message": {
+            "input": "{$.meta.input_granules}",
+            "outputs": [{"source": "{$.input}", "destination": "{$.payload}"}]
+        }
+    })
+    event['task_config']['cumulus_message'] = {
+        "input": "{{$.meta.input_granules}}",
+        "outputs": [
+            {"source": "{$.granules}", "destination": "{$.meta.output_granules}"},
+            {"source": "{$}", "destination": "{$.payload}"}
+        ]
+    }
+    event['ReplaceConfig'] = {"FullMessage": True, "MaxSize": 10 ** 9}
+    return event
+
+
+def create_cma_event():
+    return {
+        "cma": {
+            "event": create_templated_event(),
+            "task_config": {"cma": "{$.meta.foo}"},
+        }
+    }
+
+
+class TestCumulusMessageAdapterConformance(unittest.TestCase):
+    """CumulusMessageAdapter must produce the same events as MessageAdapter."""
+
+    def assert_conforms(self, event, schemas=None, handler=None):
+        handler = handler or (lambda nested: {"granules": nested['input']})
+        context = vars(LambdaContextMock())
+        expected_adapter = MessageAdapter(schemas)
+        schema_set = SchemaSet((schema_type, path)
+                               for schema_type, path, _ in _cache_key(schemas))
+        actual_adapter = CumulusMessageAdapter(schemas, schema_set)
+
+        expected_full = expected_adapter.load_and_update_remote_event(
+            copy.deepcopy(event), context)
+        actual_full = actual_adapter.load_and_update_remote_event(
+            copy.deepcopy(event), context)
+        self.assertEqual(actual_full, expected_full)
+
+        expected_nested = expected_adapter.load_nested_event(expected_full)
+        actual_nested = actual_adapter.load_nested_event(actual_full)
+        self.assertEqual(actual_nested, expected_nested)
+        self.assertEqual(actual_full, expected_full)
+
+        message_config = expected_nested.get('messageConfig')
+        expected_next = expected_adapter.create_next_event(
+            handler(expected_nested), expected_full, message_config)
+        actual_next = actual_adapter.create_next_event(
+            handler(actual_nested), actual_full, message_config)
+        self.assertEqual(actual_next, expected_next)
+
+    def test_simple_event(self):
+        self.assert_conforms(create_event())
+
+    def test_event_without_meta(self):
+        event = create_event()
+        del event['meta']
+        del event['task_config']
+        self.assert_conforms(event)
+
+    def test_templated_event(self):
+        self.assert_conforms(create_templated_event())
+
+    def test_parameter_configured_event(self):
+        self.assert_conforms(create_cma_event())
+
+    def test_root_output_destination(self):
+        event = create_event()
+        event['task_config']['cumulus_message'] = {
+            "outputs": [{"source": "{$.granules}", "destination": "{$}"}]}
+        self.assert_conforms(event)
+
+    def test_is_a_message_adapter(self):
+        self.assertTrue(issubclass(CumulusMessageAdapter, MessageAdapter))
+
+    def test_event_with_schemas(self):
+        task = create_handler_config()['task']
+        osenv = copy.deepcopy(os.environ)
+        try:
+            os.environ['LAMBDA_TASK_ROOT'] = task['root']
+            self.assert_conforms(create_event(), task['schemas'],
+                                 lambda nested: {"goodbye": "bye"})
+        finally:
+            os.environ = osenv
+
+    def test_validation_error_message(self):
+        task = create_handler_config()['task']
+        schema_set = SchemaSet(
+            [('input', os.path.join(task['root'], task['schemas']['input']))])
+        adapter = CumulusMessageAdapter(task['schemas'], schema_set)
+        event = create_event()
+        event['payload'] = {"hello": 1}
+        with self.assertRaises(Exception) as raised:
+            adapter.load_nested_event(event)
+        self.assertTrue(raised.exception.message.startswith('input schema: '))
+
+
+class TestCompiledTemplates(unittest.TestCase):
+    """Compiled templates must resolve as ``resolve_path_str`` does."""
+    templates = [
+        "plain", "{$.meta.stack}", "{{$.meta.stack}}", "{$.meta.missing}",
+        "{$.meta.input_granules[0].granuleId}", "{[$.meta.input_granules[*].granuleId]}",
+        "{[$.meta.stack]}", "{[$.meta.missing]}", "{$}", "{$.meta.where}",
+        "s3://{$.meta.stack}/{$.meta.missing}/{$.meta.stack}", "{$.payload.x.y}",
+        "{not a template", "{$.meta.input_granules}",
+    ]
+
+    def setUp(self):
+        self.addCleanup(cumulus_adapter.clear_cache)
+        self.event = create_event()
+        self.event['meta']['where'] = 'here'
+        self.event['payload'] = {"x": ["y"]}
+
+    def test_conforms(self):
+        from message_adapter.cumulus_message import resolve_path_str
+        for template in self.templates:
+            with self.subTest(template=template):
+                try:
+                    expected = resolve_path_str(self.event, template)
+                except Exception as exception:  # pylint: disable=broad-except
+                    with self.assertRaises(type(exception)):
+                        _resolve_path_str(self.event, template)
+                else:
+                    self.assertEqual(_resolve_path_str(self.event, template), expected)
+
+    def test_json_paths_are_parsed_once(self):
+        config = {"ids": "{[$.meta.input_granules[*].granuleId]}",
+                  "nested": [{"stack": "{$.meta.stack}"}, "plain"]}
+        with patch('jsonpath_ng.parse', wraps=jsonpath_ng.parse) as parse:
+            for _ in range(3):
+                resolved = _resolve_config_object(self.event, copy.deepcopy(config))
+        self.assertEqual(parse.call_count, 1)
+        self.assertEqual(resolved, {"ids": ["id1", "id2"],
+                                    "nested": [{"stack": "Sleestak"}, "plain"]})
+
+    def test_plans_are_cached_per_task_config(self):
+        config = {"stack": "{$.meta.stack}"}
+        for stack in ('a', 'b'):
+            self.event['meta']['stack'] = stack
+            self.assertEqual(_resolve_config_object(self.event, dict(config)),
+                             {"stack": stack})
+        self.assertEqual(len(cumulus_adapter._config_plans), 1)
+        _resolve_config_object(self.event, {"stack": "{$.meta.stack}", "other": 1})
+        self.event['cumulus_meta']['task'] = 'other-task'
+        _resolve_config_object(self.event, dict(config))
+        self.assertEqual(len(cumulus_adapter._config_plans), 3)
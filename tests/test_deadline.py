@@ -0,0 +1,167 @@
+import asyncio
+import json
+import unittest
+from mock import patch
+
+from helpers import DeadlineContextMock, FakeS3Client, LambdaContextMock, create_event
+
+from cumulus_deadline import CheckpointSaved, Deadline, DeadlineExceeded
+from run_cumulus_task import run_cumulus_task, run_cumulus_task_async
+
+
+def create_granules_event(count=10):
+    event = create_event()
+    event['cumulus_meta']['system_bucket'] = 'bucket'
+    event['payload'] = {"granules": [{"granuleId": f"granule-{i}"} for i in range(count)]}
+    return event
+
+
+def process(event, context, deadline, per_attempt=4):
+    """Processes ``per_attempt`` granules, then checks its deadline."""
+    state = deadline.checkpoint or {"processed": []}
+    processed = list(state["processed"])
+    for granule in event['input']['granules'][len(processed):]:
+        if len(processed) - len(state["processed"]) == per_attempt:
+            deadline.check({"processed": processed})
+        processed.append(granule['granuleId'])
+    return {"processed": processed}
+
+
+class TestDeadline(unittest.TestCase):
+    def test_expired(self):
+        self.assertFalse(Deadline(DeadlineContextMock(5000), margin_ms=1000).expired)
+        self.assertTrue(Deadline(DeadlineContextMock(500), margin_ms=1000).expired)
+        self.assertFalse(Deadline(LambdaContextMock(), margin_ms=1000).expired)
+        self.assertIsNone(Deadline().remaining_ms())
+
+    def test_check(self):
+        Deadline(DeadlineContextMock(5000), margin_ms=1000).check({"a": 1})
+        with self.assertRaises(DeadlineExceeded) as raised:
+            Deadline(DeadlineContextMock(0)).check({"a": 1})
+        self.assertEqual(raised.exception.checkpoint, {"a": 1})
+        self.assertEqual(DeadlineExceeded().checkpoint, {})
+
+
+class TestCheckpoint(unittest.TestCase):
+    def setUp(self):
+        self.s3 = FakeS3Client()
+        patcher = patch('cumulus_remote.s3_client', side_effect=lambda: self.s3)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def run_attempts(self, run, task, **taskargs):
+        """Runs ``task`` on the same message until it no longer stops at its
+        deadline, as the Retry of its state would, and returns the outgoing
+        message and the checkpoints saved."""
+        checkpoints = []
+        while True:
+            try:
+                return run(task, create_granules_event(), DeadlineContextMock(0),
+                           **taskargs), checkpoints
+            except CheckpointSaved as error:
+                checkpoints.append(json.loads(self.s3.objects[(error.bucket, error.key)]))
+
+    def test_resume_from_checkpoint(self):
+        result, checkpoints = self.run_attempts(run_cumulus_task, process)
+        self.assertEqual(checkpoints, [
+            {"state": {"processed": [f"granule-{i}" for i in range(4)]}},
+            {"state": {"processed": [f"granule-{i}" for i in range(8)]}}])
+        self.assertEqual(result['payload'],
+                         {"processed": [f"granule-{i}" for i in range(10)]})
+        self.assertNotIn('checkpoint', result['cumulus_meta'])
+        # Every attempt saves its checkpoint where the next one finds it
+        self.assertEqual(len({key for _, _, key in self.s3.calls}), 1)
+        # and the last one deletes it
+        self.assertEqual(self.s3.calls[-1][0], 'delete_object')
+        self.assertEqual(self.s3.objects, {})
+
+    def test_checkpoint_kept_if_resumed_task_fails(self):
+        def fail(event, context, deadline):
+            if deadline.checkpoint:
+                raise RuntimeError('boom')
+            deadline.check({"processed": []})
+        with self.assertRaises(CheckpointSaved):
+            run_cumulus_task(fail, create_granules_event(), DeadlineContextMock(0))
+        with self.assertRaises(RuntimeError):
+            run_cumulus_task(fail, create_granules_event(), DeadlineContextMock(0))
+        self.assertEqual(len(self.s3.objects), 1)
+        self.assertEqual(self.s3.count('delete_object'), 0)
+
+    def test_missing_checkpoint_without_list_bucket(self):
+        self.s3.list_bucket = False
+        result, checkpoints = self.run_attempts(run_cumulus_task, process)
+        self.assertEqual(len(checkpoints), 2)
+        self.assertEqual(len(result['payload']['processed']), 10)
+
+    def test_no_lookup_for_tasks_not_given_a_deadline(self):
+        def task(event, context, deadline=None):
+            return {}
+        run_cumulus_task(lambda event, context: {}, create_granules_event(),
+                         LambdaContextMock())
+        run_cumulus_task(task, create_granules_event(), LambdaContextMock(),
+                         deadline=Deadline())
+        self.assertEqual(self.s3.calls, [])
+
+    def test_unhashable_task(self):
+        class Task:
+            __hash__ = None
+
+            def __call__(self, event, context, deadline):
+                return process(event, context, deadline)
+        result, checkpoints = self.run_attempts(run_cumulus_task, Task())
+        self.assertEqual(len(checkpoints), 2)
+        self.assertEqual(len(result['payload']['processed']), 10)
+
+    def test_checkpoint_is_per_message(self):
+        with self.assertRaises(CheckpointSaved) as first:
+            run_cumulus_task(process, create_granules_event(), DeadlineContextMock(0))
+        other = create_granules_event()
+        other['cumulus_meta']['execution_name'] = 'other'
+        with self.assertRaises(CheckpointSaved) as second:
+            run_cumulus_task(process, other, DeadlineContextMock(0))
+        self.assertNotEqual(first.exception.key, second.exception.key)
+
+    def test_deadline_exceeded_without_a_bucket(self):
+        event = create_granules_event()
+        del event['cumulus_meta']['system_bucket']
+        with self.assertRaises(DeadlineExceeded):
+            run_cumulus_task(process, event, DeadlineContextMock(0))
+        self.assertEqual(self.s3.calls, [])
+
+    def test_message_adapter_disabled(self):
+        def process_message(event, context, deadline):
+            nested_event = {"input": event['payload']}
+            return dict(event, payload=process(nested_event, context, deadline))
+        with patch('run_cumulus_task._settings', None), \
+                patch.dict('os.environ', {'CUMULUS_MESSAGE_ADAPTER_DISABLED': 'true'}):
+            result, checkpoints = self.run_attempts(run_cumulus_task, process_message)
+        self.assertEqual(len(checkpoints), 2)
+        self.assertEqual(len(result['payload']['processed']), 10)
+
+    def test_deadline_only_for_tasks_taking_one(self):
+        received = []
+
+        def task(event, context, **kwargs):
+            received.append(kwargs)
+            return {}
+        run_cumulus_task(task, create_event(), LambdaContextMock(), extra=1)
+        self.assertEqual(received, [{"extra": 1}])
+
+    def test_async_task(self):
+        async def task(event, context, deadline):
+            deadline.check({"processed": []})
+            return {}
+        with self.assertRaises(CheckpointSaved) as raised:
+            asyncio.run(run_cumulus_task_async(
+                task, create_granules_event(), DeadlineContextMock(0)))
+        self.assertEqual(json.loads(self.s3.objects[('bucket', raised.exception.key)]),
+                         {"state": {"processed": []}})
+
+    def test_async_task_resumed(self):
+        async def task(event, context, deadline):
+            return process(event, context, deadline)
+        result, checkpoints = self.run_attempts(
+            lambda *args: asyncio.run(run_cumulus_task_async(*args)), task)
+        self.assertEqual(len(checkpoints), 2)
+        self.assertEqual(len(result['payload']['processed']), 10)
+        self.assertEqual(self.s3.objects, {})
@@ -6,7 +6,7 @@ import unittest
 
 from helpers import LambdaContextMock, create_event, create_handler_config
 
-from run_cumulus_task import run_cumulus_task, set_sys_path
+from run_cumulus_task import bootstrap, run_cumulus_task, set_sys_path
 
 
 class TestSledHandler(unittest.TestCase):
@@ -16,6 +16,7 @@ class TestSledHandler(unittest.TestCase):
     @classmethod
     def tearDownClass(cls):
         os.environ = cls.osenv
+        bootstrap(refresh=True)
     @patch('os.path.isfile')
     def test_set_sys_path_sets_adapter_dir_paths(self, isfile_mock):
         isfile_mock.value = True
@@ -33,6 +34,7 @@ class TestSledHandler(unittest.TestCase):
             return {"message": "hello"}
 
         os.environ['CUMULUS_MESSAGE_ADAPTER_DISABLED'] = 'true'
+        bootstrap(refresh=True)
         test_event = create_event()
         context = LambdaContextMock()
         response = run_cumulus_task(
@@ -45,6 +47,7 @@ class TestSledHandler(unittest.TestCase):
             raise empty_exception
 
         os.environ['CUMULUS_MESSAGE_ADAPTER_DISABLED'] = 'true'
+        bootstrap(refresh=True)
         test_event = create_event()
         context = LambdaContextMock()
         try:
@@ -0,0 +1,165 @@
+import importlib.util
+import json
+import unittest
+from mock import patch
+
+from helpers import LambdaContextMock, create_event, create_parameter_event
+
+import cumulus_json
+from cumulus_logger import CumulusLogger
+
+
+def installed(module):
+    return importlib.util.find_spec(module) is not None
+
+
+def create_message_shapes():
+    event = create_event()
+    event['meta']['workflow_tasks'] = {
+        0: {"name": "task", "version": 1, "arn": "arn:aws:lambda:us-east-1:123:function:task"}
+    }
+    event['payload'] = {
+        "granules": [
+            {
+                "granuleId": f"MOD09GQ.A{i}.h00v00.006",
+                "dataType": "MOD09GQ",
+                "version": "006",
+                "sync_granule_duration": 1234,
+                "files": [{
+                    "bucket": "protected",
+                    "key": f"MOD09GQ/{i}/granule.hdf",
+                    "fileName": "granule.hdf",
+                    "size": 2 ** 40 + i,
+                    "checksum": "d41d8cd98f00b204e9800998ecf8427e",
+                    "checksumType": "md5",
+                    "ratio": 0.25 * i,
+                    "published": i % 2 == 0,
+                    "description": None,
+                }],
+            }
+            for i in range(50)
+        ],
+        "pdr": {"name": "PDN 'quoted' \"name\"", "path": "/pdrs/a\\b"},
+    }
+    return [
+        event,
+        create_parameter_event(),
+        {"message": "Unicode: é ü 東京 😀  ", "level": "info"},
+        {"message": "Control: \x00 \x1f \t\n\r \x7f </script>", "level": "debug"},
+        {"granules": [], "meta": {}, "empty": "", "negative": -1, "float": 1.5},
+        ["top", "level", ["list", {"nested": [True, False, None]}]],
+        "a string",
+        42,
+        None,
+    ]
+
+
+class CodecCompatibilityMixin:
+    codec = None
+
+    def setUp(self):
+        self.previous = cumulus_json.codec_name
+        cumulus_json.set_codec(self.codec)
+
+    def tearDown(self):
+        cumulus_json.set_codec(self.previous)
+
+    def test_dumps_matches_standard_library(self):
+        for shape in create_message_shapes():
+            expected = json.dumps(shape)
+            self.assertEqual(cumulus_json.dumps(shape), expected)
+            self.assertEqual(cumulus_json.dumpb(shape), expected.encode('utf-8'))
+
+    def test_compact_encoding(self):
+        for shape in create_message_shapes():
+            expected = json.dumps(shape, ensure_ascii=False, separators=(',', ':'))
+            self.assertEqual(cumulus_json.dumpb_compact(shape), expected.encode('utf-8'))
+
+    def test_loads_matches_standard_library(self):
+        for shape in create_message_shapes():
+            document = json.dumps(shape)
+            self.assertEqual(cumulus_json.loads(document), json.loads(document))
+            self.assertEqual(cumulus_json.loads(document.encode('utf-8')),
+                             json.loads(document))
+
+    def test_values_beyond_backend_range_fall_back(self):
+        value = {"big": 2 ** 70}
+        self.assertEqual(cumulus_json.dumpb_compact(value), b'{"big":%d}' % 2 ** 70)
+        self.assertEqual(cumulus_json.loads('{"big": %d}' % 2 ** 70), value)
+
+    def test_non_finite_floats_round_trip(self):
+        value = {"values": [float('nan'), float('inf'), -float('inf'), None]}
+        self.assertEqual(cumulus_json.dumps(value), json.dumps(value))
+        expected = json.dumps(value, separators=(',', ':'))
+        self.assertEqual(cumulus_json.dumpb_compact(value), expected.encode('utf-8'))
+        decoded = cumulus_json.loads(expected)
+        self.assertEqual(json.dumps(decoded), json.dumps(value))
+
+    def test_lone_surrogates_are_escaped(self):
+        name = b'granule-\xff.hdf'.decode('utf-8', 'surrogateescape')
+        self.assertEqual(cumulus_json.dumps([name, "é"]), json.dumps([name, "é"]))
+        expected = json.dumps([name, "é"], separators=(',', ':'))
+        self.assertEqual(cumulus_json.dumpb_compact([name, "é"]), expected.encode('ascii'))
+        self.assertEqual(cumulus_json.loads(expected), [name, "é"])
+
+        logger = CumulusLogger('codec_test')
+        with self.assertLogs('codec_test') as logs:
+            logger.info("file {}", name)
+        self.assertEqual(json.loads(logs.records[0].getMessage())['message'],
+                         f'file {name}')
+
+    def test_unserializable_values_raise_type_error(self):
+        with self.assertRaises(TypeError):
+            cumulus_json.dumps({"value": object()})
+        with self.assertRaises(TypeError):
+            cumulus_json.dumpb_compact({"value": object()})
+
+    @patch('cumulus_logger._timestamp', lambda: '2020-01-01T00:00:00.000001')
+    def test_log_lines_match_previous_encoding(self):
+        # Log lines used to be json.dumps(msg), msg being createMessage(...)
+        # plus the level
+        logger = CumulusLogger('codec_test')
+        logger.setMetadata(create_event(), LambdaContextMock())
+        messages = [
+            ("test {}", "codec"),
+            ("Unicode: é 東京 😀 \x00 </script>",),
+            ({"message": "mapping", "count": 1.5, "nested": {"a": [None, True]}},),
+            ({"sender": "overridden", "message": "collision", "level": "debug"},),
+            ({"timestamp": "overridden", "message": "collision"},),
+        ]
+        for args in messages:
+            with self.subTest(message=args[0]):
+                expected = logger.createMessage(*args)
+                expected["level"] = "info"
+                with self.assertLogs('codec_test') as logs:
+                    logger.info(*args)
+                self.assertEqual(logs.records[0].getMessage(), json.dumps(expected))
+
+
+class TestStandardLibraryCodec(CodecCompatibilityMixin, unittest.TestCase):
+    codec = 'json'
+
+
+@unittest.skipUnless(installed('orjson'), 'orjson is not installed')
+class TestOrjsonCodec(CodecCompatibilityMixin, unittest.TestCase):
+    codec = 'orjson'
+
+
+@unittest.skipUnless(installed('ujson'), 'ujson is not installed')
+class TestUjsonCodec(CodecCompatibilityMixin, unittest.TestCase):
+    codec = 'ujson'
+
+
+class TestCodecSelection(unittest.TestCase):
+    def test_unsupported_codec(self):
+        with self.assertRaises(ValueError):
+            cumulus_json.set_codec('simplejson')
+
+    def test_default_codec_is_fastest_installed(self):
+        expected = next(codec for codec in cumulus_json.CODECS
+                        if codec == 'json' or installed(codec))
+        previous = cumulus_json.codec_name
+        try:
+            self.assertEqual(cumulus_json.set_codec(), expected)
+        finally:
+            cumulus_json.set_codec(previous)
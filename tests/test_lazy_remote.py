@@ -0,0 +1,263 @@
+import copy
+import json
+import tempfile
+import tracemalloc
+import unittest
+from mock import patch
+
+from helpers import FakeS3Client, LambdaContextMock, create_event
+
+import cumulus_json
+from cumulus_adapter import CumulusMessageAdapter, SchemaSet, _resolve_config_object
+from cumulus_remote import iter_json
+from cumulus_streaming import LazyObject, LazyView, load_lazy, parse_lazy_objects
+from run_cumulus_task import run_cumulus_task
+
+
+def create_large_event(granules=2000):
+    event = create_event()
+    event['cumulus_meta']['system_bucket'] = 'bucket'
+    event['meta']['collection'] = {"name": "collection", "files": [
+        {"regex": f"^untouched-{i}$", "bucket": "protected"} for i in range(granules)]}
+    event['payload'] = {
+        "granules": [{"granuleId": f"granule-{i}", "files": [{"key": f"file-{i}"}]}
+                     for i in range(granules)],
+        "pdr": {"name": "pdr", "untouched": ["x" * 100] * granules},
+    }
+    return event
+
+
+def lazy(document):
+    data = json.dumps(document).encode('utf-8')
+    return LazyObject(data, 0, len(data))
+
+
+def remote_message(event, target_path='$'):
+    return {
+        "cumulus_meta": event['cumulus_meta'],
+        "replace": {"Bucket": "bucket", "Key": "events/large", "TargetPath": target_path},
+    }
+
+
+class TestLazyObject(unittest.TestCase):
+    document = {"a": {"b": [1, {"c": "}"}], "d": "x\"y"}, "e": 1, "f": []}
+
+    def setUp(self):
+        patcher = patch('cumulus_streaming.LAZY_OBJECT_BYTES', 0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_behaves_as_a_dict(self):
+        value = lazy(self.document)
+        self.assertIsInstance(value, dict)
+        self.assertEqual(len(value), 3)
+        self.assertEqual(list(value), ["a", "e", "f"])
+        self.assertIn("e", value)
+        self.assertNotIn("g", value)
+        self.assertEqual(value.get("g", 0), 0)
+        self.assertEqual(value, self.document)
+        self.assertEqual(dict(value), self.document)
+        self.assertEqual(json.loads(json.dumps(parse_lazy_objects(value))), self.document)
+
+    def test_members_are_parsed_when_accessed(self):
+        value = lazy(self.document)
+        self.assertEqual(value["e"], 1)
+        self.assertEqual(dict.keys(value), {"e"})
+        self.assertIsInstance(value["a"], LazyObject)
+        self.assertEqual(value["a"]["d"], "x\"y")
+        self.assertFalse(value.parsed)
+
+    def test_large_objects_only_are_lazy(self):
+        with patch('cumulus_streaming.LAZY_OBJECT_BYTES', 20):
+            value = lazy(self.document)
+            self.assertIsInstance(value["a"], LazyObject)
+            self.assertNotIsInstance(value["a"]["b"][1], LazyObject)
+        with patch('cumulus_streaming.LAZY_OBJECT_BYTES', 1000):
+            self.assertNotIsInstance(lazy(self.document)["a"], LazyObject)
+
+    def test_updates_keep_the_member_order(self):
+        value = lazy(self.document)
+        value["e"] = 2
+        del value["a"]
+        value["g"] = 3
+        self.assertEqual(value.pop("f"), [])
+        self.assertTrue(value.parsed)
+        self.assertEqual(list(dict.items(value)), [("e", 2), ("g", 3)])
+
+    def test_copies_are_independent(self):
+        value = lazy(self.document)
+        shallow = copy.copy(value)
+        shallow["e"] = 2
+        deep = copy.deepcopy(value)
+        deep["a"]["b"].append(2)
+        self.assertEqual(value, self.document)
+        self.assertEqual(shallow["a"], self.document["a"])
+
+    def test_raw_members_are_encoded_as_stored(self):
+        value = lazy(self.document)
+        value["e"] = 2
+        encoded = ''.join(iter_json(value))
+        self.assertEqual(json.loads(encoded), dict(self.document, e=2))
+        self.assertIn('"a": {"b": [1, {"c": "}"}]', encoded)
+        self.assertFalse(value.parsed)
+
+    def test_config_hashes_read_lazy_objects(self):
+        schema_set = SchemaSet({})
+        self.assertNotEqual(schema_set._config_digest({"c": lazy({"a": 1})}),
+                            schema_set._config_digest({"c": lazy({"a": 2})}))
+        event = {"meta": {"stack": "stack"}}
+        config = lazy({"stack": "{$.meta.stack}", "other": "{$.meta.missing}"})
+        self.assertEqual(_resolve_config_object(event, config),
+                         {"stack": "stack", "other": None})
+
+    def test_load_lazy(self):
+        with tempfile.TemporaryFile() as spool:
+            spool.write(b' ' + json.dumps(self.document).encode('utf-8'))
+            value = load_lazy(spool)
+        self.assertIsInstance(value, LazyObject)
+        self.assertEqual(value, self.document)
+        with tempfile.TemporaryFile() as spool:
+            spool.write(b'[1, 2]')
+            self.assertEqual(load_lazy(spool), [1, 2])
+
+
+class TestLazyRemoteEvent(unittest.TestCase):
+    def setUp(self):
+        self.s3 = FakeS3Client()
+        patchers = [
+            patch('cumulus_remote.s3_client', side_effect=lambda: self.s3),
+            patch('cumulus_remote._lazy_parse_bytes', 1024),
+            patch('cumulus_streaming.LAZY_OBJECT_BYTES', 1024),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def store(self, event):
+        self.s3.put_object(Bucket='bucket', Key='events/large',
+                           Body=json.dumps(event).encode('utf-8'))
+
+    def run_task(self, message, task=None):
+        def first_granule(event, context):
+            return {"granules": event['input']['granules'][:1],
+                    "pdr": event['input']['pdr']}
+        return run_cumulus_task(task or first_granule, message, LambdaContextMock())
+
+    def test_same_result_as_eager_parsing(self):
+        event = create_large_event()
+        self.store(event)
+        lazy_result = self.run_task(remote_message(event))
+        with patch('cumulus_remote._lazy_parse_bytes', 0):
+            eager_result = self.run_task(remote_message(event))
+        self.assertEqual(lazy_result, eager_result)
+        self.assertEqual(type(lazy_result['meta']['collection']), dict)
+        self.assertEqual(json.dumps(lazy_result), json.dumps(eager_result))
+
+    def test_payload_target_path(self):
+        event = create_large_event()
+        self.store(event['payload'])
+        message = remote_message(event, '$.payload')
+        message.update({k: v for k, v in event.items() if k != 'payload'})
+        message['payload'] = {}
+        result = self.run_task(message)
+        self.assertEqual(result['payload']['pdr'], event['payload']['pdr'])
+
+    def test_task_input_is_serializable(self):
+        event = create_large_event()
+        self.store(event['payload'])
+        message = remote_message(event, '$.payload')
+        message['payload'] = {}
+
+        def serialize(event, context):
+            with self.assertRaises(TypeError):
+                json.dumps(event['input'])
+            parsed = parse_lazy_objects(event['input'])
+            return {"json": json.dumps(parsed),
+                    "codec": cumulus_json.dumpb_compact(parsed).decode('utf-8')}
+        with patch('cumulus_streaming.LAZY_OBJECT_BYTES', 0):
+            result = self.run_task(message, serialize)
+        self.assertEqual(json.loads(result['payload']['json']), event['payload'])
+        self.assertEqual(json.loads(result['payload']['codec']), event['payload'])
+
+    def test_task_input_is_a_read_only_lazy_view(self):
+        event = create_large_event()
+        event['ReplaceConfig'] = {"FullMessage": True, "MaxSize": 100}
+        self.store(event)
+
+        def task(event, context):
+            self.assertIsInstance(event['input'], LazyView)
+            self.assertFalse(event['input']._target.parsed)
+            with self.assertRaises(TypeError):
+                event['input']['pdr'] = {}
+            # Members are copy-on-write views, the same on every access
+            event['input']['granules'][0]['granuleId'] = 'updated'
+            self.assertEqual(event['input']['granules'][0]['granuleId'], 'updated')
+            copied = event['input'].copy()
+            copied['count'] = 1
+            return event['input']
+        with patch('cumulus_json.loads', wraps=cumulus_json.loads) as loads:
+            result = self.run_task(remote_message(event), task)
+        # payload.pdr was returned, but never parsed
+        self.assertFalse([call for call in loads.call_args_list
+                          if b'xxxxxxxxxx' in bytes(call.args[0])])
+        stored = json.loads(self.s3.objects[('bucket', result['replace']['Key'])])
+        self.assertEqual(stored['payload']['granules'][0]['granuleId'], 'updated')
+        self.assertEqual(stored['payload']['pdr'], event['payload']['pdr'])
+        self.assertNotIn('count', stored['payload'])
+
+    def test_input_with_a_schema_is_parsed(self):
+        event = create_large_event()
+        self.store(event)
+        adapter = CumulusMessageAdapter(schema_set=SchemaSet({}))
+        adapter.schema_set.schemas['input'] = {"type": "object"}
+        full_event = adapter.load_and_update_remote_event(remote_message(event), {})
+        nested_event = adapter.load_nested_event(full_event)
+        self.assertNotIsInstance(nested_event['input'], LazyView)
+        self.assertEqual(json.loads(json.dumps(nested_event['input'])), event['payload'])
+
+    def test_untouched_parts_are_not_parsed(self):
+        event = create_large_event()
+        event['ReplaceConfig'] = {"FullMessage": True, "MaxSize": 100}
+        self.store(event)
+        with patch('cumulus_json.loads', wraps=cumulus_json.loads) as loads:
+            result = self.run_task(remote_message(event),
+                                   lambda event, context: {"count": 1})
+        self.assertFalse([call for call in loads.call_args_list
+                          if b'untouched-' in bytes(call.args[0])])
+        stored = json.loads(self.s3.objects[('bucket', result['replace']['Key'])])
+        self.assertEqual(stored['meta']['collection'], event['meta']['collection'])
+        self.assertEqual(stored['payload'], {"count": 1})
+
+    @patch('cumulus_remote.MULTIPART_MIN_PART_SIZE', 1024)
+    def test_untouched_parts_are_copied_in_s3(self):
+        event = create_large_event()
+        event['ReplaceConfig'] = {"FullMessage": True, "MaxSize": 100}
+        self.store(event)
+        result = self.run_task(remote_message(event), lambda event, context: {"count": 1})
+        stored = json.loads(self.s3.objects[('bucket', result['replace']['Key'])])
+        # meta.collection was never parsed, and is copied
+        self.assertEqual(self.s3.count('upload_part_copy'), 1)
+        self.assertEqual(stored['meta']['collection'], event['meta']['collection'])
+        self.assertEqual(stored['payload'], {"count": 1})
+
+    def load_peak(self, event):
+        adapter = CumulusMessageAdapter()
+        tracemalloc.start()
+        try:
+            full_event = adapter.load_and_update_remote_event(
+                remote_message(event), {'function_name': 'task'})
+            nested_event = adapter.load_nested_event(full_event)
+            self.assertEqual(nested_event['input']['granules'][0]['granuleId'],
+                             'granule-0')
+            return tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    def test_peak_memory(self):
+        event = create_large_event(granules=1000)
+        event['payload']['pdr']['untouched'] = [f"{i:0100d}" for i in range(50000)]
+        self.store(event)
+        lazy_peak = self.load_peak(event)
+        with patch('cumulus_remote._lazy_parse_bytes', 0):
+            eager_peak = self.load_peak(event)
+        self.assertLess(lazy_peak, eager_peak / 4)
@@ -1,11 +1,23 @@
+from datetime import datetime
 import json
 import logging
+import os
 import sys
 import unittest
+import mock
+import cumulus_logger
 from cumulus_logger import CumulusLogger
 from helpers import LambdaContextMock, create_event, create_parameter_event
 
 
+class FormatCounter:
+    calls = 0
+
+    def __format__(self, format_spec):
+        self.calls += 1
+        return "formatted"
+
+
 class TestLogger(unittest.TestCase):
     def set_up_logger(self, event=None, context=None, logger=None, **kwargs):
         if event is None:
@@ -151,3 +163,130 @@ class TestLogger(unittest.TestCase):
         logger2 = self.set_up_logger(name='test')
         self.assertEqual(1, len(logger1.logger.handlers))
         self.assertEqual(1, len(logger2.logger.handlers))
+
+    def test_truncated_granule_metadata(self):
+        event = create_event()
+        event["payload"]["granules"] = [
+            {"granuleId": "granule-%d" % i} for i in range(5)]
+        logger = self.set_up_logger(
+            event=event, granule_metadata="truncated", granule_metadata_limit=2)
+        msg = logger.createMessage("truncated")
+        self.assertEqual(msg["granules"], json.dumps(["granule-0", "granule-1"]))
+        self.assertEqual(msg["granuleCount"], 5)
+
+    def test_hashed_granule_metadata(self):
+        logger = self.set_up_logger(granule_metadata="hashed")
+        msg = logger.createMessage("hashed")
+        self.assertTrue(msg["granules"].startswith("sha256:"))
+        self.assertEqual(len(msg["granules"]), len("sha256:") + 64)
+        self.assertEqual(msg["granuleCount"], 2)
+
+    def test_full_granule_metadata_has_no_count(self):
+        logger = self.set_up_logger()
+        self.assertEqual(logger.granule_metadata, "full")
+        self.assertNotIn("granuleCount", logger.createMessage("full"))
+
+    def test_granule_metadata_policy_from_environment(self):
+        with mock.patch.dict(os.environ, {
+                "CUMULUS_LOGGER_GRANULE_METADATA": "truncated",
+                "CUMULUS_LOGGER_GRANULE_METADATA_LIMIT": "1"}):
+            logger = self.set_up_logger()
+        msg = logger.createMessage("from environment")
+        self.assertEqual(msg["granules"], json.dumps(["id1"]))
+        self.assertEqual(msg["granuleCount"], 2)
+
+    def test_invalid_granule_metadata_policy(self):
+        with self.assertRaises(ValueError):
+            CumulusLogger(granule_metadata="sampled")
+
+    def test_granules_without_ids(self):
+        event = create_event()
+        event["payload"]["granules"] = [{"granuleId": "id"}, {}, "not a granule"]
+        logger = self.set_up_logger(event=event)
+        msg = logger.createMessage("granules without ids")
+        self.assertEqual(msg["granules"], json.dumps(["id", None, None]))
+
+    def test_logged_line_matches_created_message(self):
+        logger = self.set_up_logger(name='test_logged_line')
+        with self.assertLogs(logger.logger, logging.DEBUG) as logs:
+            logger.info("formatted {}", "message")
+            logger.log({"message": "dict", "level": "warn", "sender": "other",
+                        "timestamp": "never", "extra": [1, "é"]})
+        expected = [
+            dict(logger.createMessage("formatted {}", "message"), level="info"),
+            dict(logger.createMessage({"message": "dict", "extra": [1, "é"]}),
+                 level="warning"),
+        ]
+        for line, msg in zip(logs.records, expected):
+            logged = json.loads(line.getMessage())
+            self.assertRegex(logged.pop("timestamp"), r"^\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d")
+            msg.pop("timestamp")
+            self.assertEqual(logged, msg)
+        self.assertEqual(logs.records[1].levelno, logging.WARNING)
+
+    def test_timestamp_format(self):
+        with mock.patch("cumulus_logger.time.time_ns",
+                        side_effect=[1700000000123456789, 1700000001000000000]):
+            self.assertEqual(cumulus_logger._timestamp(),
+                             datetime.fromtimestamp(1700000000.123456).isoformat())
+            self.assertEqual(cumulus_logger._timestamp(),
+                             datetime.fromtimestamp(1700000001).isoformat())
+
+    def test_disabled_level_does_not_format_message(self):
+        logger = self.set_up_logger(name='test_disabled_level')
+        logger.logger.setLevel(logging.INFO)
+        argument = FormatCounter()
+        logger.debug("not formatted {}", argument)
+        self.assertEqual(argument.calls, 0)
+
+    def test_format_errors_raise(self):
+        logger = self.set_up_logger(name='test_format_errors')
+        with self.assertRaises(IndexError):
+            logger.info("{} and {}", "one")
+        with self.assertRaises(KeyError):
+            logger.info("{missing}", "one")
+
+    def test_exc_info_is_captured_when_logged(self):
+        logger = self.set_up_logger(name='test_lazy_exc_info')
+        with self.assertLogs(logger.logger, logging.DEBUG) as logs:
+            try:
+                1 / 0
+            except ZeroDivisionError:
+                logger.error("failed", exc_info=True)
+        self.assertIn("ZeroDivisionError", logs.records[0].getMessage())
+
+    def test_rate_limit(self):
+        clock = mock.Mock(return_value=100.0)
+        logger = self.set_up_logger(name='test_rate_limit', rate_limit=2)
+        logger._limiter.clock = clock
+        with self.assertLogs(logger.logger, logging.DEBUG) as logs:
+            for i in range(5):
+                logger.info("granule {}", i)
+            logger.info("other")
+            clock.return_value = 101.0
+            logger.info("granule {}", 5)
+        messages = [json.loads(record.getMessage()) for record in logs.records]
+        self.assertEqual([msg["message"] for msg in messages], [
+            "granule 0", "granule 1", "other",
+            "Suppressed 3 log records like: granule {}", "granule 5"])
+        self.assertEqual(messages[3]["suppressed"], 3)
+        self.assertEqual(messages[3]["level"], "info")
+
+    def test_sampling_keeps_warnings(self):
+        logger = self.set_up_logger(name='test_sampling', sample_rate=0)
+        with self.assertLogs(logger.logger, logging.DEBUG) as logs:
+            for i in range(3):
+                logger.debug("sampled {}", i)
+            logger.warn("kept")
+            cumulus_logger.flush_logs()
+        self.assertEqual(
+            [json.loads(record.getMessage())["message"] for record in logs.records],
+            ["kept", "Suppressed 3 log records like: sampled {}"])
+
+    def test_rate_limit_from_environment(self):
+        with mock.patch.dict(os.environ, {"CUMULUS_LOGGER_RATE_LIMIT": "7",
+                                          "CUMULUS_LOGGER_SAMPLE_RATE": "0.5"}):
+            logger = CumulusLogger('test_rate_limit_environment')
+        self.assertEqual(
+            (logger._limiter.rate_limit, logger._limiter.sample_rate), (7, 0.5))
+        self.assertIsNone(CumulusLogger('test_no_rate_limit')._limiter)
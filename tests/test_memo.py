@@ -0,0 +1,317 @@
+import asyncio
+from datetime import timedelta
+import os
+import tempfile
+import time
+import unittest
+from mock import Mock, patch
+
+from helpers import DeadlineContextMock, FakeS3Client, LambdaContextMock, create_event
+from test_lazy_remote import lazy
+
+from cumulus_deadline import DeadlineExceeded
+import cumulus_memo
+from cumulus_memo import (
+    DirectoryMemoStore, MemoryMemoStore, S3MemoStore, TaskMemo, configure_task_memo,
+    task_memo)
+from run_cumulus_task import (
+    bootstrap, run_cumulus_task, run_cumulus_task_async, run_cumulus_tasks)
+
+
+def create_granules_event(count=3):
+    event = create_event()
+    event['task_config'] = {"foo": "{$.meta.foo}"}
+    event['payload'] = {"granules": [{"granuleId": f"granule-{i}"} for i in range(count)]}
+    return event
+
+
+class CountingTask:
+    """A task function recording its calls."""
+
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self, event, context):
+        self.calls += 1
+        return {"granules": [dict(granule, queried=True)
+                             for granule in event['input']['granules']],
+                "foo": event['config']['foo']}
+
+
+class TestMemoizedTasks(unittest.TestCase):
+    def setUp(self):
+        bootstrap()
+        self.addCleanup(configure_task_memo)
+        self.memo = configure_task_memo('memory')
+
+    def test_retries_reuse_the_response(self):
+        task = CountingTask()
+        results = [run_cumulus_task(task, create_granules_event(), LambdaContextMock())
+                   for _ in range(3)]
+        self.assertEqual(task.calls, 1)
+        self.assertEqual(results[1], results[0])
+        self.assertEqual(results[2]['payload']['granules'][0],
+                         {"granuleId": "granule-0", "queried": True})
+        self.assertEqual((self.memo.hits, self.memo.misses), (2, 1))
+
+    def test_key_covers_the_task_input_and_config(self):
+        task = CountingTask()
+        run_cumulus_task(task, create_granules_event(3))
+        run_cumulus_task(task, create_granules_event(4))
+        changed = create_granules_event(3)
+        changed['meta']['foo'] = 'baz'
+        run_cumulus_task(task, changed)
+        self.assertEqual(task.calls, 3)
+
+        def other(event, context):
+            return {}
+        self.assertEqual(run_cumulus_task(other, create_granules_event(3))['payload'], {})
+
+    def test_key_covers_the_cumulus_config(self):
+        def execution_event(execution_name):
+            event = create_granules_event(3)
+            event['cumulus_meta'].update(state_machine='arn:sm', execution_name=execution_name)
+            return event
+        task = CountingTask()
+        run_cumulus_task(task, execution_event('first'))
+        run_cumulus_task(task, execution_event('other'))
+        self.assertEqual(task.calls, 2)
+
+        self.memo.ignore_cumulus_config = True
+        run_cumulus_task(task, execution_event('first'))
+        run_cumulus_task(task, execution_event('other'))
+        self.assertEqual(task.calls, 3)
+
+    def test_key_covers_the_task_arguments(self):
+        calls = []
+
+        def task(event, context, bucket='default'):
+            calls.append(bucket)
+            return {"bucket": bucket}
+        results = [run_cumulus_task(task, create_event(), **taskargs)['payload']
+                   for taskargs in ({}, {'bucket': 'a'}, {'bucket': 'b'}, {'bucket': 'a'})]
+        self.assertEqual(results, [{"bucket": bucket} for bucket in ('default', 'a', 'b', 'a')])
+        self.assertEqual(calls, ['default', 'a', 'b'])
+
+        client = object()
+        for _ in range(2):
+            run_cumulus_task(task, create_event(), bucket=client)
+        self.assertEqual(calls[3:], [client, client])
+
+    def test_failures_are_not_memoized(self):
+        calls = []
+
+        def failing(event, context):
+            calls.append(event)
+            raise Exception('WorkflowError')
+
+        def stopping(event, context, deadline):
+            calls.append(event)
+            deadline.check({"processed": []})
+        for _ in range(2):
+            self.assertEqual(run_cumulus_task(failing, create_event())['exception'],
+                             'WorkflowError')
+            with self.assertRaises(DeadlineExceeded):
+                run_cumulus_task(stopping, create_event(), DeadlineContextMock(0))
+        self.assertEqual(len(calls), 4)
+        self.assertEqual(len(self.memo.store), 0)
+
+    def test_streamed_responses_are_not_memoized(self):
+        calls = []
+
+        def streaming(event, context):
+            calls.append(event)
+            return {"granules": (granule for granule in event['input']['granules'])}
+        for _ in range(2):
+            result = run_cumulus_task(streaming, create_granules_event())
+            self.assertEqual(len(result['payload']['granules']), 3)
+        self.assertEqual(len(calls), 2)
+
+    def test_store_failures_run_the_task(self):
+        task = CountingTask()
+        with patch.object(self.memo, 'store', Mock(get=Mock(side_effect=OSError),
+                                                   put=Mock(side_effect=OSError))):
+            run_cumulus_task(task, create_granules_event())
+            run_cumulus_task(task, create_granules_event())
+        self.assertEqual(task.calls, 2)
+
+    def test_fused_steps(self):
+        task = CountingTask()
+
+        def passthrough(event, context):
+            return event['input']
+        for _ in range(2):
+            result = run_cumulus_tasks([('query', task), passthrough],
+                                       create_granules_event())
+        self.assertEqual(task.calls, 1)
+        self.assertTrue(result['payload']['granules'][0]['queried'])
+
+    def test_async_task(self):
+        calls = []
+
+        async def task(event, context):
+            calls.append(event)
+            return {"count": len(event['input']['granules'])}
+        for _ in range(2):
+            result = asyncio.run(run_cumulus_task_async(task, create_granules_event()))
+        self.assertEqual(result['payload'], {"count": 3})
+        self.assertEqual(len(calls), 1)
+
+    def test_lazily_parsed_input(self):
+        task = CountingTask()
+        document = create_granules_event()
+        with patch('cumulus_streaming.LAZY_OBJECT_BYTES', 0):
+            results = [run_cumulus_task(task, lazy(document)) for _ in range(2)]
+            nested_event = lazy({"input": document, "config": {}})
+            key = self.memo.key(task, nested_event)
+            self.assertFalse(nested_event['input'].parsed)
+            self.assertEqual(key, self.memo.key(
+                task, lazy({"input": document, "config": {}})))
+        self.assertEqual(task.calls, 1)
+        self.assertEqual(results[1], results[0])
+
+    def test_disabled_by_default(self):
+        configure_task_memo()
+        self.assertIsNone(task_memo())
+        task = CountingTask()
+        run_cumulus_task(task, create_granules_event())
+        run_cumulus_task(task, create_granules_event())
+        self.assertEqual(task.calls, 2)
+
+    def test_bootstrap(self):
+        with patch.dict(os.environ, {'CUMULUS_MEMOIZE': 's3://bucket/memo',
+                                     'CUMULUS_MEMOIZE_TTL_SECONDS': '60',
+                                     'CUMULUS_MEMOIZE_MAX_BYTES': '1000',
+                                     'CUMULUS_MEMOIZE_IGNORE_CUMULUS_CONFIG': 'true'}):
+            self.addCleanup(bootstrap, refresh=True)
+            settings = bootstrap(refresh=True)
+        self.assertEqual((settings.memoize, settings.memoize_ttl_seconds,
+                          settings.memoize_max_bytes), ('s3://bucket/memo', 60, 1000))
+        self.assertTrue(task_memo().ignore_cumulus_config)
+        store = task_memo().store
+        self.assertIsInstance(store, S3MemoStore)
+        self.assertEqual((store.bucket, store.prefix, store.ttl_seconds, store.max_bytes),
+                         ('bucket', 'memo', 60, 1000))
+
+
+def make_task(bucket):
+    def task(event, context):
+        return {"bucket": bucket}
+    return task
+
+
+def helper():
+    return 'old'
+
+
+def calling_helper(event, context):
+    return {"value": helper()}
+
+
+class TestTaskIdentity(unittest.TestCase):
+    def setUp(self):
+        self.memo = TaskMemo(MemoryMemoStore())
+        self.event = {"input": {"a": 1}, "config": {}}
+
+    def test_constants_are_part_of_the_key(self):
+        def old(event, context):
+            return {"bucket": 'old'}
+        first = self.memo.key(old, self.event)
+
+        def old(event, context):  # pylint: disable=function-redefined
+            return {"bucket": 'new'}
+        self.assertNotEqual(self.memo.key(old, self.event), first)
+
+    def test_closures_and_helpers_are_part_of_the_key(self):
+        self.assertEqual(self.memo.key(make_task('old'), self.event),
+                         self.memo.key(make_task('old'), self.event))
+        self.assertNotEqual(self.memo.key(make_task('old'), self.event),
+                            self.memo.key(make_task('new'), self.event))
+        first = self.memo.key(calling_helper, self.event)
+        with patch(f'{__name__}.helper', lambda: 'new'):
+            configure_task_memo()
+            self.assertNotEqual(self.memo.key(calling_helper, self.event), first)
+
+    def test_identity_is_hashed_once(self):
+        self.addCleanup(configure_task_memo)
+        task = make_task('old')
+        with patch('cumulus_memo._hash_function', wraps=cumulus_memo._hash_function) as hashed:
+            key = self.memo.key(task, self.event)
+            self.assertEqual(self.memo.key(task, self.event), key)
+            self.assertEqual(hashed.call_count, 1)
+            configure_task_memo()
+            self.assertEqual(self.memo.key(task, self.event), key)
+            self.assertEqual(hashed.call_count, 2)
+
+    def test_version_is_part_of_the_key(self):
+        key = self.memo.key(CountingTask(), self.event)
+        self.assertEqual(TaskMemo(MemoryMemoStore()).key(CountingTask(), self.event), key)
+        self.assertNotEqual(
+            TaskMemo(MemoryMemoStore(), '2').key(CountingTask(), self.event), key)
+
+    def test_bootstrap_version(self):
+        self.addCleanup(bootstrap, refresh=True)
+        with patch.dict(os.environ, {'CUMULUS_MEMOIZE': 'memory',
+                                     'AWS_LAMBDA_FUNCTION_VERSION': '3'}):
+            self.assertEqual(bootstrap(refresh=True).memoize_version, '3')
+            self.assertEqual(task_memo().version, '3')
+            with patch.dict(os.environ, {'CUMULUS_MEMOIZE_VERSION': 'abc123'}):
+                self.assertEqual(bootstrap(refresh=True).memoize_version, 'abc123')
+
+
+class TestMemoStores(unittest.TestCase):
+    def test_memory_eviction(self):
+        store = MemoryMemoStore(ttl_seconds=10, max_bytes=10)
+        store.put('a', b'1234')
+        store.put('b', b'1234')
+        store.get('a')
+        store.put('c', b'1234')
+        store.put('d', b'12345678901')
+        self.assertEqual((store.get('a'), store.get('b'), store.get('c'), store.get('d')),
+                         (b'1234', None, b'1234', None))
+        with patch('time.time', return_value=time.time() + 10):
+            self.assertIsNone(store.get('a'))
+        self.assertEqual(store.size, 4)
+
+    def test_directory_is_shared(self):
+        with tempfile.TemporaryDirectory() as directory:
+            first = TaskMemo(DirectoryMemoStore(directory))
+            second = TaskMemo(DirectoryMemoStore(directory))
+            key = first.key(CountingTask, {"input": {"a": 1}, "config": {}})
+            first.put(key, {"b": [1, 2]}, Mock())
+            self.assertEqual(second.get(key, Mock()), {"b": [1, 2]})
+            self.assertEqual(os.listdir(directory), [f'{key}.json'])
+
+    def test_directory_eviction(self):
+        with tempfile.TemporaryDirectory() as directory:
+            store = DirectoryMemoStore(os.path.join(directory, 'memo'), ttl_seconds=10,
+                                       max_bytes=10)
+            now = time.time()
+
+            def at(offset, method, *args):
+                with patch('time.time', return_value=now + offset):
+                    return method(*args)
+            at(0, store.put, 'a', b'1234')
+            at(1, store.put, 'b', b'1234')
+            self.assertEqual(at(2, store.get, 'a'), b'1234')
+            at(3, store.put, 'c', b'1234')
+            self.assertEqual(sorted(os.listdir(store.directory)), ['a.json', 'c.json'])
+            with patch('time.time', return_value=now + 10):
+                self.assertIsNone(store.get('a'))
+                self.assertEqual(store.get('c'), b'1234')
+                store.put('d', b'12345678901')
+            self.assertIsNone(store.get('d'))
+            self.assertEqual(os.listdir(store.directory), ['c.json'])
+
+    def test_s3(self):
+        s3 = FakeS3Client()
+        store = S3MemoStore('s3://bucket/memo', ttl_seconds=10, max_bytes=10)
+        with patch('cumulus_remote.s3_client', return_value=s3):
+            self.assertIsNone(store.get('a'))
+            store.put('a', b'1234')
+            store.put('b', b'12345678901')
+            self.assertEqual(store.get('a'), b'1234')
+            self.assertEqual(list(s3.objects), [('bucket', 'memo/a.json')])
+            s3.modified[('bucket', 'memo/a.json')] -= timedelta(seconds=10)
+            self.assertIsNone(store.get('a'))
+            self.assertEqual(s3.objects, {})
@@ -0,0 +1,117 @@
+import asyncio
+import json
+import logging
+import os
+import time
+import tracemalloc
+import unittest
+from mock import Mock, patch
+
+from helpers import LambdaContextMock, create_event
+
+from cumulus_metrics import PHASES, InvocationMetrics
+from run_cumulus_task import (
+    bootstrap, run_cumulus_task, run_cumulus_task_async, run_cumulus_tasks)
+
+
+def sleepy_task(event, context):
+    time.sleep(0.01)
+    return {"answer": 42}
+
+
+class TestMetrics(unittest.TestCase):
+    def run_task(self, task_function, environ=None, runner=run_cumulus_task):
+        environ = {'CUMULUS_METRICS': 'true', **(environ or {})}
+        with patch.dict(os.environ, environ):
+            bootstrap(refresh=True)
+            with self.assertLogs('cumulus_logger', logging.INFO) as logs:
+                result = runner(task_function, create_event(), LambdaContextMock())
+                if asyncio.iscoroutine(result):
+                    result = asyncio.run(result)
+        bootstrap(refresh=True)
+        records = [json.loads(record.getMessage()) for record in logs.records]
+        return result, [record for record in records if '_aws' in record]
+
+    def assert_emf(self, record):
+        directive, = record['_aws']['CloudWatchMetrics']
+        self.assertEqual(directive['Namespace'], 'CumulusMessageAdapter')
+        self.assertEqual(directive['Dimensions'], [['FunctionName']])
+        self.assertEqual(record['FunctionName'], 'function_name_example')
+        for metric in directive['Metrics']:
+            self.assertIn(metric['Name'], record)
+
+    def test_one_record_per_invocation(self):
+        result, (record,) = self.run_task(sleepy_task)
+        self.assert_emf(record)
+        for phase in PHASES:
+            self.assertIn(f'{phase}Time', record)
+        self.assertGreaterEqual(record['TaskTime'], 10)
+        self.assertGreaterEqual(record['TotalTime'], record['TaskTime'])
+        self.assertEqual(record['MessageBytesIn'], len(json.dumps(create_event())))
+        self.assertEqual(record['MessageBytesOut'], len(json.dumps(result)))
+        self.assertIn('MaxRSSGrowth', record)
+        self.assertNotIn('TaskPeakAllocated', record)
+
+    def test_async(self):
+        _, (record,) = self.run_task(sleepy_task, runner=run_cumulus_task_async)
+        self.assertIn('CreateNextEventTime', record)
+
+    def test_fused_steps_add_up(self):
+        def runner(task_function, event, context):
+            return run_cumulus_tasks([task_function] * 3, event, context)
+        _, (record,) = self.run_task(sleepy_task, runner=runner)
+        self.assertGreaterEqual(record['TaskTime'], 30)
+        self.assertGreaterEqual(record['TotalTime'], record['TaskTime'])
+
+    def test_trace_memory(self):
+        def allocating_task(event, context):
+            data = bytearray(10 ** 6)
+            return {"size": len(data)}
+        _, (record,) = self.run_task(
+            allocating_task, {'CUMULUS_METRICS_TRACEMALLOC': 'true',
+                              'CUMULUS_METRICS_NAMESPACE': 'Tasks'})
+        self.assertGreaterEqual(record['TaskPeakAllocated'], 10 ** 6)
+        self.assertEqual(
+            record['_aws']['CloudWatchMetrics'][0]['Namespace'], 'Tasks')
+        self.assertFalse(tracemalloc.is_tracing())
+
+    def test_concurrent_invocations_skip_peaks(self):
+        first = InvocationMetrics(trace_memory=True)
+        second = InvocationMetrics(trace_memory=True)
+        first.start()
+        with first.phase('LoadNestedEvent'):
+            pass
+        second.start()
+        with first.phase('Task'):
+            pass
+        second.emit(Mock())
+        self.assertTrue(tracemalloc.is_tracing())
+        first.emit(Mock())
+        self.assertFalse(tracemalloc.is_tracing())
+        self.assertIn('LoadNestedEventPeakAllocated', first.values)
+        self.assertNotIn('TaskPeakAllocated', first.values)
+        self.assertIn('TaskTime', first.values)
+
+    def test_failed_task(self):
+        def failing_task(event, context):
+            raise RuntimeError('boom')
+        with patch.dict(os.environ, {'CUMULUS_METRICS': 'true'}):
+            bootstrap(refresh=True)
+            with self.assertLogs('cumulus_logger', logging.INFO) as logs:
+                with self.assertRaises(RuntimeError):
+                    run_cumulus_task(failing_task, create_event(), LambdaContextMock())
+        bootstrap(refresh=True)
+        record = json.loads(logs.records[-1].getMessage())
+        self.assertIn('TaskTime', record)
+        self.assertNotIn('MessageBytesOut', record)
+
+    def test_disabled(self):
+        metrics = InvocationMetrics(enabled=False)
+        metrics.start()
+        with metrics.phase('Task'):
+            pass
+        metrics.size('MessageBytesIn', {})
+        self.assertEqual(metrics.values, {})
+        logger = Mock()
+        metrics.emit(logger)
+        logger.info.assert_not_called()
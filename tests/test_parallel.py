@@ -0,0 +1,76 @@
+import os
+import time
+import unittest
+from mock import patch
+
+from helpers import DeadlineContextMock, LambdaContextMock, create_event
+
+from cumulus_deadline import Deadline
+from cumulus_parallel import GranuleMapResult, map_granules
+
+
+def describe(granule, logger):
+    # Later granules finish first
+    time.sleep((10 - granule) * 0.005)
+    return {"granuleId": granule, "pid": os.getpid(),
+            "sender": logger.createMessage("done")["sender"]}
+
+
+def slow(granule, logger, duration):
+    time.sleep(duration)
+    return granule
+
+
+def fail_on_three(granule, logger):
+    if granule == 3:
+        raise ValueError(f'granule {granule} is invalid')
+    return granule
+
+
+class TestMapGranules(unittest.TestCase):
+    def test_results_keep_the_granule_order(self):
+        result = map_granules(describe, range(10), LambdaContextMock(),
+                              create_event(), max_workers=4)
+        self.assertTrue(result.complete)
+        self.assertEqual([item["granuleId"] for item in result.results], list(range(10)))
+        self.assertEqual(result.unprocessed, [])
+        self.assertNotIn(os.getpid(), {item["pid"] for item in result.results})
+        self.assertEqual({item["sender"] for item in result.results},
+                         {LambdaContextMock().function_name})
+
+    def test_in_process_with_one_worker(self):
+        result = map_granules(describe, range(3), max_workers=1)
+        self.assertEqual([item["pid"] for item in result.results], [os.getpid()] * 3)
+        with patch('cumulus_parallel._fork_context', return_value=None):
+            result = map_granules(describe, range(3), max_workers=2)
+        self.assertEqual([item["granuleId"] for item in result.results], [0, 1, 2])
+
+    def test_stops_near_the_deadline(self):
+        for max_workers in (1, 2):
+            context = DeadlineContextMock(remaining_ms=400)
+            result = map_granules(slow, range(50), context, max_workers=max_workers,
+                                  deadline=Deadline(context, margin_ms=200),
+                                  duration=0.05)
+            self.assertFalse(result.complete)
+            processed = len(result.results)
+            self.assertGreater(processed, 0)
+            self.assertEqual(result.results, list(range(processed)))
+            self.assertEqual(result.unprocessed, list(range(processed, 50)))
+            self.assertGreater(context.get_remaining_time_in_millis(), 0)
+
+    def test_shares_the_task_deadline(self):
+        deadline = Deadline(DeadlineContextMock(remaining_ms=5000), margin_ms=10000)
+        for max_workers in (1, 2):
+            result = map_granules(describe, range(3), max_workers=max_workers,
+                                  deadline=deadline)
+            self.assertEqual(result.unprocessed, [0, 1, 2])
+
+    def test_no_granules(self):
+        self.assertEqual(map_granules(describe, []), GranuleMapResult())
+
+    def test_exceptions_are_raised(self):
+        for max_workers in (1, 3):
+            with self.assertRaises(ValueError) as raised:
+                map_granules(fail_on_three, range(10), max_workers=max_workers)
+            self.assertEqual(str(raised.exception), 'granule 3 is invalid')
+        self.assertIn('fail_on_three', str(raised.exception.__cause__))
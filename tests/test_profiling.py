@@ -0,0 +1,139 @@
+import io
+import json
+import logging
+import os
+import pstats
+import tempfile
+import threading
+import tracemalloc
+import unittest
+from mock import Mock, patch
+
+from helpers import FakeS3Client, LambdaContextMock, create_event
+from test_batch import create_sqs_event
+
+from cumulus_metrics import InvocationMetrics
+import cumulus_profiling
+from cumulus_profiling import InvocationProfiler
+from run_cumulus_task import bootstrap, run_cumulus_task, run_cumulus_task_batch
+
+
+def profiled_task(event, context):
+    return {"squares": [i * i for i in range(1000)]}
+
+
+class TestProfiling(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def run_task(self, environ):
+        environ = {'CUMULUS_PROFILE_DIR': self.directory.name, **environ}
+        with patch.dict(os.environ, environ):
+            bootstrap(refresh=True)
+            with self.assertLogs('cumulus_logger', logging.INFO) as logs:
+                run_cumulus_task(profiled_task, create_event(), LambdaContextMock())
+        bootstrap(refresh=True)
+        messages = [json.loads(record.getMessage()) for record in logs.records]
+        return [message for message in messages if 'profileArtifacts' in message]
+
+    def test_profile_written_to_directory(self):
+        (message,) = self.run_task({'CUMULUS_PROFILE_RATE': '1'})
+        (path,) = message['profileArtifacts']
+        self.assertTrue(path.startswith(
+            os.path.join(self.directory.name, 'function_name_example', '')))
+        output = io.StringIO()
+        pstats.Stats(path, stream=output).print_stats()
+        self.assertIn('profiled_task', output.getvalue())
+        self.assertIn('load_nested_event', output.getvalue())
+
+    def test_tracemalloc_snapshot(self):
+        tracing = tracemalloc.is_tracing()
+        (message,) = self.run_task({'CUMULUS_PROFILE_RATE': '1',
+                                    'CUMULUS_PROFILE_TRACEMALLOC': 'true'})
+        _, snapshot_path = message['profileArtifacts']
+        self.assertTrue(tracemalloc.Snapshot.load(snapshot_path).traces)
+        self.assertEqual(tracemalloc.is_tracing(), tracing)
+
+    def test_tracing_shared_with_metrics(self):
+        profiler = InvocationProfiler(rate=1, trace_memory=True,
+                                      directory=self.directory.name)
+        metrics = InvocationMetrics(trace_memory=True)
+        logger = Mock()
+        with profiler.profile(logger):
+            metrics.start()
+        self.assertTrue(tracemalloc.is_tracing())
+        with metrics.phase('Task'):
+            bytearray(10 ** 6)
+        metrics.emit(logger)
+        self.assertFalse(tracemalloc.is_tracing())
+        self.assertGreaterEqual(metrics.values['TaskPeakAllocated'], 10 ** 6)
+
+    def test_profile_uploaded_to_s3(self):
+        s3 = FakeS3Client()
+        with patch('cumulus_remote.s3_client', return_value=s3):
+            (message,) = self.run_task({
+                'CUMULUS_PROFILE_RATE': '1',
+                'CUMULUS_PROFILE_S3_URI': 's3://bucket/profiles/'})
+        (uri,) = message['profileArtifacts']
+        (bucket, key), = s3.objects
+        self.assertEqual(uri, f's3://{bucket}/{key}')
+        self.assertTrue(key.startswith('profiles/function_name_example/'))
+        self.assertTrue(key.endswith('.prof'))
+        self.assertEqual(os.listdir(self.directory.name), [])
+
+    def test_concurrent_batch_records(self):
+        barrier = threading.Barrier(4, timeout=5)
+
+        def task(event, context):
+            # Every record is being profiled, or skipped, at once
+            barrier.wait()
+            return profiled_task(event, context)
+        environ = {'CUMULUS_PROFILE_DIR': self.directory.name, 'CUMULUS_PROFILE_RATE': '1'}
+        with patch.dict(os.environ, environ):
+            bootstrap(refresh=True)
+            response = run_cumulus_task_batch(
+                task, create_sqs_event([create_event()] * 4), LambdaContextMock(),
+                max_workers=4)
+        bootstrap(refresh=True)
+        self.assertEqual(response, {"batchItemFailures": []})
+        (profiles,) = [files for _, _, files in os.walk(self.directory.name) if files]
+        self.assertEqual(len(profiles), 1)
+
+    def test_profiler_already_active(self):
+        logger = Mock()
+        with patch('cumulus_profiling.cProfile.Profile') as profile:
+            profile.return_value.enable.side_effect = ValueError(
+                'Another profiling tool is already active')
+            with InvocationProfiler(rate=1).profile(logger):
+                pass
+        logger.warn.assert_called_once()
+        profile.return_value.dump_stats.assert_not_called()
+        with self.assertRaises(KeyError):
+            with InvocationProfiler(rate=1, directory=self.directory.name).profile(logger):
+                raise KeyError('task failed')
+        self.assertEqual(len(logger.info.call_args_list), 1)
+
+    def test_disabled_by_default(self):
+        with patch.dict(os.environ, {'CUMULUS_PROFILE_DIR': self.directory.name}):
+            bootstrap(refresh=True)
+            with patch('cumulus_profiling.cProfile.Profile') as profile:
+                run_cumulus_task(profiled_task, create_event(), LambdaContextMock())
+        bootstrap(refresh=True)
+        profile.assert_not_called()
+        self.assertEqual(os.listdir(self.directory.name), [])
+
+    def test_sampling_ratio(self):
+        profiler = InvocationProfiler(rate=0.01)
+        with patch.object(cumulus_profiling._random, 'random',
+                          side_effect=[0.005, 0.5, 0.01]):
+            self.assertEqual([profiler.sampled() for _ in range(3)],
+                             [True, False, False])
+
+    def test_storage_failure_is_logged(self):
+        profiler = InvocationProfiler(rate=1, s3_uri='not-an-s3-uri')
+        logger = Mock()
+        with profiler.profile(logger):
+            pass
+        logger.warn.assert_called_once()
+        logger.info.assert_not_called()
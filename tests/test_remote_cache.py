@@ -0,0 +1,98 @@
+import json
+import unittest
+from mock import patch
+
+from helpers import FakeS3Client, LambdaContextMock, create_event
+
+import cumulus_remote
+from cumulus_remote import RemoteEventCache, configure_remote_event_cache
+from run_cumulus_task import run_cumulus_task
+
+
+def create_remote_event(s3, key='events/remote'):
+    stored = create_event()
+    stored['meta']['large'] = ['x' * 100] * 10
+    s3.put_object(Bucket='bucket', Key=key, Body=json.dumps(stored))
+    return {
+        "cumulus_meta": {"execution_name": "123123"},
+        "replace": {"Bucket": "bucket", "Key": key, "TargetPath": "$"},
+    }
+
+
+class TestRemoteEventCache(unittest.TestCase):
+    def setUp(self):
+        self.s3 = FakeS3Client()
+        patcher = patch('cumulus_remote.s3_client', return_value=self.s3)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(configure_remote_event_cache, 0)
+
+    def test_remote_event_is_fetched_once(self):
+        cache = configure_remote_event_cache(10 ** 6)
+
+        def handler_fn(event, context):
+            return event['input']
+
+        for _ in range(3):
+            response = run_cumulus_task(
+                handler_fn, create_remote_event(self.s3), LambdaContextMock())
+            self.assertEqual(response['payload'], {"anykey": "anyvalue"})
+            self.assertEqual(len(response['meta']['workflow_tasks']), 1)
+        self.assertEqual(self.s3.count('get_object'), 1)
+        self.assertEqual(self.s3.count('head_object'), 3)
+        self.assertEqual((cache.hits, cache.misses), (2, 1))
+
+    def test_cache_is_disabled_by_default(self):
+        self.assertIsNone(cumulus_remote.remote_event_cache())
+        for _ in range(2):
+            run_cumulus_task(lambda event, context: {},
+                             create_remote_event(self.s3))
+        self.assertEqual(self.s3.count('get_object'), 2)
+        self.assertEqual(self.s3.count('head_object'), 0)
+
+    def test_mutations_do_not_corrupt_cache(self):
+        configure_remote_event_cache(10 ** 6)
+
+        def mutating_fn(event, context):
+            event['input']['anykey'] = 'mutated'
+            return event['input']
+
+        first = run_cumulus_task(mutating_fn, create_remote_event(self.s3))
+        self.assertEqual(first['payload']['anykey'], 'mutated')
+        second = run_cumulus_task(lambda event, context: event['input'],
+                                  create_remote_event(self.s3))
+        self.assertEqual(second['payload']['anykey'], 'anyvalue')
+
+    def test_changed_etag_is_refetched(self):
+        configure_remote_event_cache(10 ** 6)
+        run_cumulus_task(lambda event, context: {}, create_remote_event(self.s3))
+        remote_event = create_remote_event(self.s3)
+        stored = json.loads(self.s3.objects[('bucket', 'events/remote')])
+        stored['payload'] = {"anykey": "changed"}
+        self.s3.put_object(Bucket='bucket', Key='events/remote',
+                           Body=json.dumps(stored))
+        response = run_cumulus_task(lambda event, context: event['input'],
+                                    remote_event)
+        self.assertEqual(response['payload'], {"anykey": "changed"})
+        self.assertEqual(self.s3.count('get_object'), 2)
+
+    def test_size_based_eviction(self):
+        cache = RemoteEventCache(max_bytes=250)
+        for index in range(5):
+            cache.put('bucket', f'key{index}', 'etag', {"data": 'x' * 100})
+        self.assertEqual(len(cache), 2)
+        self.assertLessEqual(cache.size, 250)
+        self.assertIsNone(cache.get('bucket', 'key0', 'etag'))
+        self.assertEqual(cache.get('bucket', 'key4', 'etag'), {"data": 'x' * 100})
+
+        cache.put('bucket', 'huge', 'etag', {"data": 'x' * 1000})
+        self.assertIsNone(cache.get('bucket', 'huge', 'etag'))
+
+    def test_least_recently_used_is_evicted(self):
+        cache = RemoteEventCache(max_bytes=250)
+        cache.put('bucket', 'key0', 'etag', {"data": 'x' * 100})
+        cache.put('bucket', 'key1', 'etag', {"data": 'x' * 100})
+        cache.get('bucket', 'key0', 'etag')
+        cache.put('bucket', 'key2', 'etag', {"data": 'x' * 100})
+        self.assertIsNotNone(cache.get('bucket', 'key0', 'etag'))
+        self.assertIsNone(cache.get('bucket', 'key1', 'etag'))
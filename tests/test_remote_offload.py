@@ -0,0 +1,152 @@
+import copy
+import gc
+import itertools
+import json
+import tracemalloc
+import unittest
+from mock import patch
+
+from helpers import FakeS3Client, LambdaContextMock, create_event
+
+import cumulus_json
+import cumulus_remote
+from cumulus_remote import S3StreamWriter, json_size, store_remote_response
+from cumulus_streaming import RawJson
+from run_cumulus_task import run_cumulus_task
+
+
+def create_offloaded_event(granule_count=10):
+    event = create_event()
+    event['cumulus_meta']['system_bucket'] = 'bucket'
+    event['payload'] = {
+        "granules": [{"granuleId": f"granule-{i}", "files": [{"key": f"file-{i}"}]}
+                     for i in range(granule_count)]
+    }
+    event['ReplaceConfig'] = {"Path": "$.payload", "TargetPath": "$.payload",
+                              "MaxSize": 100}
+    return event
+
+
+class TestRemoteOffload(unittest.TestCase):
+    def setUp(self):
+        self.s3 = FakeS3Client()
+        patcher = patch('cumulus_remote.s3_client', side_effect=lambda: self.s3)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def run_task(self, event):
+        return run_cumulus_task(lambda event, context: event['input'],
+                                event, LambdaContextMock())
+
+    def test_large_payload_is_offloaded(self):
+        event = create_offloaded_event()
+        response = self.run_task(copy.deepcopy(event))
+        self.assertEqual(response['payload'], {})
+        self.assertNotIn('ReplaceConfig', response)
+        self.assertNotIn('task_config', response)
+        replace = response['replace']
+        self.assertEqual(replace['Bucket'], 'bucket')
+        self.assertEqual(replace['TargetPath'], '$.payload')
+        stored = self.s3.objects[('bucket', replace['Key'])]
+        self.assertEqual(json.loads(stored), event['payload'])
+        # Past the part measured against MaxSize, encoded the same way
+        self.assertEqual(stored, json.dumps(event['payload']).encode('utf-8'))
+
+        reloaded = self.run_task(response)
+        self.assertEqual(reloaded['payload'], event['payload'])
+
+    def test_small_payload_is_not_offloaded(self):
+        event = create_offloaded_event(granule_count=0)
+        response = self.run_task(event)
+        self.assertNotIn('replace', response)
+        self.assertEqual(response['payload'], {"granules": []})
+        self.assertEqual(self.s3.calls, [])
+
+    def test_full_message(self):
+        event = create_offloaded_event()
+        event['ReplaceConfig'] = {"FullMessage": True, "MaxSize": 100}
+        response = self.run_task(event)
+        self.assertEqual(set(response), {'cumulus_meta', 'replace'})
+        self.assertEqual(response['replace']['TargetPath'], '$')
+
+    @patch('cumulus_remote.MULTIPART_CHUNK_SIZE', 1024)
+    def test_multipart_upload(self):
+        event = create_offloaded_event(granule_count=5000)
+        response = self.run_task(copy.deepcopy(event))
+        self.assertGreater(self.s3.count('upload_part'), 1)
+        self.assertEqual(self.s3.count('complete_multipart_upload'), 1)
+        stored = self.s3.objects[('bucket', response['replace']['Key'])]
+        self.assertEqual(json.loads(stored), event['payload'])
+
+    def test_failed_upload_is_aborted(self):
+        with patch.object(self.s3, 'complete_multipart_upload',
+                          side_effect=RuntimeError('boom')):
+            with patch('cumulus_remote.MULTIPART_CHUNK_SIZE', 1024):
+                with self.assertRaises(RuntimeError):
+                    self.run_task(create_offloaded_event(granule_count=5000))
+        self.assertEqual(self.s3.count('abort_multipart_upload'), 1)
+
+    @patch('cumulus_remote.MULTIPART_CHUNK_SIZE', 64 * 1024)
+    def test_memory_stays_flat_as_payload_grows(self):
+        self.s3.keep_data = False
+        peaks = []
+        # The first call parses the JSON paths and imports modules
+        for granule_count in (100, 5000, 20000):
+            event = create_offloaded_event(granule_count)
+            event.pop('task_config')
+            gc.collect()
+            tracemalloc.start()
+            store_remote_response(event, 0, ['ReplaceConfig', 'task_config'])
+            peaks.append(tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+            self.assertIn('replace', event)
+        payload_size = max(self.s3.sizes.values())
+        self.assertGreater(payload_size, 1024 * 1024)
+        self.assertLess(peaks[2], payload_size / 2)
+        self.assertLess(peaks[2], peaks[1] * 1.2)
+
+    def test_size_limit_is_json_dumps_size(self):
+        payloads = [{"granules": [{"granuleId": "granule-é", 1: [1.5, 1e308, None]}]},
+                    {"name": "✓" * 50, "files": list(range(100))}, {}]
+        for payload, delta in itertools.product(payloads, (-1, 0, 1)):
+            event = create_offloaded_event()
+            event['payload'] = copy.deepcopy(payload)
+            max_size = len(json.dumps(payload).encode('utf-8')) + delta
+            event['ReplaceConfig']['MaxSize'] = max_size
+            store_remote_response(event, 0, ['ReplaceConfig'])
+            with self.subTest(payload=payload, delta=delta):
+                self.assertEqual('replace' in event, delta <= 0)
+                self.assertEqual(json_size(payload), max_size - delta)
+                if delta <= 0:
+                    stored = self.s3.objects[('bucket', event['replace']['Key'])]
+                    self.assertEqual(stored, json.dumps(payload).encode('utf-8'))
+
+    def test_payload_is_encoded_once(self):
+        event = create_offloaded_event(granule_count=1000)
+        with patch('cumulus_json.dumps', wraps=cumulus_json.dumps) as dumps:
+            ''.join(cumulus_remote.iter_json(event['payload']))
+        with patch('cumulus_json.dumps', wraps=cumulus_json.dumps) as upload_dumps:
+            store_remote_response(event, 0, ['ReplaceConfig', 'task_config'])
+        # The upload reuses what was encoded to measure the payload
+        self.assertEqual(upload_dumps.call_count, dumps.call_count)
+
+    @patch('cumulus_remote.MULTIPART_MIN_PART_SIZE', 10)
+    @patch('cumulus_remote.MULTIPART_MAX_PART_SIZE', 25)
+    def test_copied_parts(self):
+        source = bytes(range(100))
+        self.s3.put_object(Bucket='bucket', Key='source', Body=source)
+        etag = self.s3.head_object(Bucket='bucket', Key='source')['ETag']
+        writer = S3StreamWriter(self.s3, 'bucket', 'copy')
+        writer.write(b'ab')
+        writer.copy(RawJson(source, 20, 80, {'Bucket': 'bucket', 'Key': 'source',
+                                             'ETag': etag}))
+        # Too small to be copied as a part
+        writer.copy(RawJson(source, 0, 5, {'Bucket': 'bucket', 'Key': 'source',
+                                           'ETag': etag}))
+        writer.write(b'cd')
+        writer.close()
+        self.assertEqual(self.s3.objects[('bucket', 'copy')],
+                         b'ab' + source[20:80] + source[:5] + b'cd')
+        self.assertEqual(self.s3.count('upload_part'), 2)
+        self.assertEqual(self.s3.count('upload_part_copy'), 3)
+        self.assertEqual([part['PartNumber'] for part in writer.parts], [1, 2, 3, 4, 5])
@@ -0,0 +1,144 @@
+import copy
+import json
+import unittest
+from mock import patch
+
+from helpers import DeadlineContextMock, FakeS3Client, LambdaContextMock, create_event
+
+from cumulus_deadline import CheckpointSaved
+from run_cumulus_task import CumulusStep, run_cumulus_task, run_cumulus_tasks
+
+STEP_CONFIGS = {
+    "parse": {
+        "stack": "{$.meta.stack}",
+        "cumulus_message": {"outputs": [
+            {"source": "{$.granules}", "destination": "{$.payload.granules}"},
+            {"source": "{$.pdr}", "destination": "{$.meta.pdr}"},
+        ]},
+    },
+    "queue": {"pdr": "{$.meta.pdr}"},
+}
+
+
+def parse(event, context):
+    return {"granules": [{"granuleId": f"{event['config']['stack']}-{i}"} for i in range(3)],
+            "pdr": {"name": "pdr-1"}}
+
+
+def queue(event, context):
+    return {"queued": [granule['granuleId'] for granule in event['input']['granules']],
+            "pdr": event['config']['pdr']['name']}
+
+
+def create_fused_event():
+    event = create_event()
+    event['task_config'] = {"workflow_tasks": copy.deepcopy(STEP_CONFIGS)}
+    return event
+
+
+class TestRunCumulusTasks(unittest.TestCase):
+    def test_same_message_as_separate_steps(self):
+        message = create_event()
+        for name, task in (('parse', parse), ('queue', queue)):
+            message['task_config'] = copy.deepcopy(STEP_CONFIGS[name])
+            message = run_cumulus_task(task, message, LambdaContextMock())
+
+        result = run_cumulus_tasks([parse, queue], create_fused_event(), LambdaContextMock())
+        self.assertEqual(result, message)
+        self.assertEqual(result['payload'], {
+            "queued": ["Sleestak-0", "Sleestak-1", "Sleestak-2"], "pdr": "pdr-1"})
+        self.assertEqual(len(result['meta']['workflow_tasks']), 2)
+
+    def test_steps_share_the_task_config_by_default(self):
+        seen = []
+
+        def step(event, context):
+            seen.append(event['config'])
+            return event['input']
+        event = create_event()
+        event['task_config'] = {"stack": "{$.meta.stack}"}
+        result = run_cumulus_tasks([('first', step), CumulusStep('second', step)], event)
+        self.assertEqual(seen, [{"stack": "Sleestak"}] * 2)
+        self.assertEqual(result['payload'], event['payload'])
+
+    def test_only_the_last_message_is_stored(self):
+        s3 = FakeS3Client()
+        event = create_fused_event()
+        event['cumulus_meta']['system_bucket'] = 'bucket'
+        event['ReplaceConfig'] = {"FullMessage": True, "MaxSize": 0}
+        with patch('cumulus_remote.s3_client', side_effect=lambda: s3):
+            result = run_cumulus_tasks([parse, queue], event, LambdaContextMock())
+        self.assertEqual(s3.count('put_object'), 1)
+        self.assertEqual(set(result), {'cumulus_meta', 'replace'})
+
+    def test_workflow_error_ends_the_workflow(self):
+        def fail(event, context):
+            raise Exception('WorkflowError')
+
+        def never(event, context):
+            raise AssertionError('not reached')
+        result = run_cumulus_tasks([parse, fail, never], create_fused_event())
+        self.assertEqual(result['exception'], 'WorkflowError')
+        self.assertIsNone(result['payload'])
+        self.assertEqual(result['meta']['pdr'], {"name": "pdr-1"})
+
+    def test_workflow_error_stores_a_large_message(self):
+        def parse_large(event, context):
+            return dict(parse(event, context), pdr={"name": "pdr-1", "data": "x" * 10000})
+
+        def fail(event, context):
+            raise Exception('WorkflowError')
+        s3 = FakeS3Client()
+        event = create_fused_event()
+        event['cumulus_meta']['system_bucket'] = 'bucket'
+        event['ReplaceConfig'] = {"FullMessage": True, "MaxSize": 1000}
+        with patch('cumulus_remote.s3_client', side_effect=lambda: s3):
+            result = run_cumulus_tasks([('parse', parse_large), fail], event)
+        self.assertEqual(set(result), {'cumulus_meta', 'replace'})
+        self.assertEqual(event['ReplaceConfig'], {"FullMessage": True, "MaxSize": 1000})
+        stored = json.loads(s3.objects[('bucket', result['replace']['Key'])])
+        self.assertEqual(stored['exception'], 'WorkflowError')
+        self.assertEqual(len(stored['meta']['pdr']['data']), 10000)
+
+    def test_resume_from_the_step_that_stopped(self):
+        calls = []
+
+        def counted(task):
+            def step(event, context, deadline):
+                calls.append(task.__name__)
+                if task is queue and deadline.checkpoint is None:
+                    deadline.stop({"queued": 1})
+                return task(event, context)
+            step.__name__ = task.__name__
+            return step
+        steps = [counted(parse), counted(queue)]
+        s3 = FakeS3Client()
+        event = create_fused_event()
+        event['cumulus_meta']['system_bucket'] = 'bucket'
+        with patch('cumulus_remote.s3_client', side_effect=lambda: s3):
+            with self.assertRaises(CheckpointSaved) as raised:
+                run_cumulus_tasks(steps, copy.deepcopy(event), DeadlineContextMock(0))
+            saved = json.loads(s3.objects[('bucket', raised.exception.key)])
+            self.assertEqual((saved['step'], saved['state']), ('queue', {"queued": 1}))
+            self.assertEqual(len(saved['message']['payload']['granules']), 3)
+
+            # Retried with the same message
+            result = run_cumulus_tasks(steps, copy.deepcopy(event), DeadlineContextMock(0))
+        self.assertEqual(calls, ['parse', 'queue', 'queue'])
+        self.assertEqual(result['payload']['pdr'], 'pdr-1')
+        self.assertNotIn('checkpoint', result['cumulus_meta'])
+
+        saved['step'] = 'unknown'
+        with patch('run_cumulus_task.find_checkpoint', return_value=saved), \
+                self.assertRaises(ValueError):
+            run_cumulus_tasks(steps, copy.deepcopy(event))
+
+    def test_message_adapter_disabled(self):
+        with patch('run_cumulus_task._settings', None), \
+                patch.dict('os.environ', {'CUMULUS_MESSAGE_ADAPTER_DISABLED': 'true'}):
+            result = run_cumulus_tasks(
+                [lambda event, context: dict(event, first=True),
+                 lambda event, context: dict(event, second=event['first'])],
+                {"a": 1})
+        self.assertEqual(result, {"a": 1, "first": True, "second": True})
+
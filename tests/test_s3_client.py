@@ -0,0 +1,119 @@
+import json
+import os
+import unittest
+from mock import patch
+
+from helpers import LambdaContextMock, LocalS3Server, create_event
+from test_batch import create_sqs_event
+
+import cumulus_remote
+from cumulus_parallel import map_granules
+from cumulus_remote import configure_s3_client, s3_client
+from run_cumulus_task import bootstrap, run_cumulus_task, run_cumulus_task_batch
+
+
+def remote_message():
+    message = create_event()
+    message['cumulus_meta']['system_bucket'] = 'bucket'
+    message['payload'] = {}
+    message['replace'] = {"Bucket": "bucket", "Key": "events/incoming",
+                          "TargetPath": "$.payload"}
+    message['ReplaceConfig'] = {"Path": "$.payload", "TargetPath": "$.payload",
+                                "MaxSize": 0}
+    return message
+
+
+def inherited_client(granule, logger):
+    return cumulus_remote._s3_client is None
+
+
+class TestSharedS3Client(unittest.TestCase):
+    """Counts the connections opened to a local S3 stand-in."""
+
+    def setUp(self):
+        self.server = LocalS3Server().__enter__()
+        self.addCleanup(self.server.__exit__)
+        payload = {"granules": [{"granuleId": f"granule-{i}"} for i in range(100)]}
+        self.server.objects['/bucket/events/incoming'] = json.dumps(payload).encode()
+        patchers = [patch('cumulus_remote._localhost_s3_url', return_value=self.server.url),
+                    patch('cumulus_remote._s3_client', None)]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(configure_s3_client)
+
+    def new_connections(self, invoke, count=5):
+        opened = []
+        for _ in range(count):
+            connections = self.server.connections
+            invoke()
+            opened.append(self.server.connections - connections)
+        return opened
+
+    def test_invocations_reuse_one_connection(self):
+        def invoke():
+            result = run_cumulus_task(lambda event, context: event['input'],
+                                      remote_message(), LambdaContextMock())
+            self.assertIn('replace', result)
+        self.assertEqual(self.new_connections(invoke), [1, 0, 0, 0, 0])
+        # Loaded once and stored once per invocation
+        self.assertEqual(len(self.server.objects), 6)
+
+    def test_tasks_share_the_client(self):
+        def task(event, context):
+            s3_client().put_object(Bucket='bucket', Key='task/output', Body=b'{}')
+            return {}
+
+        def invoke():
+            run_cumulus_task(task, remote_message(), LambdaContextMock())
+        self.assertEqual(self.new_connections(invoke), [1, 0, 0, 0, 0])
+        self.assertIs(s3_client(), s3_client())
+
+    def test_batches_reuse_connections(self):
+        records = create_sqs_event([remote_message() for _ in range(8)])
+
+        def invoke():
+            response = run_cumulus_task_batch(
+                lambda event, context: event['input'], records, LambdaContextMock(),
+                max_workers=4)
+            self.assertEqual(response, {"batchItemFailures": []})
+        opened = self.new_connections(invoke, count=3)
+        self.assertLessEqual(opened[0], 4)
+        self.assertEqual(opened[1:], [0, 0])
+
+    def test_forked_workers_create_their_own_client(self):
+        s3_client()
+        result = map_granules(inherited_client, range(4), max_workers=2)
+        self.assertEqual(result.results, [True] * 4)
+        self.assertIsNotNone(cumulus_remote._s3_client)
+
+    def test_configure(self):
+        client = s3_client()
+        configure_s3_client()
+        self.assertIs(s3_client(), client)
+        configure_s3_client(max_pool_connections=3, tcp_keepalive=False, max_attempts=2,
+                            retry_mode='adaptive', connect_timeout=1, read_timeout=2)
+        config = s3_client().meta.config
+        self.assertIsNot(s3_client(), client)
+        self.assertEqual((config.max_pool_connections, config.tcp_keepalive,
+                          config.connect_timeout, config.read_timeout),
+                         (3, False, 1, 2))
+        self.assertEqual(config.retries, {'total_max_attempts': 2, 'mode': 'adaptive'})
+        with self.assertRaises(ValueError):
+            configure_s3_client(retry_mode='exponential')
+
+    def test_bootstrap(self):
+        with patch.dict(os.environ, {'CUMULUS_S3_MAX_POOL_CONNECTIONS': '20',
+                                     'CUMULUS_S3_TCP_KEEPALIVE': 'false',
+                                     'CUMULUS_S3_MAX_ATTEMPTS': '4',
+                                     'CUMULUS_S3_READ_TIMEOUT': '2.5'}):
+            self.addCleanup(bootstrap, refresh=True)
+            settings = bootstrap(refresh=True)
+        self.assertEqual((settings.s3_max_pool_connections, settings.s3_tcp_keepalive,
+                          settings.s3_max_attempts, settings.s3_retry_mode,
+                          settings.s3_connect_timeout, settings.s3_read_timeout),
+                         (20, False, 4, 'standard', None, 2.5))
+        config = s3_client().meta.config
+        self.assertEqual((config.max_pool_connections, config.tcp_keepalive,
+                          config.read_timeout), (20, False, 2.5))
+        self.assertEqual(config.retries, {'total_max_attempts': 4, 'mode': 'standard'})
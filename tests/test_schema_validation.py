@@ -0,0 +1,234 @@
+import copy
+import itertools
+import json
+import os
+import random
+import unittest
+from mock import Mock, patch
+
+from helpers import LambdaContextMock, create_event
+
+from jsonschema import validators
+import cumulus_adapter
+from cumulus_adapter import CumulusMessageAdapter, SchemaSet
+from cumulus_schema import compile_schema, set_validation_engine
+
+DRAFTS = {
+    'draft-04': 'http://json-schema.org/draft-04/schema#',
+    'draft-07': 'http://json-schema.org/draft-07/schema#',
+    '2020-12': 'https://json-schema.org/draft/2020-12/schema',
+}
+FIXTURES = os.path.join(os.path.dirname(__file__), 'fixtures', 'schemas')
+
+GRANULE = {
+    "type": "object",
+    "required": ["granuleId", "files"],
+    "properties": {
+        "granuleId": {"type": "string", "pattern": "^g-[0-9]+$", "maxLength": 12},
+        "files": {"type": "array", "minItems": 1, "items": {"$ref": "#/definitions/file"}},
+        "size": {"type": "integer", "minimum": 0, "exclusiveMaximum": 100},
+        "ratio": {"type": "number", "multipleOf": 0.5},
+        "status": {"enum": ["queued", "running", 1, None]},
+    },
+    "additionalProperties": False,
+}
+# (schema, documents) pairs, in a draft-agnostic subset of JSON Schema
+CASES = [
+    ({"type": "integer"}, [1, 1.0, 1.5, True, "1", None]),
+    ({"type": ["string", "null"]}, ["a", None, 0, [], {}]),
+    ({"type": "object", "minProperties": 1, "maxProperties": 2},
+     [{}, {"a": 1}, {"a": 1, "b": 2, "c": 3}, []]),
+    ({"enum": [1, "a", [1, 2], {"b": False}]},
+     [1, True, 1.0, "a", [1, 2], [True, 2], {"b": False}, {"b": 0}, 2]),
+    ({"enum": [False, 0]}, [False, 0, 0.0, True, None]),
+    ({"uniqueItems": True},
+     [[1, 2], [1, 1.0], [1, True], [0, False], [[1], [True]], [{"a": 1}, {"a": 1}],
+      [{"a": [1]}, {"a": [True]}], ["1", 1], []]),
+    ({"minimum": 1, "maximum": 3}, [0, 1, 3, 3.5, "5", True]),
+    ({"multipleOf": 3}, [9, 10, 9.0, 4.5]),
+    ({"multipleOf": 0.1}, [0.3, 1e308, 0.35]),
+    ({"minLength": 2, "maxLength": 3, "pattern": "b"}, ["ab", "abcd", "a", "cc", 12]),
+    ({"items": {"type": "string"}, "minItems": 1, "maxItems": 2},
+     [[], ["a"], ["a", 1], ["a", "b", "c"], "ab"]),
+    ({"properties": {"a": {"type": "integer"}}, "required": ["b"],
+      "patternProperties": {"^x-": {"type": "string"}},
+      "additionalProperties": {"type": "boolean"}},
+     [{"b": 1}, {"a": "1", "b": 1}, {"b": 1, "x-y": 1}, {"b": 1, "x-y": "y"},
+      {"b": True, "c": 1}, {"b": True, "c": False}, {"a": 1}]),
+    ({"patternProperties": {"^a": True, "b$": True}, "additionalProperties": False},
+     [{"ab": 1}, {"cb": 1}, {"c": 1}, {}]),
+    ({"allOf": [{"type": "integer"}, {"minimum": 2}]}, [1, 2, 2.5]),
+    ({"anyOf": [{"type": "string"}, {"minimum": 2}]}, ["a", 1, 3]),
+    ({"oneOf": [{"type": "integer"}, {"minimum": 2}]}, [1, 3, 2.5, 1.5]),
+    ({"not": {"type": "string"}}, ["a", 1]),
+    ({"definitions": {"a~b": {"type": "integer"}, "c/d": {"$ref": "#/definitions/a~0b"}},
+      "properties": {"x": {"$ref": "#/definitions/c~1d"}, "y": {"$ref": "#"}}},
+     [{"x": 1}, {"x": "1"}, {"y": {"x": "1"}}, {"y": {"y": {"x": 2}}}]),
+    ({"type": "array", "items": GRANULE, "definitions": {"file": {
+        "type": "object", "required": ["key"],
+        "properties": {"key": {"type": "string"}, "bucket": {"type": "string"}}}}},
+     [[{"granuleId": "g-1", "files": [{"key": "k"}]}],
+      [{"granuleId": "g-1", "files": [{"key": "k"}], "size": 100}],
+      [{"granuleId": "g-1", "files": [{"key": "k"}], "size": 99, "ratio": 1.5,
+        "status": None}],
+      [{"granuleId": "g-1", "files": [{"key": "k"}], "ratio": 1.2}],
+      [{"granuleId": "g-1", "files": [{"key": "k"}], "status": True}],
+      [{"granuleId": "g-1", "files": []}],
+      [{"granuleId": "x-1", "files": [{"key": "k"}]}],
+      [{"granuleId": "g-1", "files": [{"bucket": "b"}]}],
+      [{"granuleId": "g-1", "files": [{"key": "k"}], "extra": 1}]]),
+]
+
+
+def validator_class(schema, draft):
+    return validators.validator_for(dict(schema, **{"$schema": DRAFTS[draft]}))
+
+
+def random_document(depth=0):
+    choices = [None, True, False, 0, 1, -1, 2.5, 100, "", "g-1", "g-12345678901", "a"]
+    kind = random.random()
+    if depth > 3 or kind < 0.5:
+        return random.choice(choices)
+    keys = ["granuleId", "files", "size", "ratio", "status", "key", "bucket", "x"]
+    if kind < 0.75:
+        return [random_document(depth + 1) for _ in range(random.randint(0, 3))]
+    return {key: random_document(depth + 1)
+            for key in random.sample(keys, random.randint(0, 4))}
+
+
+class TestConformance(unittest.TestCase):
+    """Compiled validators must agree with jsonschema."""
+
+    def assert_conforms(self, schema, documents, draft):
+        schema = dict(schema, **{"$schema": DRAFTS[draft]})
+        cls = validators.validator_for(schema)
+        is_valid = compile_schema(schema, cls)
+        self.assertIsNotNone(is_valid, schema)
+        validator = cls(schema)
+        for document in documents:
+            with self.subTest(draft=draft, schema=schema, document=document):
+                self.assertEqual(is_valid(document), validator.is_valid(document))
+
+    def test_cases(self):
+        for (schema, documents), draft in itertools.product(CASES, DRAFTS):
+            self.assert_conforms(schema, documents, draft)
+
+    def test_random_documents(self):
+        random.seed(7)
+        documents = [random_document() for _ in range(500)]
+        documents += [[{"granuleId": "g-1", "files": [document]}] for document in documents]
+        for (schema, _), draft in itertools.product(CASES, DRAFTS):
+            self.assert_conforms(schema, documents, draft)
+
+    def test_fixture_schemas(self):
+        event = create_event()
+        for name in ('input', 'config', 'output'):
+            with open(os.path.join(FIXTURES, f'{name}.json'), encoding='utf-8') as schema_file:
+                schema = json.load(schema_file)
+            cls = validators.validator_for(schema)
+            is_valid = compile_schema(schema, cls)
+            self.assertIsNotNone(is_valid)
+            for document in (event, event['payload'], event['task_config'], {},
+                             {"hello": "world"}, {"goodbye": 1}, []):
+                self.assertEqual(is_valid(document), cls(schema).is_valid(document))
+
+    def test_draft_specific_keywords(self):
+        cases = [
+            ({"minimum": 1, "exclusiveMinimum": True}, 'draft-04', [1, 2]),
+            ({"exclusiveMinimum": 1}, 'draft-07', [1, 2]),
+            ({"const": {"a": [1]}}, 'draft-04', [{"a": [True]}]),
+            ({"const": {"a": [1]}}, 'draft-07', [{"a": [1]}, {"a": [True]}, {"a": [1.0]}]),
+            ({"if": {"type": "integer"}, "then": {"minimum": 2}, "else": {"type": "string"}},
+             'draft-07', [1, 2, "a", None]),
+            ({"if": {"type": "integer"}, "then": {"minimum": 2}}, 'draft-04', [1]),
+            ({"definitions": {"a": {"type": "integer"}},
+              "$ref": "#/definitions/a", "minimum": 2}, 'draft-07', [1, "a"]),
+            ({"$defs": {"a": {"type": "integer"}},
+              "$ref": "#/$defs/a", "minimum": 2}, '2020-12', [1, 2, "a"]),
+            ({"type": "integer"}, 'draft-04', [1.0]),
+            ({"items": False}, '2020-12', [[], [1]]),
+            ({"properties": {"a": False}}, 'draft-07', [{}, {"a": 1}]),
+        ]
+        for schema, draft, documents in cases:
+            self.assert_conforms(schema, documents, draft)
+
+    def test_unsupported_schemas(self):
+        for schema in ({"dependencies": {"a": ["b"]}}, {"contains": {"type": "string"}},
+                       {"$ref": "other.json#/a"}, {"items": [{"type": "string"}]},
+                       {"type": "any"},
+                       {"definitions": {"a": {"$id": "#a"}}, "$ref": "#a"}):
+            with self.subTest(schema=schema):
+                self.assertIsNone(compile_schema(schema, validator_class(schema, 'draft-07')))
+
+    def test_sampled_items(self):
+        schema = {"items": {"type": "integer"}, "maxItems": 5}
+        is_valid = compile_schema(schema, validator_class(schema, 'draft-07'), sample_items=2)
+        self.assertTrue(is_valid([1, 2, "three"]))
+        self.assertFalse(is_valid([1, "two"]))
+        self.assertFalse(is_valid([1, 2, 3, 4, 5, 6]))
+
+
+class TestCompiledEngine(unittest.TestCase):
+    schema = {"type": "object", "required": ["granules"], "properties": {
+        "granules": {"type": "array", "minItems": 1,
+                     "items": {"type": "object", "required": ["granuleId"]}}}}
+
+    def setUp(self):
+        set_validation_engine('compiled')
+        self.addCleanup(set_validation_engine)
+        self.schema_set = SchemaSet({})
+        for schema_type in ('input', 'config', 'output'):
+            self.schema_set.schemas[schema_type] = self.schema
+
+    def errors(self, document):
+        errors = []
+        for engine in ('jsonschema', 'compiled'):
+            set_validation_engine(engine)
+            with self.assertRaises(Exception) as raised:
+                self.schema_set.validate(copy.deepcopy(document), 'output')
+            errors.append((raised.exception.message, list(raised.exception.path)))
+        return errors
+
+    def test_same_errors(self):
+        for document in ({}, {"granules": []}, {"granules": [{"granuleId": 1}, {}]}):
+            expected, actual = self.errors(document)
+            self.assertEqual(actual, expected)
+
+    def test_valid_documents_skip_jsonschema(self):
+        with patch.object(SchemaSet, '_validate') as validate:
+            self.schema_set.validate({"granules": [{"granuleId": "a"}]}, 'input')
+        validate.assert_not_called()
+
+    def test_valid_configs_are_remembered(self):
+        config = {"granules": [{"granuleId": "a"}]}
+        is_valid = self.schema_set._compiled_validator('config', 0)
+        with patch.dict(self.schema_set._compiled,
+                        {('config', 0): Mock(wraps=is_valid)}):
+            for _ in range(3):
+                self.schema_set.validate(dict(config), 'config')
+            self.assertEqual(self.schema_set._compiled[('config', 0)].call_count, 1)
+        with self.assertRaises(Exception):
+            self.schema_set.validate({"granules": []}, 'config')
+
+    def test_streamed_items(self):
+        adapter = CumulusMessageAdapter(schema_set=self.schema_set)
+
+        def granules():
+            yield {"granuleId": "a"}
+            yield {}
+        with self.assertRaises(Exception) as raised:
+            adapter.create_next_event({"granules": granules()}, create_event(), {})
+        self.assertEqual(list(raised.exception.path), ['granules', 1])
+
+    def test_bootstrap(self):
+        from run_cumulus_task import bootstrap, run_cumulus_task
+        with patch.dict('os.environ', {'CUMULUS_SCHEMA_VALIDATION': 'compiled',
+                                       'CUMULUS_SCHEMA_SAMPLE_ITEMS': '10'}):
+            self.addCleanup(bootstrap, refresh=True)
+            settings = bootstrap(refresh=True)
+        self.assertEqual((settings.schema_validation, settings.schema_sample_items),
+                         ('compiled', 10))
+        cumulus_adapter.clear_cache()
+        result = run_cumulus_task(lambda event, context: {}, create_event(),
+                                  LambdaContextMock())
+        self.assertEqual(result['payload'], {})
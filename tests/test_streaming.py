@@ -0,0 +1,183 @@
+import json
+import tracemalloc
+import unittest
+from mock import patch
+
+from helpers import FakeS3Client, LambdaContextMock, create_event
+
+import cumulus_json
+from cumulus_adapter import CumulusMessageAdapter, SchemaSet
+from cumulus_streaming import SpooledArray
+from run_cumulus_task import run_cumulus_task
+
+
+def make_granule(index):
+    return {"granuleId": f"granule-{index}",
+            "files": [{"bucket": "protected", "key": f"granule-{index}.h5"}]}
+
+
+def discover(count):
+    for index in range(count):
+        yield make_granule(index)
+
+
+def create_offloaded_event():
+    event = create_event()
+    event['cumulus_meta']['system_bucket'] = 'bucket'
+    event['ReplaceConfig'] = {"Path": "$.payload", "TargetPath": "$.payload",
+                              "MaxSize": 100}
+    return event
+
+
+def output_adapter(schema):
+    schema_set = SchemaSet({})
+    schema_set.schemas['output'] = schema
+    return CumulusMessageAdapter(schema_set=schema_set)
+
+
+class TestSpooledArray(unittest.TestCase):
+    def test_in_memory(self):
+        array = SpooledArray(discover(3), budget=1024)
+        self.assertFalse(array.spilled)
+        self.assertEqual(len(array), 3)
+        self.assertEqual(array.to_list(), list(discover(3)))
+        self.assertEqual(array.size, len(cumulus_json.dumpb(list(discover(3)))))
+
+    def test_spilled(self):
+        array = SpooledArray(discover(100), budget=1024)
+        self.addCleanup(array.close)
+        self.assertTrue(array.spilled)
+        self.assertEqual(len(array), 100)
+        self.assertEqual(array.to_list(), list(discover(100)))
+        self.assertEqual(''.join(array.iter_encoded()),
+                         cumulus_json.dumps(list(discover(100))))
+        self.assertEqual(array.size, len(cumulus_json.dumpb(list(discover(100)))))
+
+    def test_multibyte_characters_across_chunks(self):
+        items = ['é' * 50000, '日本' * 30000]
+        array = SpooledArray(iter(items), budget=0)
+        self.addCleanup(array.close)
+        self.assertEqual(''.join(array.iter_encoded()), cumulus_json.dumps(items))
+
+    def test_clear(self):
+        array = SpooledArray(discover(100), budget=1024)
+        array.clear()
+        self.assertFalse(array.spilled)
+        self.assertEqual((len(array), array.to_list()), (0, []))
+
+    def test_validate_each_item(self):
+        seen = []
+        SpooledArray(discover(3), lambda item, index: seen.append(index))
+        self.assertEqual(seen, [0, 1, 2])
+
+    def test_spill_file_is_deleted_on_error(self):
+        def validate(item, index):
+            if index == 50:
+                raise ValueError('invalid')
+        with patch('cumulus_streaming.tempfile.TemporaryFile') as temporary_file:
+            with self.assertRaises(ValueError):
+                SpooledArray(discover(100), validate, budget=1024)
+        temporary_file.return_value.close.assert_called_once_with()
+
+
+class TestStreamedOutput(unittest.TestCase):
+    def setUp(self):
+        self.s3 = FakeS3Client()
+        patcher = patch('cumulus_remote.s3_client', side_effect=lambda: self.s3)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_generator_payload(self):
+        response = run_cumulus_task(lambda event, context: discover(3),
+                                    create_event(), LambdaContextMock())
+        self.assertEqual(response['payload'], list(discover(3)))
+
+    def test_dict_of_generators(self):
+        def task(event, context):
+            return {"granules": discover(3), "count": 3}
+        response = run_cumulus_task(task, create_event(), LambdaContextMock())
+        self.assertEqual(response['payload'],
+                         {"granules": list(discover(3)), "count": 3})
+
+    def test_spilled_payload_is_offloaded(self):
+        def task(event, context):
+            return {"granules": discover(1000)}
+        with patch('cumulus_streaming._memory_budget', 4096):
+            response = run_cumulus_task(task, create_offloaded_event(),
+                                        LambdaContextMock())
+        self.assertEqual(response['payload'], {})
+        stored = self.s3.objects[('bucket', response['replace']['Key'])]
+        self.assertEqual(json.loads(stored), {"granules": list(discover(1000))})
+
+    def test_streamed_outputs_mapping(self):
+        event = create_event()
+        event['task_config'] = {"cumulus_message": {"outputs": [
+            {"source": "{$.granules}", "destination": "{$.meta.granules}"}]}}
+        response = run_cumulus_task(
+            lambda event, context: {"granules": discover(2)}, event,
+            LambdaContextMock())
+        self.assertEqual(response['meta']['granules'], list(discover(2)))
+
+    def test_memory_is_bounded_by_budget(self):
+        def task(event, context):
+            return {"granules": discover(50000)}
+        size = len(cumulus_json.dumpb(list(discover(50000))))
+        self.s3.keep_data = False
+        with patch('cumulus_streaming._memory_budget', 64 * 1024), \
+                patch('cumulus_remote.MULTIPART_CHUNK_SIZE', 64 * 1024):
+            tracemalloc.start()
+            try:
+                response = run_cumulus_task(task, create_offloaded_event(),
+                                            LambdaContextMock())
+                peak = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+        self.assertIn('replace', response)
+        self.assertLess(peak, size / 8)
+
+
+class TestStreamedValidation(unittest.TestCase):
+    schema = {
+        "type": "object",
+        "required": ["granules"],
+        "properties": {
+            "granules": {"type": "array", "minItems": 1,
+                         "items": {"$ref": "#/definitions/granule"}},
+            "count": {"type": "integer"},
+        },
+        "definitions": {"granule": {"type": "object", "required": ["granuleId"]}},
+    }
+
+    def create_next_event(self, response):
+        adapter = output_adapter(self.schema)
+        return adapter.create_next_event(response, create_event(), {})
+
+    def test_valid_items(self):
+        result = self.create_next_event({"granules": discover(3), "count": 3})
+        self.assertEqual(len(result['payload']['granules']), 3)
+
+    def test_invalid_item(self):
+        def granules():
+            yield from discover(2)
+            yield {"files": []}
+        with self.assertRaises(Exception) as raised:
+            self.create_next_event({"granules": granules()})
+        self.assertTrue(raised.exception.message.startswith('output schema: '))
+        self.assertEqual(list(raised.exception.path), ['granules', 2])
+
+    def test_invalid_rest_of_response(self):
+        consumed = []
+
+        def granules():
+            consumed.append(True)
+            yield from discover(1)
+        with self.assertRaises(Exception) as raised:
+            self.create_next_event({"granules": granules(), "count": "three"})
+        self.assertEqual(list(raised.exception.path), ['count'])
+        self.assertEqual(consumed, [])
+
+    def test_top_level_stream(self):
+        self.schema = {"type": "array", "items": {"type": "integer"}}
+        self.assertEqual(self.create_next_event(iter([1, 2]))['payload'], [1, 2])
+        with self.assertRaises(Exception):
+            self.create_next_event(iter([1, 'two']))